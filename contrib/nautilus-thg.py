@@ -53,6 +53,7 @@ def _thg_path():
 _thg_path()
 
 from tortoisehg.util import hglib, paths, debugthg, cachethg
+from tortoisehg.util import statusservice
 
 if debugthg.debug('N'):
     debugf = debugthg.debugf
@@ -64,6 +65,9 @@ demandimport.disable()
 
 nofilecmds = 'about serve synch repoconfig userconfig merge unmerge'.split()
 
+# number of queued files of which states are queried at once
+SCAN_BATCH = 200
+
 class HgExtensionDefault(GObject.GObject):
 
     def __init__(self):
@@ -74,6 +78,10 @@ class HgExtensionDefault(GObject.GObject):
         from tortoisehg.util import menuthg
         self.hgtk = paths.find_in_path(thg_main)
         self.menu = menuthg.menuThg()
+        self.statusclient = None
+        if self.hgtk and hasattr(os, 'getuid'):
+            self.statusclient = statusservice.StatusClient(
+                [sys.executable, self.hgtk, 'thgstatus', '--serve'])
 
         # Get the configuration directory path
         try:
@@ -233,8 +241,9 @@ class HgExtensionDefault(GObject.GObject):
                                "Hg Status",
                                "Version control status"),
 
-    def _get_file_status(self, localpath, repo=None):
-        cachestate = cachethg.get_state(localpath, repo)
+    def _get_file_status(self, localpath, repo=None, cachestate=None):
+        if cachestate is None:
+            cachestate = cachethg.get_state(localpath, repo)
         cache2state = {cachethg.UNCHANGED:   ('default',   'clean'),
                        cachethg.ADDED:       ('list-add',  'added'),
                        cachethg.MODIFIED:    ('important', 'modified'),
@@ -267,16 +276,16 @@ class HgExtensionDefault(GObject.GObject):
 
     def invalidate(self, paths, root = ''):
         started = bool(self.inv_dirs)
-        if cachethg.cache_pdir == root and root not in self.inv_dirs:
-            cachethg.overlay_cache.clear()
         self.inv_dirs.update([os.path.dirname(root), '/', ''])
         for path in paths:
             path = os.path.join(root, path)
+            cachethg.invalidate(path)
             while path not in self.inv_dirs:
                 self.inv_dirs.add(path)
                 path = os.path.dirname(path)
-                if cachethg.cache_pdir == path:
-                    cachethg.overlay_cache.clear()
+        if self.statusclient:
+            self.statusclient.invalidate([os.path.join(root, path)
+                                          for path in paths])
         if started:
             return
         if len(paths) > 1:
@@ -369,20 +378,36 @@ class HgExtensionIcons(HgExtensionDefault):
         '''Update emblem and hg status for files when there is time'''
         if not self.scanStack:
             return False
+        files = []
         try:
-            vfs_file = self.scanStack.pop()
-            path = self.get_path_for_vfs_file(vfs_file, False)
-            if not path:
+            while self.scanStack and len(files) < SCAN_BATCH:
+                vfs_file = self.scanStack.pop()
+                path = self.get_path_for_vfs_file(vfs_file, False)
+                if not path:
+                    continue
+                oldvfs = self.get_vfs(path)
+                if oldvfs and oldvfs != vfs_file:
+                    #file has changed on disc (not invalidated)
+                    self.get_path_for_vfs_file(vfs_file) #save new vfs
+                    self.invalidate([os.path.dirname(path)])
+                files.append((vfs_file, path))
+            if not files:
                 return True
-            oldvfs = self.get_vfs(path)
-            if oldvfs and oldvfs != vfs_file:
-                #file has changed on disc (not invalidated)
-                self.get_path_for_vfs_file(vfs_file) #save new vfs
-                self.invalidate([os.path.dirname(path)])
-            emblem, status = self._get_file_status(path)
-            if emblem is not None:
-                vfs_file.add_emblem(emblem)
-            vfs_file.add_string_attribute('hg_status', status)
+            # ask states of all queued files to the status service at once
+            states = None
+            if self.statusclient:
+                states = self.statusclient.states([p for _f, p in files])
+            if states is None:
+                states = [None] * len(files)
+            for (vfs_file, path), cachestate in zip(files, states):
+                if cachestate:
+                    # the first state wins as in cachethg.get_state()
+                    cachestate = cachestate[0]
+                emblem, status = self._get_file_status(path,
+                                                       cachestate=cachestate)
+                if emblem is not None:
+                    vfs_file.add_emblem(emblem)
+                vfs_file.add_string_attribute('hg_status', status)
         except Exception as e:
             debugf(e)
         return True
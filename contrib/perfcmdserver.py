@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+# perfcmdserver.py - benchmarks of command server output channel
+#
+# This software may be used and distributed according to the terms of the
+# GNU General Public License version 2 or any later version.
+
+"""benchmarks of reading output of command server
+
+Run from the top of the source tree with Mercurial and PyQt importable:
+
+  $ python contrib/perfcmdserver.py parse --size 100 --block 64
+  $ python contrib/perfcmdserver.py stream --size 100 --block 4096
+
+"parse" feeds a synthetic output stream to the channel reader of CmdServer,
+and "stream" runs a command writing the output in a real command server.
+In both cases, the output is captured as by setCaptureOutput().
+"""
+
+from __future__ import absolute_import, print_function
+
+import argparse
+import os
+import shutil
+import struct
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from tortoisehg.hgqt.qtcore import (  # noqa: E402
+    QBuffer,
+    QCoreApplication,
+    QIODevice,
+)
+from tortoisehg.hgqt import cmdcore  # noqa: E402
+from tortoisehg.util import hglib  # noqa: E402
+
+# extension providing the command which writes the output stream
+_EXTENSION = b'''\
+from mercurial import registrar
+cmdtable = {}
+command = registrar.command(cmdtable)
+@command(b'perfwrite', [], b'SIZE BLOCK', norepo=True)
+def perfwrite(ui, size, block):
+    data = b'x' * int(block)
+    for _i in range(int(size) // int(block)):
+        ui.write(data)
+'''
+
+
+def _loadui():
+    ui = hglib.loadui()
+    ui.setconfig(b'tortoisehg', b'cmdserver.readtimeout', 30, b'perf')
+    ui.setconfig(b'tortoisehg', b'cmdserver.readworkers', 0, b'perf')
+    ui.setconfig(b'tortoisehg', b'cmdserver.idletimeout', 0, b'perf')
+    return ui
+
+
+def _report(nbytes, elapsed):
+    print('%d MiB: %.2f sec (%.1f MiB/sec)'
+          % (nbytes >> 20, elapsed, nbytes / 1048576.0 / elapsed))
+
+
+def perfparse(opts):
+    """measure time to split and dispatch synthetic output"""
+    size = opts.size << 20
+    msg = struct.pack('>cI', b'o', opts.block) + b'x' * opts.block
+    stream = msg * (size // opts.block)
+    chunks = [stream[i:i + opts.chunk]
+              for i in range(0, len(stream), opts.chunk)]
+    del stream
+
+    server = cmdcore.CmdServer(_loadui())
+    uihandler = cmdcore.UiHandler()
+    out = QBuffer()
+    out.open(QIODevice.WriteOnly)
+    uihandler.setDataOutputDevice(out)
+    server._uihandler = uihandler
+    server._readchtable = server._runcommandchtable
+    start = time.time()
+    for data in chunks:
+        server._reader.feed(data)
+        server._dispatchRead()
+    elapsed = time.time() - start
+    assert out.size() == size // opts.block * opts.block, out.size()
+    _report(out.size(), elapsed)
+
+
+def perfstream(opts):
+    """measure throughput of output of command server"""
+    app = QCoreApplication(sys.argv)
+    tmpdir = tempfile.mkdtemp(prefix='thg-perfcmdserver.')
+    try:
+        extpath = os.path.join(tmpdir, 'perfwrite.py')
+        with open(extpath, 'wb') as f:
+            f.write(_EXTENSION)
+        ui = _loadui()
+        ui.setconfig(b'extensions', b'perfwrite', hglib.fromunicode(extpath),
+                     b'--config')
+        agent = cmdcore.CmdAgent(ui, cwd=tmpdir)
+        agent.serviceStopped.connect(app.quit)
+
+        def run(size):
+            sess = agent.runCommand(['perfwrite', str(size), str(opts.block)])
+            sess.setCaptureOutput(True)
+            sess.commandFinished.connect(app.quit)
+            app.exec_()
+            if sess.exitCode() != 0:
+                raise RuntimeError(sess.errorString())
+            return sess
+
+        run(0)  # wait for the server to start
+        start = time.time()
+        sess = run(opts.size << 20)
+        elapsed = time.time() - start
+        nbytes = len(sess.readAll())
+        _report(nbytes, elapsed)
+        agent.stopService()
+        app.exec_()
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    sub = parser.add_subparsers(dest='command')
+    p = sub.add_parser('parse', help=perfparse.__doc__)
+    p.add_argument('--size', type=int, default=100, help='MiB to output')
+    p.add_argument('--block', type=int, default=64,
+                   help='bytes per message')
+    p.add_argument('--chunk', type=int, default=65536,
+                   help='bytes per read from pipe')
+    p.set_defaults(func=perfparse)
+    p = sub.add_parser('stream', help=perfstream.__doc__)
+    p.add_argument('--size', type=int, default=100, help='MiB to output')
+    p.add_argument('--block', type=int, default=4096,
+                   help='bytes per ui.write() call')
+    p.set_defaults(func=perfstream)
+    opts = parser.parse_args()
+    if not getattr(opts, 'func', None):
+        parser.print_help()
+        return 1
+    opts.func(opts)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
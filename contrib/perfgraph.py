@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+# perfgraph.py - benchmarks of revision graph layout
+#
+# This software may be used and distributed according to the terms of the
+# GNU General Public License version 2 or any later version.
+
+"""benchmarks of revision graph layout on synthetic DAG
+
+Run from the top of the source tree with Mercurial importable:
+
+  $ python contrib/perfgraph.py memory --revs 500000
+  $ python contrib/perfgraph.py width --revs 20000 --widths 10,100,1000
+"""
+
+from __future__ import absolute_import, print_function
+
+import argparse
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from tortoisehg.hgqt import graph  # noqa: E402
+
+
+def syntheticdag(nrevs, width, seed=0):
+    """Build parents of a DAG having about `width` open branches"""
+    rnd = random.Random(seed)
+    parents = []
+    heads = []
+    for rev in range(nrevs):
+        if not heads or (len(heads) < width and rnd.random() < 0.3):
+            p1 = rnd.randrange(rev) if rev else -1  # fork new branch
+        else:
+            p1 = heads.pop(rnd.randrange(len(heads)))
+        p2 = -1
+        if len(heads) >= width and rnd.random() < 0.5:
+            p2 = heads.pop(rnd.randrange(len(heads)))  # merge branch
+        parents.append((p1, p2))
+        heads.append(rev)
+    return parents
+
+
+def iterrows(parents):
+    revs = [None] + list(range(len(parents) - 1, -1, -1))
+    wdparents = [len(parents) - 1]
+    return graph.iterlayout(parents.__getitem__, revs, wdparents)
+
+
+class _FakeCtx(object):
+    """Just enough changectx to instantiate GraphNode"""
+
+    def __init__(self, rev):
+        self._rev = rev
+
+    def rev(self):
+        return self._rev
+
+    def hidden(self):
+        return False
+
+    def obsolete(self):
+        return False
+
+    def instabilities(self):
+        return []
+
+
+def _buildnodes(parents):
+    nodes = []
+    for rev, x, lines in iterrows(parents):
+        gnode = graph.GraphNode(graph.NODE_SHAPE_REVISION, _FakeCtx(rev), x,
+                                lines)
+        if nodes:
+            gnode.toplines = nodes[-1].bottomlines
+        nodes.append(gnode)
+    return nodes
+
+
+def _buildcompact(parents):
+    rows = graph.CompactGraphRows()
+    for rev, x, lines in iterrows(parents):
+        rows.append(rev, x, lines)
+        rows.setshape(len(rows) - 1, graph.NODE_SHAPE_REVISION)
+    return rows
+
+
+def _measure(func, *args):
+    tracemalloc.start()
+    start = time.time()
+    obj = func(*args)
+    elapsed = time.time() - start
+    size, _peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return obj, size, elapsed
+
+
+def perfmemory(opts):
+    """compare memory usage of GraphNode list and CompactGraphRows"""
+    parents = syntheticdag(opts.revs, opts.width)
+    results = []
+    for name, func in [('GraphNode list', _buildnodes),
+                       ('CompactGraphRows', _buildcompact)]:
+        obj, size, elapsed = _measure(func, parents)
+        results.append(size)
+        print('%-18s %8d rows %10.1f MiB %8.2f sec'
+              % (name, len(obj), size / 1048576.0, elapsed))
+        del obj
+    print('ratio: %.1fx' % (float(results[0]) / max(results[1], 1)))
+
+
+def perfwidth(opts):
+    """measure layout cost per row and per edge for wide DAGs"""
+    print('%6s %10s %10s %12s %12s'
+          % ('width', 'rows', 'edges/row', 'usec/row', 'usec/edge'))
+    for width in opts.widths:
+        parents = syntheticdag(opts.revs, width)
+        nrows = nedges = 0
+        start = time.time()
+        for _rev, _x, lines in iterrows(parents):
+            nrows += 1
+            nedges += len(lines)
+        elapsed = time.time() - start
+        print('%6d %10d %10.1f %12.2f %12.3f'
+              % (width, nrows, float(nedges) / nrows, elapsed * 1e6 / nrows,
+                 elapsed * 1e6 / max(nedges, 1)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    sub = parser.add_subparsers(dest='command')
+    p = sub.add_parser('memory', help=perfmemory.__doc__)
+    p.add_argument('--revs', type=int, default=100000)
+    p.add_argument('--width', type=int, default=10)
+    p.set_defaults(func=perfmemory)
+    p = sub.add_parser('width', help=perfwidth.__doc__)
+    p.add_argument('--revs', type=int, default=20000)
+    p.add_argument('--widths', default='10,100,1000',
+                   type=lambda s: [int(w) for w in s.split(',')])
+    p.set_defaults(func=perfwidth)
+    opts = parser.parse_args()
+    if not getattr(opts, 'func', None):
+        parser.print_help()
+        return 1
+    opts.func(opts)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
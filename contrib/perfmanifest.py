@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# perfmanifest.py - benchmarks of manifest tree model
+#
+# This software may be used and distributed according to the terms of the
+# GNU General Public License version 2 or any later version.
+
+"""benchmarks of manifest tree on synthetic manifest
+
+Run from the top of the source tree with Mercurial and PyQt importable:
+
+  $ python contrib/perfmanifest.py build --paths 1000000
+  $ python contrib/perfmanifest.py lookup --paths 1000000
+"""
+
+from __future__ import absolute_import, print_function
+
+import argparse
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from tortoisehg.hgqt import manifestmodel  # noqa: E402
+
+
+def syntheticpaths(npaths, fanout, seed=0):
+    """Generate file paths of a tree having about `fanout` entries per
+    directory, with file names repeated across directories"""
+    rnd = random.Random(seed)
+    basenames = ['%s%d.%s' % (stem, i, ext)
+                 for stem in ('file', 'test_', 'index', 'util')
+                 for i in range(fanout // 4 + 1)
+                 for ext in ('py', 'c')]
+    dirs = ['']
+    paths = set()
+    while len(paths) < npaths:
+        parent = dirs[rnd.randrange(len(dirs))]
+        if rnd.random() < 1.0 / fanout:
+            d = parent + 'dir%d/' % len(dirs)
+            dirs.append(d)
+            continue
+        paths.add(parent + basenames[rnd.randrange(len(basenames))])
+    return sorted(paths)
+
+
+def _buildtree(paths):
+    roote = manifestmodel._RepoEntry()
+    makepath = manifestmodel._treenodeop.makepath
+    for path in paths:
+        e = makepath(roote, path)
+        e.status = 'C'
+    roote.sort()
+    return roote
+
+
+def _measure(func, *args):
+    tracemalloc.start()
+    start = time.time()
+    obj = func(*args)
+    elapsed = time.time() - start
+    size, _peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return obj, size, elapsed
+
+
+def perfbuild(opts):
+    """measure memory usage and time to build and sort the tree"""
+    paths = syntheticpaths(opts.paths, opts.fanout)
+    roote, size, elapsed = _measure(_buildtree, paths)
+    print('%d paths: %.1f MiB (%.0f bytes/path), %.2f sec'
+          % (len(paths), size / 1048576.0, float(size) / len(paths),
+             elapsed))
+    start = time.time()
+    roote.sort()
+    print('resort: %.2f sec' % (time.time() - start))
+
+
+def perflookup(opts):
+    """measure time to look up rows and paths of random entries"""
+    paths = syntheticpaths(opts.paths, opts.fanout)
+    roote = _buildtree(paths)
+    findpath = manifestmodel._treenodeop.findpath
+    rnd = random.Random(1)
+    samples = [paths[rnd.randrange(len(paths))] for _i in range(opts.samples)]
+    start = time.time()
+    for path in samples:
+        e = findpath(roote, path)
+        e.parent.index(e.name)  # as ManifestModel.indexFromPath()
+    elapsed = time.time() - start
+    print('path -> row: %8.2f usec' % (elapsed * 1e6 / len(samples)))
+    entries = [findpath(roote, p) for p in samples]
+    start = time.time()
+    for e in entries:
+        e.path  # as ManifestModel.filePath()
+    elapsed = time.time() - start
+    print('entry -> path: %8.2f usec' % (elapsed * 1e6 / len(samples)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    sub = parser.add_subparsers(dest='command')
+    p = sub.add_parser('build', help=perfbuild.__doc__)
+    p.add_argument('--paths', type=int, default=1000000)
+    p.add_argument('--fanout', type=int, default=30)
+    p.set_defaults(func=perfbuild)
+    p = sub.add_parser('lookup', help=perflookup.__doc__)
+    p.add_argument('--paths', type=int, default=1000000)
+    p.add_argument('--fanout', type=int, default=30)
+    p.add_argument('--samples', type=int, default=100000)
+    p.set_defaults(func=perflookup)
+    opts = parser.parse_args()
+    if not getattr(opts, 'func', None):
+        parser.print_help()
+        return 1
+    opts.func(opts)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
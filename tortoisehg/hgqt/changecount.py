@@ -0,0 +1,193 @@
+# changecount.py - count files changed by revisions in background
+#
+# This software may be used and distributed according to the terms of the
+# GNU General Public License version 2 or any later version.
+
+"""count files changed by revisions in background
+
+The "Changes" column of the revision log shows the number of modified,
+added and removed files of each revision, which requires a manifest diff
+per revision.  ChangeCounter computes them in a worker thread for the rows
+around the ones requested, and keeps the counts of recently displayed
+revisions.  Since revisions are immutable, the counts are looked up by node
+and survive reloads of the model.
+"""
+
+from __future__ import absolute_import
+
+import time
+
+from .qtcore import (
+    QObject,
+    QThread,
+    pyqtSignal,
+    pyqtSlot,
+)
+
+from mercurial import (
+    error,
+    hg,
+    util,
+)
+
+from . import (
+    qtlib,
+)
+
+# number of revisions of which counts are kept
+_CACHESIZE = 10000
+
+# maximum number of revisions processed by one worker thread
+_BATCHSIZE = 50
+
+# number of queued revisions; older requests are likely scrolled out of view
+_MAXPENDING = 500
+
+# time slice to collect counts before they are sent to the model
+_BLOCK_INTERVAL = 0.05
+
+
+class ChangeCountThread(QThread):
+    """Count modified, added and removed files of revisions"""
+
+    # emitted with [(rev, node, (modified, added, removed)), ...]
+    countsComputed = pyqtSignal(object)
+
+    def __init__(self, repo, revnodes):
+        super(ChangeCountThread, self).__init__()
+        self._repo = repo
+        self._revnodes = revnodes
+        self._canceled = False
+
+    def cancel(self):
+        self._canceled = True
+
+    def run(self):
+        repo = self._repo
+        results = []
+        refreshed = False
+        deadline = time.time() + _BLOCK_INTERVAL
+        for rev, node in self._revnodes:
+            if self._canceled:
+                return
+            try:
+                status = self._status(repo, node)
+            except (error.LookupError, error.RepoLookupError):
+                if refreshed:
+                    continue  # stripped meanwhile
+                # revision may be added since the repository was loaded
+                repo.invalidate()
+                refreshed = True
+                try:
+                    status = self._status(repo, node)
+                except (error.LookupError, error.RepoLookupError):
+                    continue
+            results.append((rev, node, (len(status.modified),
+                                        len(status.added),
+                                        len(status.removed))))
+            if time.time() >= deadline:
+                self.countsComputed.emit(results)
+                results = []
+                deadline = time.time() + _BLOCK_INTERVAL
+        if results:
+            self.countsComputed.emit(results)
+
+    @staticmethod
+    def _status(repo, node):
+        ctx = repo[node]
+        return repo.status(ctx.p1().node(), node)
+
+
+class ChangeCounter(QObject):
+    """Cache of file change counts filled by ChangeCountThread"""
+
+    # emitted with [(rev, node), ...] of which counts are newly available
+    countsChanged = pyqtSignal(object)
+
+    def __init__(self, repoagent, parent=None):
+        super(ChangeCounter, self).__init__(parent)
+        self._repoagent = repoagent
+        self._repo = None  # used by one worker thread at a time
+        self._counts = util.lrucachedict(_CACHESIZE)
+        self._pending = []  # [(rev, node), ...] in request order
+        self._queued = set()  # nodes in _pending or being counted
+        self._thread = None
+        self._batch = []  # [(rev, node), ...] being counted
+
+    def get(self, node):
+        """(modified, added, removed) counts or None if not known yet"""
+        return self._counts.get(node)
+
+    def request(self, revnodes):
+        """Queue revisions to be counted in background
+
+        The revisions requested last are counted first.  Revisions already
+        queued are moved to the end of the queue.
+        """
+        revnodes = [(rev, node) for rev, node in revnodes
+                    if node not in self._counts]
+        requeued = set(node for _rev, node in revnodes
+                       if node in self._queued)
+        if requeued:
+            self._pending = [(rev, node) for rev, node in self._pending
+                             if node not in requeued]
+        counting = set(node for _rev, node in self._batch)
+        for rev, node in revnodes:
+            if node in counting:
+                continue
+            self._pending.append((rev, node))
+            self._queued.add(node)
+        if len(self._pending) > _MAXPENDING:
+            self._queued.difference_update(
+                node for _rev, node in self._pending[:-_MAXPENDING])
+            del self._pending[:-_MAXPENDING]
+        self._startThread()
+
+    def cancel(self):
+        """Discard queued revisions and stop the running worker"""
+        del self._pending[:]
+        self._queued.clear()
+        self._batch = []
+        if self._thread:
+            self._thread.cancel()
+            self._thread = None
+            self._repo = None  # may still be used by the canceled thread
+
+    def _startThread(self):
+        if self._thread or not self._pending:
+            return
+        # most recently requested rows are likely to be displayed
+        revnodes = self._pending[-_BATCHSIZE:]
+        revnodes.reverse()
+        del self._pending[-_BATCHSIZE:]
+        self._batch = revnodes
+        if self._repo is None:
+            # own repository instance to not share revlog state with GUI
+            # thread
+            repo = self._repoagent.rawRepo()
+            self._repo = hg.repository(repo.ui, repo.root).unfiltered()
+        self._thread = th = ChangeCountThread(self._repo, revnodes)
+        th.countsComputed.connect(self._onCountsComputed)
+        th.finished.connect(self._onThreadFinished)
+        qtlib.startKeptThread(th)
+
+    @pyqtSlot(object)
+    def _onCountsComputed(self, results):
+        if self.sender() is not self._thread:
+            return  # canceled
+        revnodes = []
+        for rev, node, counts in results:
+            self._counts[node] = counts
+            self._queued.discard(node)
+            revnodes.append((rev, node))
+        self.countsChanged.emit(revnodes)
+
+    @pyqtSlot()
+    def _onThreadFinished(self):
+        if self.sender() is not self._thread:
+            return
+        self._thread = None
+        # forget revisions which couldn't be counted
+        self._queued.difference_update(node for _rev, node in self._batch)
+        self._batch = []
+        self._startThread()
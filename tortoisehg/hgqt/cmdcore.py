@@ -7,6 +7,7 @@
 
 from __future__ import absolute_import
 
+import collections
 import os
 import signal
 import struct
@@ -339,6 +340,122 @@ class CmdProc(CmdWorker):
                     hglib.tounicode(label or defaultlabel))
 
 
+def _tobytes(data):
+    # type: (Union[bytes, bytearray, memoryview]) -> bytes
+    if isinstance(data, memoryview):
+        return data.tobytes()
+    return bytes(data)
+
+def _islabeled(data):
+    # type: (Union[bytes, bytearray, memoryview]) -> bool
+    return data[:1] == b'\1'
+
+def _joinPlainOutput(data, readq):
+    # type: (Union[bytearray, memoryview], collections.deque) -> Union[bytearray, memoryview]
+    """Concatenate the data with the following unlabeled outputs in readq
+    so that they can be written at once"""
+    if not readq or readq[0][0] != b'o' or _islabeled(readq[0][1]):
+        return data
+    buf = bytearray(data)
+    while readq and readq[0][0] == b'o' and not _islabeled(readq[0][1]):
+        buf += readq.popleft()[1]
+    return buf
+
+_CHANNEL_HEADER = struct.Struct('>cI')
+
+class _ChannelReader(object):
+    r"""Split data read from the command server into channel messages
+
+    Complete messages are queued as (ch, data) without copying the payload,
+    where data is a memoryview of the fed chunk.  A payload split across
+    chunks is collected into a bytearray.  Input channels are queued as
+    (ch, size).
+
+    >>> r = _ChannelReader()
+    >>> r.feed(b'o\0\0\0\3fooe\0\0\0\1xI\0\0\0\5r\0')
+    >>> [(ch, _tobytes(d) if ch != b'I' else d) for ch, d in r.messages]
+    [(b'o', b'foo'), (b'e', b'x'), (b'I', 5)]
+    >>> r.messages.clear()
+    >>> r.hasPendingData(), r.peekPending(3)
+    (True, b'r\x00')
+    >>> r.feed(b'\0\0\6ab')
+    >>> r.feed(b'cd')
+    >>> r.messages
+    deque([])
+    >>> r.feed(b'efr\0\0\0\0')
+    >>> [(ch, _tobytes(d)) for ch, d in r.messages]
+    [(b'r', b'abcdef'), (b'r', b'')]
+    >>> r.hasPendingData()
+    False
+    """
+
+    def __init__(self):
+        # type: () -> None
+        self.messages = collections.deque()  # (ch, data or datasize), ...
+        self._header = b''  # immature header
+        self._ch = b''
+        self._payload = None  # type: Optional[bytearray]
+        self._payloadsize = 0
+
+    def clear(self):
+        # type: () -> None
+        self.messages.clear()
+        self._header = b''
+        self._payload = None
+
+    def hasPendingData(self):
+        # type: () -> bool
+        """True if an immature message remains"""
+        return bool(self._header) or self._payload is not None
+
+    def peekPending(self, maxlen):
+        # type: (int) -> bytes
+        if self._payload is not None:
+            return bytes(self._payload[:maxlen])
+        return self._header[:maxlen]
+
+    def feed(self, data):
+        # type: (bytes) -> None
+        view = memoryview(data)
+        pos = 0
+        if self._payload is not None:
+            pos = self._payloadsize - len(self._payload)
+            self._payload += view[:pos]
+            if len(self._payload) < self._payloadsize:
+                return
+            self.messages.append((self._ch, self._payload))
+            self._payload = None
+        if self._header:
+            n = _CHANNEL_HEADER.size - len(self._header)
+            self._header += view[pos:pos + n].tobytes()
+            if len(self._header) < _CHANNEL_HEADER.size:
+                return
+            ch, size = _CHANNEL_HEADER.unpack(self._header)
+            self._header = b''
+            pos = self._takePayload(ch, size, view, pos + n)
+        end = len(view)
+        while end - pos >= _CHANNEL_HEADER.size:
+            ch, size = _CHANNEL_HEADER.unpack_from(data, pos)
+            pos = self._takePayload(ch, size, view, pos + _CHANNEL_HEADER.size)
+        if pos < end:
+            self._header = view[pos:].tobytes()
+
+    def _takePayload(self, ch, size, view, pos):
+        # type: (bytes, int, memoryview, int) -> int
+        if ch in b'IL':
+            # input channel has no data
+            self.messages.append((ch, size))
+            return pos
+        end = pos + size
+        if end <= len(view):
+            self.messages.append((ch, view[pos:end]))
+            return end
+        self._ch = ch
+        self._payload = bytearray(view[pos:])
+        self._payloadsize = size
+        return len(view)
+
+
 class CmdServer(CmdWorker):
     """Run Mercurial commands in command server process"""
 
@@ -348,7 +465,7 @@ class CmdServer(CmdWorker):
         self._ui = ui
         self._uihandler = UiHandler()
         self._readchtable = self._idlechtable
-        self._readq = []  # (ch, data or datasize), ...
+        self._reader = _ChannelReader()
         # deadline for arrival of hello message and immature data
         sec = ui.configint(b'tortoisehg', b'cmdserver.readtimeout')
         self._readtimer = QTimer(self, interval=sec * 1000, singleShot=True)
@@ -427,7 +544,7 @@ class CmdServer(CmdWorker):
     def _onServiceFinished(self):
         self._uihandler = UiHandler()
         self._readchtable = self._idlechtable
-        del self._readq[:]
+        self._reader.clear()
         self._readtimer.stop()
         if self._servicestate == CmdWorker.Restarting:
             self._startService()
@@ -473,39 +590,23 @@ class CmdServer(CmdWorker):
 
     @pyqtSlot()
     def _onReadyRead(self):
-        proc = self._proc
-        headersize = 5
+        reader = self._reader
         try:
-            while True:
-                header = proc.peek(headersize).data()
-                if not header:
-                    self._readtimer.stop()
-                    break
-                if len(header) < headersize:
-                    self._readtimer.start()
-                    break
-                ch, datasize = struct.unpack('>cI', header)
-                if ch in b'IL':
-                    # input channel has no data
-                    proc.read(headersize)
-                    self._readq.append((ch, datasize))
-                    continue
-                if proc.bytesAvailable() < headersize + datasize:
-                    self._readtimer.start()
-                    break
-                proc.read(headersize)
-                data = proc.read(datasize)
-                self._readq.append((ch, data))
-
-            # don't do much things in readyRead slot for simplicity
-            QTimer.singleShot(0, self._dispatchRead)
+            reader.feed(self._proc.readAll().data())
+            if reader.hasPendingData():
+                self._readtimer.start()
+            else:
+                self._readtimer.stop()
+            if reader.messages:
+                # don't do much things in readyRead slot for simplicity
+                QTimer.singleShot(0, self._dispatchRead)
         except Exception:
             self.stopService()
             raise
 
     @pyqtSlot()
     def _onReadTimeout(self):
-        startbytes = self._proc.peek(20).data()
+        startbytes = self._reader.peekPending(20)
         if startbytes:
             # data corruption because bad extension might write to stdout?
             self._emitError(_('timed out while reading: %r...') % startbytes)
@@ -515,9 +616,10 @@ class CmdServer(CmdWorker):
 
     @pyqtSlot()
     def _dispatchRead(self):
+        readq = self._reader.messages
         try:
-            while self._readq:
-                ch, dataorsize = self._readq.pop(0)
+            while readq:
+                ch, dataorsize = readq.popleft()
                 try:
                     chfunc = self._readchtable[ch]
                 except KeyError:
@@ -525,6 +627,8 @@ class CmdServer(CmdWorker):
                         continue
                     raise _ProtocolError(_('unexpected response on required '
                                            'channel %r') % ch)
+                if ch == b'o' and not _islabeled(dataorsize):
+                    dataorsize = _joinPlainOutput(dataorsize, readq)
                 chfunc(self, ch, dataorsize)
         except _ProtocolError as inst:
             self._emitError(inst.args[0])
@@ -543,6 +647,7 @@ class CmdServer(CmdWorker):
                 hglib.tounicode(label) or 'ui.error')
 
     def _processHello(self, _ch, data):
+        data = _tobytes(data)
         try:
             fields = dict(l.split(b':', 1) for l in data.splitlines())
             capabilities = fields[b'capabilities'].split()
@@ -554,7 +659,15 @@ class CmdServer(CmdWorker):
         self._changeServiceState(CmdWorker.Ready)
 
     def _processOutput(self, ch, data):
-        msg, label = pipeui.unpackmsg(data)
+        if not _islabeled(data):
+            # fast path for data output
+            if isinstance(data, memoryview):
+                data = data.tobytes()
+            if ch == b'o' and self._uihandler.writeOutput(data, b'') >= 0:
+                return
+            self.outputReceived.emit(hglib.tounicode(data), '')
+            return
+        msg, label = pipeui.unpackmsg(_tobytes(data))
         if ch == b'o' and self._uihandler.writeOutput(msg, label) >= 0:
             return
         labelset = label.split()
@@ -577,6 +690,7 @@ class CmdServer(CmdWorker):
                 hglib.tounicode(label))
 
     def _processCommandResult(self, _ch, data):
+        data = _tobytes(data)
         try:
             ret, = struct.unpack('>i', data)
         except struct.error:
@@ -866,8 +980,78 @@ def nullCmdSession():
     return CmdSession([], UiHandler())
 
 
+# commands which don't modify the repository, and can run in parallel with
+# the other commands
+_readonlycommands = frozenset([
+    'annotate',
+    'blame',
+    'cat',
+    'diff',
+    'files',
+    'grep',
+    'heads',
+    'id',
+    'identify',
+    'locate',
+    'log',
+    'manifest',
+    'parents',
+    'status',
+    'summary',
+    'tip',
+])
+
+# global options taking a value, which may precede the command name
+_globaloptswithvalue = frozenset([
+    '-R',
+    '--color',
+    '--config',
+    '--cwd',
+    '--encoding',
+    '--encodingmode',
+    '--pager',
+    '--repository',
+])
+
+def _isWorkerStopped(worker):
+    # type: (CmdWorker) -> bool
+    return worker.serviceState() in (CmdWorker.NoService, CmdWorker.NotRunning)
+
+def _isReadOnlyCommand(cmdline):
+    # type: (List[Text]) -> bool
+    """True if the command line runs one of the known read-only commands
+
+    >>> _isReadOnlyCommand(['log', '-r', 'tip'])
+    True
+    >>> _isReadOnlyCommand(['-R', 'foo', '--hidden', 'annotate', 'bar'])
+    True
+    >>> _isReadOnlyCommand(['--config', 'ui.foo=bar', 'pull'])
+    False
+    >>> _isReadOnlyCommand(['--hidden'])
+    False
+    """
+    args = iter(cmdline)
+    for a in args:
+        if a in _globaloptswithvalue:
+            next(args, None)
+        elif not a.startswith('-'):
+            return a in _readonlycommands
+    return False
+
+
 class CmdAgent(QObject):
-    """Manage requests of Mercurial commands"""
+    """Manage requests of Mercurial commands
+
+    Commands are run one after another by the main worker, except for the
+    known read-only commands, which may run in parallel with the others.  A
+    read-only command is run by the main worker if no other command is
+    waiting for it, or by one of the extra read workers (up to
+    tortoisehg.cmdserver.readworkers) otherwise.  Commands are started in
+    order of requests, so a read-only command may overtake the running
+    commands, but not the waiting ones.  A read worker is started only when
+    a read-only command would otherwise wait, and is shut down after idle
+    for tortoisehg.cmdserver.idletimeout seconds.
+    """
 
     serviceStopped = pyqtSignal()
     busyChanged = pyqtSignal(bool)
@@ -879,6 +1063,8 @@ class CmdAgent(QObject):
     #
     # Inactive session is not started by the agent, so agent.commandFinished
     # won't be emitted when waiting session is aborted.
+    #
+    # Read-only sessions may finish before the preceding sessions.
     commandFinished = pyqtSignal(CmdSession)
     outputReceived = pyqtSignal(str, str)
     progressReceived = pyqtSignal(ProgressMessage)
@@ -890,21 +1076,36 @@ class CmdAgent(QObject):
         # type: (uimod.ui, Optional[QObject], Optional[Text], Optional[Text]) -> None
         super(CmdAgent, self).__init__(parent)
         self._ui = ui
-        self._worker = self._createWorker(cwd, worker or 'server')
-        self._sessqueue = []  # [active, waiting...]
+        self._cwd = cwd
+        self._workertype = worker or 'server'
+        self._worker = self._createWorker(cwd, self._workertype)
+        self._readworkers = []  # type: List[CmdWorker]
+        self._maxreadworkers = ui.configint(b'tortoisehg',
+                                            b'cmdserver.readworkers')
+        self._idletimeout = ui.configint(b'tortoisehg',
+                                         b'cmdserver.idletimeout')
+        self._idlesince = {}  # type: Dict[CmdWorker, float]
+        self._sessqueue = []  # [(waiting, readonly), ...]
+        self._activesess = {}  # type: Dict[CmdWorker, CmdSession]
         self._runlater = QTimer(self, interval=0, singleShot=True)
-        self._runlater.timeout.connect(self._runNextSession)
+        self._runlater.timeout.connect(self._runNextSessions)
+        self._reaptimer = QTimer(self, singleShot=True)
+        self._reaptimer.timeout.connect(self._reapIdleWorkers)
+
+    def _workers(self):
+        # type: () -> List[CmdWorker]
+        return [self._worker] + self._readworkers
 
     def isServiceRunning(self):
         # type: () -> bool
-        stoppedstates = (CmdWorker.NoService, CmdWorker.NotRunning)
-        return self._worker.serviceState() not in stoppedstates
+        return not all(_isWorkerStopped(w) for w in self._workers())
 
     def stopService(self):
         # type: () -> None
         """Shut down back-end services so that this can be deleted safely or
         reconfigured; serviceStopped will be emitted asynchronously"""
-        self._worker.stopService()
+        for worker in self._workers():
+            worker.stopService()
 
     @pyqtSlot()
     def _tryEmitServiceStopped(self):
@@ -913,30 +1114,37 @@ class CmdAgent(QObject):
 
     def isBusy(self):
         # type: () -> bool
-        return bool(self._sessqueue)
+        return bool(self._sessqueue or self._activesess)
 
-    def _enqueueSession(self, sess):
-        self._sessqueue.append(sess)
-        if len(self._sessqueue) == 1:
+    def _enqueueSession(self, sess, readonly):
+        wasbusy = self.isBusy()
+        self._sessqueue.append((sess, readonly))
+        if not wasbusy:
             self.busyChanged.emit(self.isBusy())
-            # make sure no command signals emitted in the current context
-            self._runlater.start()
-
-    def _dequeueSession(self):
-        del self._sessqueue[0]
+        # make sure no command signals emitted in the current context
+        self._runlater.start()
+
+    def _dequeueSession(self, worker):
+        del self._activesess[worker]
+        if worker is not self._worker:
+            self._idlesince[worker] = time.time()
+            self._scheduleReaping()
         if self._sessqueue:
             # make sure client can receive commandFinished before next session
             self._runlater.start()
-        else:
+        elif not self._activesess:
             self._runlater.stop()
             self.busyChanged.emit(self.isBusy())
 
     def _cleanupWaitingSession(self):
-        for i in reversed(pycompat.xrange(1, len(self._sessqueue))):
-            sess = self._sessqueue[i]
+        for item in self._sessqueue[:]:
+            sess = item[0]
             if sess.isFinished():
-                del self._sessqueue[i]
+                self._sessqueue.remove(item)
                 sess.setParent(None)
+        if not self.isBusy():
+            self._runlater.stop()
+            self.busyChanged.emit(self.isBusy())
 
     def runCommand(self, cmdline, uihandler=None):
         # type: (List[Text], Optional[Union[QWidget, UiHandler]]) -> CmdSession
@@ -963,20 +1171,27 @@ class CmdAgent(QObject):
 
         If one of the preceding command exits with non-zero status, the
         following commands won't be executed.
+
+        If all commands are read-only, they may run in parallel with the
+        other sessions.
         """
         if not isinstance(uihandler, UiHandler):
             uihandler = _createDefaultUiHandler(uihandler)
         sess = CmdSession(cmdlines, uihandler, self)
         sess.commandFinished.connect(self._onCommandFinished)
         sess.controlMessage.connect(self._forwardControlMessage)
-        self._enqueueSession(sess)
+        readonly = bool(cmdlines) and all(_isReadOnlyCommand(l)
+                                          for l in cmdlines)
+        self._enqueueSession(sess, readonly)
         return sess
 
     def abortCommands(self):
         # type: () -> None
         """Abort running and queued commands; all command sessions will emit
         commandFinished"""
-        for sess in self._sessqueue[:]:
+        sessions = list(self._activesess.values())
+        sessions.extend(sess for sess, _readonly in self._sessqueue)
+        for sess in sessions:
             sess.abort()
 
     def _createWorker(self, cwd, name):
@@ -988,26 +1203,87 @@ class CmdAgent(QObject):
         worker.progressReceived.connect(self.progressReceived)
         return worker
 
+    def _addReadWorker(self):
+        # type: () -> CmdWorker
+        worker = self._createWorker(self._cwd, self._workertype)
+        self._readworkers.append(worker)
+        return worker
+
+    def _findIdleWorker(self, readonly):
+        # type: (bool) -> Optional[CmdWorker]
+        mainidle = self._worker not in self._activesess
+        if not readonly:
+            return self._worker if mainidle else None
+        if mainidle and all(ro for _sess, ro in self._sessqueue):
+            return self._worker
+        for worker in self._readworkers:
+            if worker not in self._activesess:
+                return worker
+        if len(self._readworkers) < self._maxreadworkers:
+            return self._addReadWorker()
+        return None
+
     @pyqtSlot()
-    def _runNextSession(self):
-        sess = self._sessqueue[0]
-        worker = self._worker
-        assert not worker.isCommandRunning()
-        sess.run(worker)
-        # start after connected to sess so that it can receive immediate error
-        worker.startService()
+    def _runNextSessions(self):
+        for item in self._sessqueue[:]:
+            sess, readonly = item
+            worker = self._findIdleWorker(readonly)
+            if not worker:
+                break  # the following sessions mustn't overtake this
+            self._sessqueue.remove(item)
+            self._activesess[worker] = sess
+            self._idlesince.pop(worker, None)
+            assert not worker.isCommandRunning()
+            sess.run(worker)
+            # start after connected to sess so that it can receive immediate
+            # error
+            worker.startService()
 
     @pyqtSlot()
     def _onCommandFinished(self):
-        sess = self._sessqueue[0]
-        if not sess.isFinished():
+        for worker, sess in list(self._activesess.items()):
+            if sess.isFinished():
+                break
+        else:
             # waiting session is aborted, just delete it
             self._cleanupWaitingSession()
             return
-        self._dequeueSession()
+        self._dequeueSession(worker)
         self.commandFinished.emit(sess)
         sess.setParent(None)
 
+    def _scheduleReaping(self):
+        if (self._reaptimer.isActive() or not self._idlesince
+            or self._idletimeout <= 0):
+            return
+        deadline = min(self._idlesince.values()) + self._idletimeout
+        msec = int((deadline - time.time()) * 1000)
+        self._reaptimer.start(max(msec, 0))
+
+    @pyqtSlot()
+    def _reapIdleWorkers(self):
+        now = time.time()
+        for worker, since in list(self._idlesince.items()):
+            if now - since < self._idletimeout:
+                continue
+            self._ui.debug(b'shutting down idle cmdworker\n')
+            del self._idlesince[worker]
+            self._readworkers.remove(worker)
+            worker.serviceStateChanged.disconnect(self._tryEmitServiceStopped)
+            if _isWorkerStopped(worker):
+                worker.deleteLater()
+                continue
+            worker.serviceStateChanged.connect(self._deleteReapedWorker)
+            worker.stopService()
+        self._scheduleReaping()
+
+    @pyqtSlot()
+    def _deleteReapedWorker(self):
+        worker = self.sender()
+        if _isWorkerStopped(worker):
+            worker.serviceStateChanged.disconnect(self._deleteReapedWorker)
+            worker.deleteLater()
+
     @pyqtSlot(str)
     def _forwardControlMessage(self, msg):
         self.outputReceived.emit(msg + '\n', 'control')
@@ -0,0 +1,381 @@
+# fsmonitor.py - filesystem monitor shared by repository watchers
+#
+# This software may be used and distributed according to the terms of the
+# GNU General Public License version 2 or any later version.
+
+"""filesystem monitor shared by repository watchers
+
+A single inotify instance serves all repositories opened by RepoManager,
+so the number of inotify instances and watches doesn't grow with the number
+of open repositories.  Directories watched by more than one client (e.g.
+the one containing ~/.hgrc) are watched once.
+
+Events are not delivered immediately.  Changed paths are collected for the
+debounce window, and then passed to each client at once, so a burst of
+writes (e.g. by a command run from the terminal) results in a single check
+per repository.
+
+WorkingDirFeed watches all directories of a working copy through the
+monitor, and tracks the paths changed since the last status query of each
+subscriber, so the status can be refreshed by checking only these paths.
+"""
+
+from __future__ import absolute_import
+
+import errno
+import os
+import stat
+import time
+import weakref
+
+from .qtcore import (
+    QObject,
+    QSocketNotifier,
+    QTimer,
+    pyqtSlot,
+)
+
+from mercurial import (
+    util,
+)
+from mercurial.utils import (
+    stringutil,
+)
+
+from ..util import (
+    inotify,
+)
+
+# default time window (msec) in which changes are collected
+_DEFAULT_DEBOUNCE = 100
+
+# number of changed paths above which full status is considered cheaper
+_MAX_FEED_CHANGES = 10000
+
+# time slice (sec) to walk working directory in GUI thread
+_WALK_INTERVAL = 0.02
+
+
+def createMonitor(ui, parent=None):
+    """Create FileSystemMonitor if the platform supports it; otherwise None"""
+    if not inotify.available():
+        return None
+    try:
+        return FileSystemMonitor(ui, parent)
+    except OSError as inst:
+        # e.g. fs.inotify.max_user_instances reached
+        ui.debug(b'cannot use inotify: %s\n' % stringutil.forcebytestr(inst))
+        return None
+
+
+class FileSystemMonitor(QObject):
+    """Watch directories for clients and dispatch changed paths to them
+
+    A client is an object having notifyPathsChanged(paths) method, which is
+    called with a set of changed paths, or None if events were lost and the
+    client should check everything.
+    """
+
+    def __init__(self, ui, parent=None):
+        super(FileSystemMonitor, self).__init__(parent)
+        self._ui = ui
+        self._watcher = inotify.Watcher()
+        self._notifier = QSocketNotifier(self._watcher.fileno(),
+                                         QSocketNotifier.Read, self)
+        self._notifier.activated.connect(self._onActivated)
+        self._wdpaths = {}  # wd: dir
+        self._dirwds = {}  # dir: wd
+        self._dirclients = {}  # dir: set(client)
+        self._clientdirs = {}  # client: set(dir)
+        self._pending = {}  # client: set(path) or None
+        self._timer = QTimer(self)
+        self._timer.setSingleShot(True)
+        self._timer.setInterval(ui.configint(b'tortoisehg', b'monitordebounce')
+                                or _DEFAULT_DEBOUNCE)
+        self._timer.timeout.connect(self._flushPending)
+
+    def close(self):
+        """Stop watching all directories and release the inotify instance"""
+        self._notifier.setEnabled(False)
+        self._timer.stop()
+        self._watcher.close()
+        self._wdpaths.clear()
+        self._dirwds.clear()
+        self._dirclients.clear()
+        self._clientdirs.clear()
+        self._pending.clear()
+
+    def isWatching(self, client, path):
+        return path in self._dirwds and path in self._clientdirs.get(client,
+                                                                     ())
+
+    def watchDirectory(self, client, path):
+        """Start watching the directory on behalf of the client if exists;
+        True if watched"""
+        if path not in self._dirwds:
+            try:
+                # IN_ATTRIB to catch changes of exec bit
+                wd = self._watcher.addwatch(path, inotify.IN_DIRCHANGES
+                                            | inotify.IN_ATTRIB
+                                            | inotify.IN_ONLYDIR)
+            except OSError:
+                return False
+            self._ui.debug(b'add directory to inotify: %s\n' % path)
+            self._wdpaths[wd] = path
+            self._dirwds[path] = wd
+        self._dirclients.setdefault(path, set()).add(client)
+        self._clientdirs.setdefault(client, set()).add(path)
+        return True
+
+    def unwatchDirectory(self, client, path):
+        """Stop watching the directory if no longer needed by any client"""
+        dirs = self._clientdirs.get(client)
+        if dirs is not None:
+            dirs.discard(path)
+        clients = self._dirclients.get(path)
+        if clients is None:
+            return
+        clients.discard(client)
+        if clients:
+            return
+        del self._dirclients[path]
+        wd = self._dirwds.pop(path, None)
+        if wd is None:
+            return
+        del self._wdpaths[wd]
+        try:
+            self._watcher.rmwatch(wd)
+        except OSError:
+            pass  # directory removed meanwhile
+
+    def unwatchAll(self, client):
+        """Stop watching the directories no longer needed by any client"""
+        self._pending.pop(client, None)
+        for path in self._clientdirs.pop(client, ()):
+            self.unwatchDirectory(client, path)
+
+    def watchCount(self):
+        """Number of directories watched by the inotify instance"""
+        return len(self._dirwds)
+
+    def flush(self, client):
+        """Deliver changes queued for the client now without waiting for the
+        debounce window"""
+        self._readEvents()
+        if client in self._pending and client in self._clientdirs:
+            client.notifyPathsChanged(self._pending.pop(client))
+
+    @pyqtSlot()
+    def _onActivated(self):
+        self._readEvents()
+        if self._pending and not self._timer.isActive():
+            self._timer.start()
+
+    def _readEvents(self):
+        pending = self._pending
+        for wd, mask, _cookie, name in self._watcher.read():
+            if mask & inotify.IN_Q_OVERFLOW:
+                for client in self._clientdirs:
+                    pending[client] = None
+                continue
+            path = self._wdpaths.get(wd)
+            if path is None:
+                continue  # already unwatched
+            if mask & inotify.IN_IGNORED:
+                # directory removed; clients will watch it again once
+                # recreated
+                del self._wdpaths[wd]
+                del self._dirwds[path]
+            changed = name and os.path.join(path, name) or path
+            for client in self._dirclients.get(path, ()):
+                if client not in pending:
+                    pending[client] = set()
+                if pending[client] is not None:
+                    pending[client].add(changed)
+
+    @pyqtSlot()
+    def _flushPending(self):
+        pending = self._pending
+        self._pending = {}
+        for client, paths in pending.items():
+            # client may be unwatched by previous client's handler
+            if client in self._clientdirs:
+                client.notifyPathsChanged(paths)
+
+
+class WorkingDirFeed(QObject):
+    """Track paths changed in working directory since the last query
+
+    Each subscriber (e.g. status widget) takes the changed paths by
+    takeChanges(), which also starts tracking new changes for the next query.
+    The directories are walked incrementally in the GUI thread, so every
+    directory is watched before it is listed, and no change can slip between
+    them.
+    """
+
+    def __init__(self, monitor, root, ui, parent=None):
+        super(WorkingDirFeed, self).__init__(parent)
+        self._monitor = monitor
+        self._root = root
+        self._ui = ui
+        self._dirs = set()  # watched directories relative to root
+        self._walkqueue = []  # directories (relative to root) to be walked
+        self._walktimer = QTimer(self)
+        self._walktimer.setInterval(0)
+        self._walktimer.timeout.connect(self._walkSome)
+        self._started = False
+        self._disabled = False
+        # subscriber: (files, dirs) changed since last query, or None if
+        # unknown
+        self._changes = weakref.WeakKeyDictionary()
+
+    def isReady(self):
+        """True if all directories are watched"""
+        return self._started and not self._walkqueue
+
+    def start(self):
+        if self._started or self._disabled:
+            return
+        self._ui.debug(b'start watching working directory: %s\n'
+                       % self._root)
+        self._started = True
+        self._walkqueue.append(b'')
+        self._walktimer.start()
+
+    def stop(self):
+        """Stop watching working directory and release watches"""
+        if not self._started:
+            return
+        self._walktimer.stop()
+        del self._walkqueue[:]
+        self._monitor.unwatchAll(self)
+        self._dirs.clear()
+        self._started = False
+        self._invalidateAll()
+
+    def takeChanges(self, subscriber):
+        """Paths changed since the last call by the subscriber as
+        (files, dirs) relative to root, or None if unknown
+
+        The subscriber should check the whole working directory if None is
+        returned.  The directories include removed or renamed ones.
+        """
+        self.start()
+        # changes made just before the query may still be in the debounce
+        # window
+        self._monitor.flush(self)
+        changes = self._changes.get(subscriber)
+        if self.isReady():
+            self._changes[subscriber] = (set(), set())
+        else:
+            self._changes[subscriber] = None
+        return changes
+
+    def invalidate(self, subscriber):
+        """Make the next takeChanges() return None, e.g. because the last
+        status query failed"""
+        self._changes[subscriber] = None
+
+    def _invalidateAll(self):
+        for subscriber in list(self._changes.keys()):
+            self._changes[subscriber] = None
+
+    def _disable(self, inst):
+        self._ui.debug(b'cannot watch working directory: %s\n'
+                       % stringutil.forcebytestr(inst))
+        self.stop()
+        self._disabled = True
+
+    def _abspath(self, rel):
+        if not rel:
+            return self._root
+        return os.path.join(self._root, rel)
+
+    def _watchTree(self, rel):
+        """Watch the directory and queue its subdirectories to be walked"""
+        path = self._abspath(rel)
+        if not self._monitor.watchDirectory(self, path):
+            # distinguish a directory removed meanwhile from a system limit
+            try:
+                os.lstat(path)
+            except OSError:
+                return
+            self._disable(OSError(errno.ENOSPC,
+                                  'cannot add inotify watch', path))
+            return
+        self._dirs.add(rel)
+        try:
+            entries = util.listdir(path)
+        except OSError:
+            return  # removed meanwhile; event will follow
+        for name, kind in entries:
+            if kind != stat.S_IFDIR or name == b'.hg':
+                continue
+            subrel = rel and rel + b'/' + name or name
+            if os.path.lexists(os.path.join(self._abspath(subrel), b'.hg')):
+                continue  # nested repository isn't walked by status
+            self._walkqueue.append(subrel)
+
+    @pyqtSlot()
+    def _walkSome(self):
+        deadline = time.time() + _WALK_INTERVAL
+        while self._walkqueue and time.time() < deadline:
+            self._watchTree(self._walkqueue.pop())
+        if not self._walkqueue:
+            self._walktimer.stop()
+            if self._started:
+                self._ui.debug(b'watching %d directories: %s\n'
+                               % (len(self._dirs), self._root))
+
+    def _unwatchTree(self, rel):
+        prefix = rel + b'/'
+        for d in [d for d in self._dirs if d == rel or d.startswith(prefix)]:
+            self._monitor.unwatchDirectory(self, self._abspath(d))
+            self._dirs.discard(d)
+
+    def notifyPathsChanged(self, changedpaths):
+        """Called by FileSystemMonitor with changed paths, or None if
+        unknown"""
+        if changedpaths is None:
+            self._invalidateAll()
+            return
+        rootprefix = self._root + b'/'
+        files = set()
+        dirs = set()
+        newdirs = []
+        for path in changedpaths:
+            if not path.startswith(rootprefix):
+                continue  # root itself
+            rel = util.pconvert(path[len(rootprefix):])
+            if rel == b'.hg':
+                continue
+            if rel in self._dirs:
+                dirs.add(rel)
+                if not os.path.isdir(path):
+                    self._unwatchTree(rel)  # removed or renamed
+            elif os.path.isdir(path) and not os.path.islink(path):
+                dirs.add(rel)
+                newdirs.append(rel)
+            else:
+                files.add(rel)
+        # walk new directories after removed ones are unwatched since a
+        # renamed directory keeps its watch descriptor
+        if newdirs and self._started:
+            ready = self.isReady()
+            self._walkqueue.extend(newdirs)
+            if ready:
+                # new directory must be watched before subscribers take
+                # changes, so walk it now
+                while self._walkqueue and not self._disabled:
+                    self._watchTree(self._walkqueue.pop())
+        # rules to detect ignored files may be changed
+        if any(os.path.basename(f) == b'.hgignore' for f in files):
+            self._invalidateAll()
+            return
+        for subscriber, changes in list(self._changes.items()):
+            if changes is None:
+                continue
+            changes[0].update(files)
+            changes[1].update(dirs)
+            if len(changes[0]) + len(changes[1]) > _MAX_FEED_CHANGES:
+                self._changes[subscriber] = None
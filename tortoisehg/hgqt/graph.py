@@ -20,8 +20,10 @@ are used by repomodel.py which renders them on a widget.
 
 from __future__ import absolute_import
 
+import array
 import collections
 import os
+import struct
 import time
 
 from mercurial.thirdparty import attr
@@ -550,6 +552,47 @@ class FamilyLineDag(StandardDag):
         assert not queue, queue
 
 
+@attr.s(slots=True, frozen=True)
+class RepoState(object):
+    """Snapshot of repository state which graph nodes are computed from"""
+    tiprev = attr.ib()  # int
+    tipnode = attr.ib()  # bytes
+    filteredrevs = attr.ib()  # frozenset of int
+    nonpublicrevs = attr.ib()  # frozenset of int
+    obsmarkers = attr.ib()  # int
+    mqpatches = attr.ib()  # frozenset of bytes
+    wdparents = attr.ib()  # tuple of int
+
+    @classmethod
+    def fromrepo(cls, repo):
+        urepo = repo.unfiltered()
+        cl = urepo.changelog
+        tiprev = len(cl) - 1
+        return cls(tiprev=tiprev,
+                   tipnode=cl.node(tiprev),
+                   filteredrevs=frozenset(repo.changelog.filteredrevs),
+                   nonpublicrevs=frozenset(urepo.revs(b'draft() or secret()')),
+                   obsmarkers=len(urepo.obsstore),
+                   mqpatches=frozenset(repo._thgmqpatchnames),
+                   wdparents=tuple(p.rev() for p in repo[None].parents()))
+
+    def isprefixof(self, repo, other):
+        """True if `other` state of `repo` only differs from this state by
+        appended revisions and working directory parents"""
+        tiprev = self.tiprev
+        if other.tiprev < tiprev:
+            return False
+        if repo.unfiltered().changelog.node(tiprev) != self.tipnode:
+            return False  # stripped and recommitted
+        if (self.obsmarkers != other.obsmarkers
+            or self.mqpatches != other.mqpatches):
+            return False
+        return (self.filteredrevs == frozenset(
+                    r for r in other.filteredrevs if r <= tiprev)
+                and self.nonpublicrevs == frozenset(
+                    r for r in other.nonpublicrevs if r <= tiprev))
+
+
 def revision_grapher(repo, opts):
     """incremental revision grapher
 
@@ -597,26 +640,28 @@ def revision_grapher(repo, opts):
 
 
 def _iter_graphnodes(dag, nodefactory):
-    revs = []
-    activeedges = []  # order is not important
+    revs = []  # rev of each lane
+    revpos = {}  # rev: lane
+    edgesbyend = {}  # endrev: [GraphEdge, ...] of active edges
 
     rev_color = RevColorPalette()
 
     for ctx, parents in dag.walk():
         curr_rev = ctx.rev()
-        # Compute revs and next_revs.
-        if curr_rev not in revs:
+        # Compute lane of the current revision.
+        rev_index = revpos.get(curr_rev)
+        if rev_index is None:
             # New head.
+            rev_index = revpos[curr_rev] = len(revs)
             revs.append(curr_rev)
-        rev_index = revs.index(curr_rev)
-        next_revs = revs[:]
-        activeedges = [e for e in activeedges if e.endrev < curr_rev]
+        # Retire edges ending at the current revision.
+        edgesbyend.pop(curr_rev, None)
 
-        # Add parents to next_revs.
+        # Add parents to next lanes.
         parents_to_add = []
         for pctx, link_type, is_p1 in parents:
             parent = pctx.rev()
-            if parent not in next_revs:
+            if parent not in revpos:
                 # Because the parents originate from multiple sources, it is
                 # theoretically possible that several point to the same
                 # revision.  Only take the first of this (which is graftsource
@@ -630,21 +675,121 @@ def _iter_graphnodes(dag, nodefactory):
                 color = rev_color.nextcolor()
             else:
                 color = rev_color[pctx]
-            activeedges.append(GraphEdge(curr_rev, parent, color, link_type))
+            edge = GraphEdge(curr_rev, parent, color, link_type)
+            edgesbyend.setdefault(parent, []).append(edge)
 
-        next_revs[rev_index:rev_index + 1] = parents_to_add
+        # The current lane is replaced by the added parents, which shifts
+        # the following lanes by delta.
+        delta = len(parents_to_add) - 1
+        addedpos = dict((p, rev_index + i)
+                        for i, p in enumerate(parents_to_add))
 
         lines = []
-        for e in activeedges:
-            if e.startrev == curr_rev:
-                r = e.startrev
-            else:
-                r = e.endrev
-            p = (revs.index(r), next_revs.index(e.endrev))
-            lines.append((p, e))
+        for edges in edgesbyend.values():
+            for e in edges:
+                endrev = e.endrev
+                if e.startrev == curr_rev:
+                    start = rev_index
+                else:
+                    start = revpos[endrev]
+                end = addedpos.get(endrev)
+                if end is None:
+                    end = revpos[endrev]
+                    if end > rev_index:
+                        end += delta
+                lines.append(((start, end), e))
 
         yield nodefactory(dag.repo, ctx, rev_index, lines)
-        revs = next_revs
+
+        del revpos[curr_rev]
+        revs[rev_index:rev_index + 1] = parents_to_add
+        if delta:
+            for i in pycompat.xrange(rev_index, len(revs)):
+                revpos[revs[i]] = i
+        else:
+            revpos.update(addedpos)
+
+
+class _RevNode(object):
+    """Minimal changectx replacement which only knows revision and parents"""
+
+    __slots__ = ('_dag', '_rev')
+
+    def __init__(self, dag, rev):
+        self._dag = dag
+        self._rev = rev
+
+    def rev(self):
+        return self._rev
+
+    def parents(self):
+        # mimic changectx.parents(): p2 is omitted if null, p1 is not
+        p1, p2 = self._dag.parentrevs(self._rev)
+        if p2 == node.nullrev:
+            return [_RevNode(self._dag, p1)]
+        return [_RevNode(self._dag, p1), _RevNode(self._dag, p2)]
+
+    def __bool__(self):
+        return self._rev != node.nullrev
+
+    __nonzero__ = __bool__
+
+
+class ParentRevDag(object):
+    """Generate DAG for grapher from changelog parent data only
+
+    This is the equivalent of StandardDag with no graft edges.  The
+    revisions should be listed in descending order, starting from None
+    (the working directory) if it is to be graphed.  If branchrevs is
+    specified, only these revisions (and their ancestors if allparents)
+    are iterated.  It should contain None if the working directory is on
+    the branch.
+    """
+
+    repo = None
+
+    def __init__(self, parentrevs, revs, wdparents, branchrevs=None,
+                 allparents=False):
+        self._parentrevs = parentrevs
+        self._revs = revs
+        self._wdparents = tuple(wdparents) + (node.nullrev,) * 2
+        self._branchrevs = branchrevs
+        self._allparents = allparents
+
+    def parentrevs(self, rev):
+        if rev is None:
+            return self._wdparents[:2]
+        return self._parentrevs(rev)
+
+    def walk(self):
+        branchrevs = self._branchrevs
+        filterparents = branchrevs is not None and not self._allparents
+        upcomingparents = set()
+        for rev in self._revs:
+            if branchrevs is not None:
+                if rev in upcomingparents:
+                    upcomingparents.remove(rev)
+                elif rev not in branchrevs:
+                    continue
+            rnode = _RevNode(self, rev)
+            pnodes = [p for p in rnode.parents()
+                      if p and (not filterparents or p.rev() in branchrevs)]
+            if branchrevs is not None:
+                upcomingparents.update(p.rev() for p in pnodes)
+            parents = [(p, LINE_TYPE_PARENT, i == 0)
+                       for i, p in enumerate(pnodes)]
+            yield rnode, parents
+
+
+def _layoutrow(repo, rnode, xposition, lines):
+    return rnode.rev(), xposition, lines
+
+
+def iterlayout(parentrevs, revs, wdparents, branchrevs=None,
+               allparents=False):
+    """Yield (rev, x, lines) of each row without accessing changectx"""
+    dag = ParentRevDag(parentrevs, revs, wdparents, branchrevs, allparents)
+    return _iter_graphnodes(dag, _layoutrow)
 
 
 def filelog_grapher(repo, path):
@@ -808,6 +953,19 @@ class GraphEdge(object):
         # prefer parent-child relation and younger (i.e. longer) edge
         return -self.linktype, -self.color
 
+def nodeshape(ctx):
+    """Return NODE_SHAPE_* of the given changectx"""
+    if ctx.thgmqappliedpatch():
+        return NODE_SHAPE_APPLIEDPATCH
+    elif ctx.closesbranch():
+        return NODE_SHAPE_CLOSEDBRANCH
+    elif phases.draft == ctx.phase():
+        return NODE_SHAPE_REVISION_DRAFT
+    elif phases.secret <= ctx.phase():
+        return NODE_SHAPE_REVISION_SECRET
+    else:
+        return NODE_SHAPE_REVISION
+
 class GraphNode(object):
     """Graph node for all actual changesets, as well as the working copy
 
@@ -826,17 +984,9 @@ class GraphNode(object):
                  "x"]
 
     @classmethod
-    def fromchangectx(cls, repo, ctx, xposition, lines):
-        if ctx.thgmqappliedpatch():
-            shape = NODE_SHAPE_APPLIEDPATCH
-        elif ctx.closesbranch():
-            shape = NODE_SHAPE_CLOSEDBRANCH
-        elif phases.draft == ctx.phase():
-            shape = NODE_SHAPE_REVISION_DRAFT
-        elif phases.secret <= ctx.phase():
-            shape = NODE_SHAPE_REVISION_SECRET
-        else:
-            shape = NODE_SHAPE_REVISION
+    def fromchangectx(cls, repo, ctx, xposition, lines, shape=None):
+        if shape is None:
+            shape = nodeshape(ctx)
         wdparent = ctx.node() in repo.dirstate.parents()
         return cls(shape, ctx=ctx, xposition=xposition, lines=lines,
                    wdparent=wdparent)
@@ -872,6 +1022,165 @@ class GraphNode(object):
         return max([self.x] + [max(p) for p, _e in self.bottomlines]) + 1
 
 
+class CompactGraphRows(object):
+    """Array-backed storage of graph layout rows
+
+    Each row is a (rev, x, lines) tuple as yielded by the layout engine,
+    which is packed into flat arrays of C integers instead of keeping a
+    GraphNode and GraphEdge objects per row.  The node shape can be recorded
+    once it is known, since it can't be computed from the layout.
+
+    Rows must be appended in descending revision order, the working
+    directory first, so that a revision can be looked up by bisection.
+    """
+
+    _NOSHAPE = -1
+    _SEGSIZE = 6  # col, nextcol, startrev, endrev, color, linktype
+    _HEADER = struct.Struct('=II')  # number of rows and segment items
+
+    def __init__(self):
+        self._revs = array.array('i')
+        self._xs = array.array('i')
+        self._shapes = array.array('b')
+        self._segoffsets = array.array('i', [0])  # (len + 1) entries
+        self._segments = array.array('i')
+
+    def __len__(self):
+        return len(self._revs)
+
+    def append(self, rev, x, lines):
+        if rev is None:
+            rev = node.wdirrev
+        self._revs.append(rev)
+        self._xs.append(x)
+        self._shapes.append(self._NOSHAPE)
+        segments = self._segments
+        for (col, nextcol), e in lines:
+            startrev = e.startrev
+            if startrev is None:
+                startrev = node.wdirrev
+            segments.extend((col, nextcol, startrev, e.endrev, e.color,
+                             e.linktype))
+        self._segoffsets.append(len(segments))
+
+    def extend(self, other, start=0):
+        """Append rows of other CompactGraphRows from the start row"""
+        segstart = other._segoffsets[start]
+        base = self._segoffsets[-1] - segstart
+        self._revs.extend(other._revs[start:])
+        self._xs.extend(other._xs[start:])
+        self._shapes.extend(other._shapes[start:])
+        self._segoffsets.extend(base + o
+                                for o in other._segoffsets[start + 1:])
+        self._segments.extend(other._segments[segstart:])
+
+    def write(self, fp):
+        """Write rows in native byte order, excluding node shapes"""
+        fp.write(self._HEADER.pack(len(self._revs), len(self._segments)))
+        for arr in (self._revs, self._xs, self._segoffsets, self._segments):
+            if pycompat.ispy3:
+                fp.write(arr.tobytes())
+            else:
+                fp.write(arr.tostring())
+
+    @classmethod
+    def read(cls, buf, offset=0):
+        """Read rows written by write() from buffer at offset
+
+        Returns a tuple of (rows, end offset).  Raises ValueError if the
+        buffer is truncated.
+        """
+        try:
+            nrows, nsegs = cls._HEADER.unpack_from(buf, offset)
+        except struct.error:
+            raise ValueError('truncated graph rows header')
+        offset += cls._HEADER.size
+        rows = cls()
+        rows._segoffsets = array.array('i')
+        for arr, count in [(rows._revs, nrows), (rows._xs, nrows),
+                           (rows._segoffsets, nrows + 1),
+                           (rows._segments, nsegs)]:
+            end = offset + arr.itemsize * count
+            if end > len(buf):
+                raise ValueError('truncated graph rows')
+            if pycompat.ispy3:
+                arr.frombytes(buf[offset:end])
+            else:
+                arr.fromstring(buf[offset:end])
+            offset = end
+        rows._shapes = array.array('b', [cls._NOSHAPE]) * nrows
+        return rows, offset
+
+    def rev(self, row):
+        rev = self._revs[row]
+        if rev == node.wdirrev:
+            return None
+        return rev
+
+    def x(self, row):
+        return self._xs[row]
+
+    def shape(self, row):
+        """NODE_SHAPE_* of the row, or None if not recorded yet"""
+        shape = self._shapes[row]
+        if shape == self._NOSHAPE:
+            return None
+        return shape
+
+    def setshape(self, row, shape):
+        self._shapes[row] = shape
+
+    def lines(self, row):
+        """List of ((col, next_col), GraphEdge) of the row"""
+        segments = self._segments
+        lines = []
+        for i in pycompat.xrange(self._segoffsets[row],
+                                 self._segoffsets[row + 1], self._SEGSIZE):
+            col, nextcol, startrev, endrev, color, linktype = \
+                segments[i:i + self._SEGSIZE]
+            if startrev == node.wdirrev:
+                startrev = None
+            lines.append(((col, nextcol),
+                          GraphEdge(startrev, endrev, color, linktype)))
+        return lines
+
+    def samerow(self, row, x, lines):
+        """Whether the row has the specified x and lines in any order"""
+        if self._xs[row] != x:
+            return False
+        segments = self._segments
+        size = self._SEGSIZE
+        start, end = self._segoffsets[row], self._segoffsets[row + 1]
+        if end - start != len(lines) * size:
+            return False
+        packed = []
+        for (col, nextcol), e in lines:
+            startrev = e.startrev
+            if startrev is None:
+                startrev = node.wdirrev
+            packed.append((col, nextcol, startrev, e.endrev, e.color,
+                           e.linktype))
+        stored = [tuple(segments[i:i + size])
+                  for i in pycompat.xrange(start, end, size)]
+        return sorted(packed) == sorted(stored)
+
+    def find(self, rev):
+        """Row number of the specified revision, or -1 if not found"""
+        if rev is None:
+            rev = node.wdirrev
+        revs = self._revs
+        lo, hi = 0, len(revs)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if revs[mid] > rev:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(revs) and revs[lo] == rev:
+            return lo
+        return -1
+
+
 class PatchGraphNode(object):
     """Node for un-applied patch queue items.
 
@@ -912,6 +1221,8 @@ class Graph(object):
         self.grapher = grapher
         self.nodes = []
         self.nodesdict = {}
+        self.rowsdict = {}  # rev: row + _rowbase
+        self._rowbase = 0
 
     def __getitem__(self, idx):
         if isinstance(idx, slice):
@@ -965,6 +1276,7 @@ class Graph(object):
         for gnode in self.grapher:
             if self.nodes:
                 gnode.toplines = self.nodes[-1].bottomlines
+            self.rowsdict[gnode.rev] = self._rowbase + len(self.nodes)
             self.nodes.append(gnode)
             self.nodesdict[gnode.rev] = gnode
             if rev is None:
@@ -1005,10 +1317,60 @@ class Graph(object):
         if isinstance(rev, int) and brev is not None and rev < brev:
             self.build_nodes(brev - rev)
         try:
-            return self.nodes.index(self.nodesdict[rev])
+            return self.rowsdict[rev] - self._rowbase
         except KeyError:
             raise ValueError('rev %r not found' % rev)
 
+    def buildtop(self, grapher, maxnodes):
+        """Build new top nodes until their layout meets the existing rows
+
+        `grapher` must walk the same revisions as the current grapher plus
+        revisions appended to the repository since.  Returns a tuple of
+        (nodes, nrows) where `nodes` should replace the first `nrows` rows,
+        or None if the layouts did not converge within `maxnodes` nodes.
+        The existing rows below the seam and the current grapher stay valid
+        because the lanes and edges crossing the seam are identical.
+        """
+        if not self.nodes:
+            return None
+        nodes = []
+        for gnode in grapher:
+            if nodes:
+                gnode.toplines = nodes[-1].bottomlines
+            nodes.append(gnode)
+            if isinstance(gnode.rev, int) and gnode.rev in self.rowsdict:
+                row = self.rowsdict[gnode.rev] - self._rowbase
+                onode = self.nodes[row]
+                if (onode.x == gnode.x
+                    and onode.bottomlines == gnode.bottomlines):
+                    return nodes, row + 1
+            if len(nodes) >= maxnodes:
+                break
+        return None
+
+    def replacetop(self, nodes, nrows, staleparents=()):
+        """Replace the first `nrows` rows by the nodes built by buildtop()
+
+        `staleparents` are revisions that may no longer (or newly) be the
+        parents of the working directory, of which nodes are fixed up.
+        """
+        if nrows < len(self.nodes):
+            self.nodes[nrows].toplines = nodes[-1].bottomlines
+        self.nodes[:nrows] = nodes
+        self._rowbase += nrows - len(nodes)
+        for i, gnode in enumerate(nodes):
+            self.rowsdict[gnode.rev] = self._rowbase + i
+            self.nodesdict[gnode.rev] = gnode
+
+        wdparents = self.repo.dirstate.parents()
+        for rev in staleparents:
+            if rev not in self.rowsdict:
+                continue
+            row = self.rowsdict[rev] - self._rowbase
+            if row >= len(nodes):
+                gnode = self.nodes[row]
+                gnode.wdparent = self.repo.changelog.node(rev) in wdparents
+
     #
     # File graph method
     #
@@ -1024,6 +1386,8 @@ class GraphWithMq(object):
         object.__init__(self)
         self.graph = graph
         self._patchnames = list(reversed(patchnames))
+        self._patchrows = dict((name, row) for row, name
+                               in enumerate(self._patchnames))
 
     def isfilled(self):
         """Indicates whether the graph is done computing"""
@@ -1050,6 +1414,9 @@ class GraphWithMq(object):
     def index(self, rev):
         """Get row number for specified revision"""
         if isinstance(rev, bytes):
-            return self._patchnames.index(rev)
+            try:
+                return self._patchrows[rev]
+            except KeyError:
+                raise ValueError('patch %r not found' % rev)
         i = self.graph.index(rev)
         return len(self._patchnames) + i
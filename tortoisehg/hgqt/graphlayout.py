@@ -0,0 +1,351 @@
+# graphlayout.py - revision graph layout computed in background thread
+#
+# This software may be used and distributed according to the terms of the
+# GNU General Public License version 2 or any later version.
+
+"""revision graph layout computed in background thread
+
+The layout of the revision graph only depends on the parents of each
+revision, which can be read from the changelog index without instantiating
+changectx objects.  LayoutThread walks the changelog in a worker thread and
+streams blocks of finished rows to ThreadedGraph, which keeps them packed in
+CompactGraphRows and creates GraphNode objects lazily for the rows actually
+displayed.
+
+The computed rows are saved under .hg/cache/thg-graph, one file per filter
+level and branch filter.  The file records the tip node it was computed
+for, so the next layout only computes the rows of new revisions until they
+join the cached layout, and takes the remainder from the cache.
+"""
+
+from __future__ import absolute_import
+
+import hashlib
+import mmap
+import struct
+import sys
+import time
+
+from .qtcore import (
+    QThread,
+    pyqtSignal,
+)
+
+from mercurial import (
+    hg,
+    node as nodemod,
+    pycompat,
+    util,
+)
+
+from . import (
+    graph as graphmod,
+    qtlib,
+)
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue  # pytype: disable=import-error
+
+# time slice to collect rows before they are sent to the model
+_BLOCK_INTERVAL = 0.05
+
+# magic, version, byte order, tip node, tip rev, working directory parents,
+# number of filtered revisions; followed by the filtered revisions and blocks
+# of CompactGraphRows
+_CACHEHEADER = struct.Struct('=4sBc20s3iI')
+_CACHEMAGIC = b'THGG'
+_CACHEVERSION = 1
+_CACHEBYTEORDER = sys.byteorder[:1].encode('ascii')
+
+
+def _cachename(filtername, branch, allparents):
+    """Path to the layout cache relative to .hg/cache"""
+    name = filtername or b'unfiltered'
+    if branch:
+        if allparents:
+            branch += b'\0allparents'
+        name += b'-' + nodemod.hex(hashlib.sha1(branch).digest())[:16]
+    return b'thg-graph/' + name
+
+
+class _LayoutCache(object):
+    """Graph layout rows read from the cache file"""
+
+    def __init__(self, tipnode, tiprev, wdparents, filteredrevs, rows):
+        self.tipnode = tipnode
+        self.tiprev = tiprev
+        self.wdparents = wdparents
+        self.filteredrevs = filteredrevs
+        self.rows = rows
+
+
+def _parsecache(buf):
+    try:
+        (magic, version, byteorder, tipnode, tiprev, wdp1, wdp2,
+         nfiltered) = _CACHEHEADER.unpack_from(buf, 0)
+        if (magic, version, byteorder) != (_CACHEMAGIC, _CACHEVERSION,
+                                           _CACHEBYTEORDER):
+            return None
+        offset = _CACHEHEADER.size
+        filteredrevs = frozenset(
+            struct.unpack_from('=%di' % nfiltered, buf, offset))
+        offset += 4 * nfiltered
+        rows, offset = graphmod.CompactGraphRows.read(buf, offset)
+        while offset < len(buf):
+            block, offset = graphmod.CompactGraphRows.read(buf, offset)
+            rows.extend(block)
+    except (struct.error, ValueError):
+        return None
+    return _LayoutCache(tipnode, tiprev, (wdp1, wdp2), filteredrevs, rows)
+
+
+def _readcache(vfs, name):
+    """Read cached layout by mapping the file; None if not available"""
+    try:
+        fp = vfs(name, b'rb')
+    except (IOError, OSError):
+        return None
+    try:
+        try:
+            mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        except (IOError, OSError, ValueError):
+            return None  # empty file
+        try:
+            if pycompat.ispy3:
+                with memoryview(mm) as buf:
+                    return _parsecache(buf)
+            return _parsecache(mm)
+        finally:
+            mm.close()
+    finally:
+        fp.close()
+
+
+class LayoutThread(QThread):
+    """Compute graph layout rows and send them to ThreadedGraph in blocks"""
+
+    # emitted when new block of rows can be taken by build_nodes()
+    rowsComputed = pyqtSignal()
+
+    def __init__(self, repo, rowqueue, branch=None, allparents=False):
+        super(LayoutThread, self).__init__()
+        # own repository instance to not share revlog state with GUI thread
+        self._repo = hg.repository(repo.ui, repo.root).unfiltered()
+        self._changelog = self._repo.changelog
+        self._tiprev = len(repo) - 1
+        self._filteredrevs = frozenset(repo.changelog.filteredrevs)
+        self._wdparents = [p.rev() for p in repo[None].parents()]
+        self._branch = branch
+        self._allparents = allparents
+        self._wdbranch = repo[None].branch()
+        self._cachename = _cachename(repo.filtername, branch, allparents)
+        self._rowqueue = rowqueue
+        self._canceled = False
+
+    def cancel(self):
+        self._canceled = True
+
+    def _iterrevs(self):
+        yield None
+        filteredrevs = self._filteredrevs
+        for rev in pycompat.xrange(self._tiprev, nodemod.nullrev, -1):
+            if rev not in filteredrevs:
+                yield rev
+
+    def _paddedwdparents(self):
+        return tuple(self._wdparents + [nodemod.nullrev] * 2)[:2]
+
+    def _branchrevs(self):
+        if not self._branch:
+            return None
+        branchrevs = set(self._repo.revs(b'branch(%s)', self._branch))
+        if self._wdbranch == self._branch:
+            branchrevs.add(None)
+        return branchrevs
+
+    def _isuptodate(self, cache):
+        if (cache is None or not cache.rows
+            or cache.tiprev != self._tiprev
+            or cache.tipnode != self._changelog.node(self._tiprev)
+            or cache.filteredrevs != self._filteredrevs
+            or cache.wdparents != self._paddedwdparents()):
+            return False
+        wdvisible = not self._branch or self._wdbranch == self._branch
+        return (cache.rows.rev(0) is None) == wdvisible
+
+    def _joinablerev(self, cache):
+        """Highest revision at which the new layout can be joined with the
+        cached rows, or None if the cache is unusable"""
+        if cache is None or cache.tiprev > self._tiprev:
+            return None
+        if self._changelog.node(cache.tiprev) != cache.tipnode:
+            return None  # stripped
+        filteredrevs = set(r for r in self._filteredrevs
+                           if r <= cache.tiprev)
+        changedrevs = filteredrevs.symmetric_difference(cache.filteredrevs)
+        if changedrevs:
+            return min(changedrevs)
+        return cache.tiprev
+
+    def _opencachefile(self):
+        try:
+            fp = self._repo.cachevfs(self._cachename, b'wb', atomictemp=True)
+            filteredrevs = sorted(self._filteredrevs)
+            fp.write(_CACHEHEADER.pack(
+                _CACHEMAGIC, _CACHEVERSION, _CACHEBYTEORDER,
+                self._changelog.node(self._tiprev), self._tiprev,
+                *(self._paddedwdparents() + (len(filteredrevs),))))
+            fp.write(struct.pack('=%di' % len(filteredrevs), *filteredrevs))
+        except (IOError, OSError):
+            return None  # read-only repository, for example
+        return fp
+
+    def _putrows(self, rows, fp):
+        if fp:
+            rows.write(fp)
+        self._rowqueue.put(rows)
+        self.rowsComputed.emit()
+
+    def run(self):
+        try:
+            cache = _readcache(self._repo.cachevfs, self._cachename)
+            if self._isuptodate(cache):
+                self._putrows(cache.rows, None)
+                return
+            joinrev = self._joinablerev(cache)
+            if joinrev is None:
+                cache = None
+            self._layout(cache, joinrev)
+        finally:
+            # end of layout, never let reader wait forever
+            self._rowqueue.put(None)
+            self.rowsComputed.emit()
+
+    def _layout(self, cache, joinrev):
+        fp = self._opencachefile()
+        try:
+            rows = graphmod.CompactGraphRows()
+            deadline = time.time() + _BLOCK_INTERVAL
+            for rev, x, lines in graphmod.iterlayout(
+                    self._changelog.parentrevs, self._iterrevs(),
+                    self._wdparents, self._branchrevs(), self._allparents):
+                if self._canceled:
+                    return
+                rows.append(rev, x, lines)
+                if cache and rev is not None and rev <= joinrev:
+                    # the rows below are the same if the edges crossing
+                    # this row are
+                    crow = cache.rows.find(rev)
+                    if crow >= 0 and cache.rows.samerow(crow, x, lines):
+                        rows.extend(cache.rows, crow + 1)
+                        break
+                if time.time() >= deadline:
+                    self._putrows(rows, fp)
+                    rows = graphmod.CompactGraphRows()
+                    deadline = time.time() + _BLOCK_INTERVAL
+            self._putrows(rows, fp)
+            if fp:
+                fp.close()
+                fp = None
+        finally:
+            if fp:
+                fp.discard()
+
+
+class ThreadedGraph(object):
+    """Graph of which layout is computed by LayoutThread
+
+    The rows are appended as the worker thread computes them, which are
+    taken by build_nodes().  Call start() to run the worker thread.  The
+    worker stops when the graph is canceled or discarded.
+    """
+
+    def __init__(self, repo, branch=None, allparents=False):
+        self._repo = repo
+        self._rows = graphmod.CompactGraphRows()
+        self._cache = util.lrucachedict(1000)
+        self._rowqueue = queue.Queue()
+        self._filled = False
+        self._worker = LayoutThread(repo, self._rowqueue, branch, allparents)
+
+    @property
+    def repo(self):
+        return self._repo
+
+    @property
+    def rowsComputed(self):
+        """Signal emitted by the worker thread when rows are ready"""
+        return self._worker.rowsComputed
+
+    def start(self):
+        # the worker is kept alive until it finishes
+        qtlib.startKeptThread(self._worker)
+
+    def cancel(self):
+        self._worker.cancel()
+
+    def __del__(self):
+        self._worker.cancel()
+
+    def isfilled(self):
+        """Indicates whether the graph is done computing"""
+        return self._filled
+
+    def _takerows(self, block):
+        rows = self._rowqueue.get(block)
+        if rows is None:
+            self._filled = True
+        else:
+            self._rows.extend(rows)
+
+    def build_nodes(self, fillstep=None, rev=None):
+        """Take rows computed by the worker thread
+
+        This never waits for the worker unless fillstep or rev is specified.
+        If fillstep is specified, waits until the graph has at least fillstep
+        rows in total.  If rev is specified, waits until the layout reaches
+        the specified revision.
+        """
+        while not self._filled:
+            if rev is not None and self._rows:
+                lastrev = self._rows.rev(len(self._rows) - 1)
+                if isinstance(lastrev, int) and lastrev <= rev:
+                    rev = None  # already reached rev
+            block = (rev is not None
+                     or (fillstep is not None and len(self._rows) < fillstep))
+            try:
+                self._takerows(block)
+            except queue.Empty:
+                break
+
+    def __len__(self):
+        return len(self._rows)
+
+    def __getitem__(self, row):
+        rows = self._rows
+        if row >= len(rows):
+            row = len(rows) - 1
+        rev = rows.rev(row)
+        if rev in self._cache:
+            return self._cache[rev]
+        gnode = graphmod.GraphNode.fromchangectx(
+            self._repo, self._repo[rev], rows.x(row), rows.lines(row),
+            shape=rows.shape(row))
+        rows.setshape(row, gnode.shape)
+        if row > 0:
+            gnode.toplines = rows.lines(row - 1)
+        self._cache[rev] = gnode
+        return gnode
+
+    def getrevstate(self, row):
+        """Return (rev, isunapplied) of the node at the specified row"""
+        return self._rows.rev(row), False
+
+    def index(self, rev):
+        """Get row number for specified revision"""
+        row = self._rows.find(rev)
+        if row < 0:
+            raise ValueError('rev %r not found' % rev)
+        return row
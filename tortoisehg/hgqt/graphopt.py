@@ -54,13 +54,15 @@ def _compute_lines(rev, prevs, revs, active_edges):
         revs (list[int]): Index of nodes for the current line.
     """
 
+    prevpos = {r: i for i, r in enumerate(prevs)}
+    revpos = {r: i for i, r in enumerate(revs)}
     lines = []
     for edge in active_edges:
         if edge.startrev == rev:
             start_rev = edge.startrev
         else:
             start_rev = edge.endrev
-        pos = (prevs.index(start_rev), revs.index(edge.endrev))
+        pos = (prevpos[start_rev], revpos[edge.endrev])
         lines.append((pos, edge))
     return lines
 
@@ -160,6 +162,11 @@ class Graph(object):
         self._grapher = self._build_nodes()
         self._row_to_rev = dict(
             enumerate(self._get_revision_iterator()))
+        if self._revset:
+            rows = enumerate(self._revset)
+        else:
+            rows = self._row_to_rev.items()
+        self._rev_to_row = dict((rev, row) for row, rev in rows)
 
     @property
     def _clean_revset_set(self):
@@ -308,7 +315,7 @@ class Graph(object):
 
         return anc
 
-    def _add_obsolete(self, rev, parents_to_add, actedge):
+    def _add_obsolete(self, rev, parents_to_add, actedge, lanes):
         """Resolves obsolete edges.
 
         This is a mangled copy from obsoleteutil.first_known_predecessors that
@@ -324,7 +331,8 @@ class Graph(object):
             revs = [r for r in revs if r in self._revset_set]
         for r in revs:
             actedge[r].append(GraphEdge(self, rev, r, LINE_TYPE_OBSOLETE))
-            parents_to_add.append(r)
+            if r not in lanes and r not in parents_to_add:
+                parents_to_add.append(r)
 
     def _build_nodes(self):
         """
@@ -341,14 +349,18 @@ class Graph(object):
         parentrevs[None] = self._workingdir_parents()
         actedge = collections.defaultdict(list)
         revs = []
+        revpos = {}  # rev: index in revs
+        lastrevs = []  # revs stored for the previous row
         revrange = self._get_revision_iterator()
         family = self._pre_compute_family(parentrevs)
 
         for rev in revrange:
             addparents = not self._revset_set or rev in self._revset_set
-            if rev not in revs and addparents:
+            if rev not in revpos and addparents:
+                revpos[rev] = len(revs)
                 revs.append(rev)
-            rev_index = revs.index(rev) if addparents else 0
+                lastrevs = revs[:]
+            rev_index = revpos[rev] if addparents else 0
             if rev in actedge:
                 del actedge[rev]
             op1, op2 = parentrevs[rev]
@@ -365,8 +377,11 @@ class Graph(object):
                             pl = LINE_TYPE_FAMILY if p != fp1 and p != fp2 else p1l
                             actedge[p].append(GraphEdge(self, rev, p, pl))
 
-                parents_to_add = [p for p in parents if
-                                  p != -1 and p not in revs]
+                parents_to_add = []
+                for p in parents:
+                    if (p != -1 and p not in revpos
+                        and p not in parents_to_add):
+                        parents_to_add.append(p)
             else:
                 if p1 != -1 and addparents:
                     actedge[p1].append(GraphEdge(self, rev, p1, p1l))
@@ -374,16 +389,26 @@ class Graph(object):
                     actedge[p2].append(GraphEdge(self, rev, p2, p2l))
 
                 parents_to_add = [p for p in (p1, p2) if
-                                  p != -1 and p not in revs]
+                                  p != -1 and p not in revpos]
 
             if self._show_graft_source:
-                self._add_obsolete(rev, parents_to_add, actedge)
+                self._add_obsolete(rev, parents_to_add, actedge, revpos)
 
-            prevs = revs[:]
+            # rows share the lists of unchanged lanes, and the lanes of the
+            # previous row are the lanes stored for the row above
+            prevs = lastrevs
             if addparents:
+                del revpos[rev]
                 revs[rev_index:rev_index + 1] = parents_to_add
+                if len(parents_to_add) == 1:
+                    end = rev_index + 1
+                else:
+                    end = len(revs)
+                for i in pycompat.xrange(rev_index, end):
+                    revpos[revs[i]] = i
+                lastrevs = revs[:]
             self._graph[rev] = (
-                rev_index, prevs, revs[:],
+                rev_index, prevs, lastrevs,
                 list(itertools.chain(*list(actedge.values()))))
 
             yield rev
@@ -483,12 +508,7 @@ class Graph(object):
     def index(self, rev):
         """Get row number for specified revision"""
 
-        idx = 0
-        isrevset = bool(self._revset)
-        for iter_rev in self._get_revision_iterator():
-            if iter_rev == rev:
-                return idx
-            if not isrevset or iter_rev in self._revset_set:
-                idx += 1
-
-        raise ValueError('rev %r not found' % rev)
+        try:
+            return self._rev_to_row[rev]
+        except KeyError:
+            raise ValueError('rev %r not found' % rev)
@@ -7,8 +7,10 @@
 
 from __future__ import absolute_import
 
+import collections
 import os
 import re
+import time
 
 from .qtcore import (
     QAbstractTableModel,
@@ -16,6 +18,7 @@ from .qtcore import (
     QModelIndex,
     QSettings,
     QThread,
+    QTimer,
     QUrl,
     Qt,
     pyqtSignal,
@@ -44,23 +47,20 @@ from .qtgui import (
 )
 
 from mercurial import (
-    commands,
     error,
     hg,
     match,
     pycompat,
     subrepo,
-    ui,
     scmutil,
 )
-from mercurial.utils import (
-    stringutil,
-)
+from mercurial.node import nullrev
 
 from ..util import (
+    grepsearch,
     hglib,
     paths,
-    thread2,
+    trigramindex,
 )
 from ..util.i18n import _
 from . import (
@@ -75,6 +75,14 @@ from . import (
     visdiff,
 )
 
+# seconds between batches of matched rows sent by search threads
+_EMIT_INTERVAL = 0.1
+
+# matched rows are inserted to the model in chunks, for up to the time budget
+# (in seconds) per event loop iteration
+_INSERT_CHUNK_ROWS = 500
+_INSERT_TIME_BUDGET = 0.02
+
 # This widget can be embedded in any application that would like to
 # provide search features
 
@@ -181,6 +189,7 @@ class SearchWidget(QWidget, qtlib.TaskWidget):
 
         tv = MatchTree(repoagent, self)
         tv.revisionSelected.connect(self.revisionSelected)
+        tv.model().pendingRowsInserted.connect(self._onPendingRowsInserted)
         tv.setColumnHidden(COL_REVISION, True)
         tv.setColumnHidden(COL_USER, True)
         mainvbox.addWidget(tv)
@@ -399,8 +408,7 @@ class SearchWidget(QWidget, qtlib.TaskWidget):
         self.thread.finished.connect(self.searchfinished)
         self.thread.showMessage.connect(self.showMessage)
         self.thread.progress.connect(self.progress)
-        self.thread.matchedRow.connect(
-                     lambda wrapper: model.appendRow(*wrapper.data))
+        self.thread.matchedRows.connect(model.appendRows)
         self.thread.start()
 
     def searchfinished(self):
@@ -408,6 +416,17 @@ class SearchWidget(QWidget, qtlib.TaskWidget):
         self.searchbutton.setEnabled(True)
         self.regexple.setEnabled(True)
         self.regexple.setFocus()
+        model = self.tv.model()
+        assert model is not None
+        if not model.hasPendingRows():
+            self._showSearchResult()
+
+    @pyqtSlot()
+    def _onPendingRowsInserted(self):
+        if self.thread and self.thread.isFinished():
+            self._showSearchResult()
+
+    def _showSearchResult(self):
         model = self.tv.model()
         assert model is not None
         count = model.rowCount()
@@ -423,13 +442,24 @@ class SearchWidget(QWidget, qtlib.TaskWidget):
         else:
             self.showMessage.emit(_('No matches found'))
 
-class DataWrapper(object):
-    def __init__(self, data):
-        self.data = data
+def _indexCandidates(thread, repo, pattern, flags):
+    """Update the trigram index if enabled, and look up the file revisions
+    which may match the pattern; None if all have to be searched"""
+    if not trigramindex.isenabled(repo.ui):
+        return None
+    topic = _('Indexing')
+    unit = _('revisions')
+    def progress(pos, total):
+        if pos % 100 == 0:
+            thread.progress.emit(topic, pos, '', unit, total)
+    index = trigramindex.updatedindex(repo, progress,
+                                      lambda: thread.canceled)
+    thread.progress.emit(topic, None, '', '', None)
+    return index.candidates(pattern, flags)
 
 class HistorySearchThread(QThread):
     '''Background thread for searching repository history'''
-    matchedRow = pyqtSignal(DataWrapper)
+    matchedRows = pyqtSignal(object)
     showMessage = pyqtSignal(str)
     progress = pyqtSignal(str, object, str, str, object)
 
@@ -441,71 +471,73 @@ class HistorySearchThread(QThread):
         self.inc = inc
         self.exc = exc
         self.follow = follow
+        self.canceled = False
         self.completed = False
 
     def cancel(self):
-        if self.isRunning() and hasattr(self, 'thread_id'):
-            try:
-                thread2._async_raise(self.thread_id, KeyboardInterrupt)
-            except ValueError:
-                pass
+        self.canceled = True
 
     def run(self):
-        haskbf = settings.hasExtension('kbfiles')
-        haslf = settings.hasExtension('largefiles')
-        self.thread_id = int(QThread.currentThreadId())
-
-        def emitrow(row):
-            w = DataWrapper(row)
-            self.matchedRow.emit(w)
-        def emitprog(topic, pos, item, unit, total):
-            self.progress.emit(topic, pos, item, unit, total)
-        class incrui(ui.ui):
-            fullmsg = ''
-            def write(self, msg, *args, **opts):
-                self.fullmsg += msg
-                if self.fullmsg.count('\0') >= 6:
-                    try:
-                        fname, line, rev, addremove, user, text, tail = \
-                                self.fullmsg.split('\0', 6)
-                        if haslf and thgrepo.isLfStandin(fname):
-                            raise ValueError
-                        if (haslf or haskbf) and thgrepo.isBfStandin(fname):
-                            raise ValueError
-                        text = hglib.tounicode(text)
-                        text = qtlib.htmlescape(text, False)
-                        text = '<b>%s</b> <span>%s</span>' % (addremove, text)
-                        fname = hglib.tounicode(fname)
-                        user = hglib.tounicode(user)
-                        row = [fname, int(rev), int(line), user, text]
-                        emitrow(row)
-                    except ValueError:
-                        pass
-                    self.fullmsg = tail
-            def progress(topic, pos, item='', unit='', total=None):
-                emitprog(topic, pos, item, unit, total)
-        cwd = os.getcwd()
-        os.chdir(self.repo.root)
-        self.progress.emit(*cmdui.startProgress(_('Searching'), _('history')))
         try:
-            # hg grep [-i] -afn regexp
-            opts = {'all':True, 'user':True, 'follow':self.follow,
-                    'rev':[], 'line_number':True, 'print0':True,
-                    'ignore_case':self.icase, 'include':self.inc,
-                    'exclude':self.exc}
-            u = incrui(self.repo.ui)
-            commands.grep(u, self.repo, self.pattern, **opts)
+            self.searchHistory()
         except Exception as e:
-            self.showMessage.emit(str(e))
-        except KeyboardInterrupt:
-            self.showMessage.emit(_('Interrupted'))
-        self.progress.emit(*cmdui.stopProgress(_('Searching')))
-        os.chdir(cwd)
+            self.showMessage.emit(hglib.tounicode(str(e)))
         self.completed = True
 
+    def searchHistory(self):
+        haskbf = settings.hasExtension('kbfiles')
+        haslf = settings.hasExtension('largefiles')
+        topic = _('Searching')
+        unit = _('revisions')
+        if self.follow:
+            revs = self.repo.revs(b'reverse(::.)')
+        else:
+            revs = self.repo.revs(b'reverse(all())')
+        revs = [r for r in revs if r != nullrev]
+        flags = self.icase and re.I or 0
+        candidates = _indexCandidates(self, self.repo, self.pattern, flags)
+        total = len(revs)
+        count = 0
+        self.progress.emit(topic, count, '', unit, total)
+        results = grepsearch.searchhistory(self.repo, revs, self.pattern,
+                                           flags, self.inc or [],
+                                           self.exc or [], self.follow,
+                                           candidates)
+        rows = []
+        lastemit = time.time()
+        try:
+            for nrevs, matches in results:
+                if self.canceled:
+                    self.showMessage.emit(_('Interrupted'))
+                    break
+                for rev, fname, line, change, user, text, _spans in matches:
+                    if haslf and thgrepo.isLfStandin(fname):
+                        continue
+                    if (haslf or haskbf) and thgrepo.isBfStandin(fname):
+                        continue
+                    if text is None:
+                        text = _('Binary file matches')
+                    else:
+                        text = qtlib.htmlescape(hglib.tounicode(text), False)
+                    text = '<b>%s</b> <span>%s</span>' % (
+                        hglib.tounicode(change), text)
+                    rows.append((hglib.tounicode(fname), line, rev,
+                                 hglib.tounicode(user), text))
+                count += nrevs
+                self.progress.emit(topic, count, '', unit, total)
+                if rows and time.time() - lastemit >= _EMIT_INTERVAL:
+                    self.matchedRows.emit(rows)
+                    rows = []
+                    lastemit = time.time()
+        finally:
+            results.close()
+        if rows:
+            self.matchedRows.emit(rows)
+        self.progress.emit(topic, None, '', '', None)
+
 class CtxSearchThread(QThread):
     '''Background thread for searching a changectx'''
-    matchedRow = pyqtSignal(object)
+    matchedRows = pyqtSignal(object)
     showMessage = pyqtSignal(str)
     progress = pyqtSignal(str, object, str, str, object)
 
@@ -524,6 +556,15 @@ class CtxSearchThread(QThread):
     def cancel(self):
         self.canceled = True
 
+    def _formatLine(self, line, spans):
+        pos = 0
+        for start, end in spans:
+            self.hu.write(line[pos:start], label=b'ui.status')
+            self.hu.write(line[start:end], label=b'grep.match')
+            pos = end
+        self.hu.write(line[pos:], label=b'ui.status')
+        return hglib.tounicode(self.hu.getdata()[0])
+
     def run(self):
         def badfn(f, msg):
             e = hglib.tounicode("%s: %s" % (matchfn.rel(f), msg))
@@ -541,45 +582,45 @@ class CtxSearchThread(QThread):
     def searchRepo(self, ctx, prefix, matchfn):
         topic = _('Searching')
         unit = _('files')
-        total = len(ctx.manifest())
-        count = 0
         haskbf = settings.hasExtension('kbfiles')
         haslf = settings.hasExtension('largefiles')
+        wfiles = []
         for wfile in ctx:                # walk manifest
-            if self.canceled:
-                break
             if haslf and thgrepo.isLfStandin(wfile):
                 continue
             if (haslf or haskbf) and thgrepo.isBfStandin(wfile):
                 continue
-            self.progress.emit(topic, count, hglib.tounicode(wfile), unit,
-                               total)
-            count += 1
-            if not matchfn(wfile):
-                continue
-            try:
-                data = ctx[wfile].data()     # load file data
-            except EnvironmentError:
-                self.showMessage.emit(_('Skipping %s, unable to read') %
-                                      hglib.tounicode(wfile))
-                continue
-            if stringutil.binary(data):
-                continue
-            for i, line in enumerate(data.splitlines()):
-                pos = 0
-                for m in self.regexp.finditer(line): # perform regexp
-                    self.hu.write(line[pos:m.start()], label=b'ui.status')
-                    self.hu.write(line[m.start():m.end()], label=b'grep.match')
-                    pos = m.end()
-                if pos:
-                    self.hu.write(line[pos:], label=b'ui.status')
+            if matchfn(wfile):
+                wfiles.append(wfile)
+        candidates = _indexCandidates(self, ctx.repo(), self.regexp.pattern,
+                                      self.regexp.flags)
+        if candidates is not None:
+            wfiles = grepsearch.narrowfiles(ctx, wfiles, candidates)
+        total = len(wfiles)
+        count = 0
+        self.progress.emit(topic, count, '', unit, total)
+        results = grepsearch.search(ctx.repo(), ctx.rev(), wfiles,
+                                    self.regexp.pattern, self.regexp.flags,
+                                    self.once)
+        try:
+            for nfiles, matches, errors in results:
+                if self.canceled:
+                    break
+                for wfile in errors:
+                    self.showMessage.emit(_('Skipping %s, unable to read') %
+                                          hglib.tounicode(wfile))
+                rows = []
+                for wfile, found in matches:
                     path = os.path.join(prefix, hglib.tounicode(wfile))
-                    row = [path, i + 1, ctx.rev(), None,
-                           hglib.tounicode(self.hu.getdata()[0])]
-                    w = DataWrapper(row)
-                    self.matchedRow.emit(w)
-                    if self.once:
-                        break
+                    for lineno, line, spans in found:
+                        rows.append((path, lineno, ctx.rev(), None,
+                                     self._formatLine(line, spans)))
+                if rows:
+                    self.matchedRows.emit(rows)
+                count += nfiles
+                self.progress.emit(topic, count, '', unit, total)
+        finally:
+            results.close()
         self.progress.emit(topic, None, '', '', None)
 
         if ctx.rev() is None and self.recurse:
@@ -769,10 +810,15 @@ class MatchTree(QTableView):
 
 
 class MatchModel(QAbstractTableModel):
+    pendingRowsInserted = pyqtSignal()
+
     def __init__(self, repoagent, parent):
         QAbstractTableModel.__init__(self, parent)
         self._repoagent = repoagent
         self.rows = []
+        self._pendingrows = collections.deque()
+        self._inserttimer = QTimer(self, interval=0)
+        self._inserttimer.timeout.connect(self._insertPendingRows)
         self.headers = (_('File'), _('Line'), _('Rev'), _('User'),
                         _('Match Text'))
 
@@ -835,14 +881,32 @@ class MatchModel(QAbstractTableModel):
 
     ## Custom methods
 
-    def appendRow(self, *args):
-        l = len(self.rows)
-        self.beginInsertRows(QModelIndex(), l, l)
-        self.rows.append(args)
-        self.endInsertRows()
-        self.layoutChanged.emit()
+    def appendRows(self, rows):
+        """Queue rows to be inserted in chunks while the event loop is idle"""
+        for i in pycompat.xrange(0, len(rows), _INSERT_CHUNK_ROWS):
+            self._pendingrows.append(rows[i:i + _INSERT_CHUNK_ROWS])
+        if not self._inserttimer.isActive():
+            self._inserttimer.start()
+
+    def hasPendingRows(self):
+        return bool(self._pendingrows)
+
+    @pyqtSlot()
+    def _insertPendingRows(self):
+        deadline = time.time() + _INSERT_TIME_BUDGET
+        while self._pendingrows and time.time() < deadline:
+            rows = self._pendingrows.popleft()
+            l = len(self.rows)
+            self.beginInsertRows(QModelIndex(), l, l + len(rows) - 1)
+            self.rows.extend(rows)
+            self.endInsertRows()
+        if not self._pendingrows:
+            self._inserttimer.stop()
+            self.pendingRowsInserted.emit()
 
     def reset(self):
+        self._inserttimer.stop()
+        self._pendingrows.clear()
         self.beginRemoveRows(QModelIndex(), 0, len(self.rows)-1)
         self.rows = []
         self.endRemoveRows()
@@ -10,8 +10,10 @@
 
 from __future__ import absolute_import
 
+import bisect
 import os
 import re
+import sys
 
 from .qtcore import (
     QAbstractItemModel,
@@ -241,13 +243,27 @@ class ManifestModel(QAbstractItemModel):
         if not path:
             return QModelIndex()
 
+        path = pycompat.unicode(path)
+        if self._nodeop is _treenodeop:
+            self._fetchPath(path)
         try:
-            e = self._nodeop.findpath(self._rootentry, pycompat.unicode(path))
+            e = self._nodeop.findpath(self._rootentry, path)
         except KeyError:
             return QModelIndex()
 
         return self.createIndex(e.parent.index(e.name), column, e)
 
+    def _fetchPath(self, path):
+        """Populate unpopulated directories leading to the path"""
+        e = self._rootentry
+        for p in path.split('/')[:-1]:
+            if p not in e:
+                return
+            c = e[p]
+            if c.lazy:
+                self.fetchMore(self.createIndex(e.index(p), 0, c))
+            e = c
+
     def parent(self, index):
         if not index.isValid():
             return QModelIndex()
@@ -307,7 +323,7 @@ class ManifestModel(QAbstractItemModel):
                     return self.setRev(ctx.rev())
             except error.RepoLookupError:
                 pass
-        newroote = _Entry()
+        newroote = _RepoEntry()
         newroote.ctx = ctx
         self._populate = _populatepatch
         self._repopulateNodes(newroote=newroote)
@@ -368,13 +384,21 @@ class ManifestModel(QAbstractItemModel):
         # client code may obtain invalid indexes in its slot
         self._repopulateNodes(newnodeop=_nodeopmap[bool(flat)])
 
+    def hasChildren(self, parent=QModelIndex()):
+        if parent.isValid() and parent.internalPointer().lazy:
+            return True  # unpopulated directory
+        return super(ManifestModel, self).hasChildren(parent)
+
     def canFetchMore(self, parent):
         if parent.isValid():
-            return False
+            return bool(parent.internalPointer().lazy)
         return not self._rootpopulated
 
     def fetchMore(self, parent):
-        if parent.isValid() or self._rootpopulated:
+        if parent.isValid():
+            self._fetchDirectory(parent)
+            return
+        if self._rootpopulated:
             return
         assert len(self._rootentry) == 0, self._rootentry
         newroote = self._rootentry.copyskel()
@@ -388,6 +412,20 @@ class ManifestModel(QAbstractItemModel):
             self.endInsertRows()
         self.revLoaded.emit(self.rev())
 
+    def _fetchDirectory(self, parent):
+        e = parent.internalPointer()
+        if not e.lazy:
+            return
+        children = e.lazy.makechildren(e)
+        e.lazy = None
+        if children:
+            self.beginInsertRows(parent, 0, len(children) - 1)
+        for name, c in children:
+            e.putchild(name, c)
+        e.sort()
+        if children:
+            self.endInsertRows()
+
     def _repopulateNodes(self, newnodeop=None, newroote=None):
         """Recreate populated nodes if any"""
         if not self._rootpopulated:
@@ -407,6 +445,10 @@ class ManifestModel(QAbstractItemModel):
             if not newroote:
                 newroote = self._rootentry.copyskel()
             self._populateNodes(newroote)
+            if self._nodeop is _treenodeop:
+                # new nodes aren't visible yet, so populated without signals
+                for _oi, path in oldindexmap:
+                    _populatepath(newroote, path)
             self._rootentry = newroote
             for oi, path in oldindexmap:
                 self.changePersistentIndex(oi, self.indexFromPath(path))
@@ -420,7 +462,7 @@ class ManifestModel(QAbstractItemModel):
         if not _isreporev(prev):
             raise ValueError('unacceptable parent revision number: %r' % prev)
         repo = self._repoagent.rawRepo()
-        roote = _Entry()
+        roote = _RepoEntry()
         roote.ctx = repo[rev]
         if prev == ManifestModel.FirstParent:
             roote.pctx = roote.ctx.p1()
@@ -432,36 +474,62 @@ class ManifestModel(QAbstractItemModel):
 
     def _populateNodes(self, roote):
         repo = self._repoagent.rawRepo()
+        if self._canPopulateLazily(repo, roote):
+            roote.lazy = _LazyManifestTree(roote.ctx, roote.pctx,
+                                           self._statusfilter)
+            _populatelazy(roote)
+            return
         lpat = hglib.fromunicode(self._namefilter)
         match = _makematcher(repo, roote.ctx, lpat, self._changedfilesonly)
         self._populate(roote, repo, self._nodeop, self._statusfilter, match)
         roote.sort()
 
+    def _canPopulateLazily(self, repo, roote):
+        """Whether directories can be populated when expanded, which is
+        possible if the tree lists all files of two revisions"""
+        ctx = roote.ctx
+        pctx = roote.pctx
+        # working directory and name filter need status of the whole tree
+        return (self._populate is _populaterepo
+                and self._nodeop is _treenodeop
+                and not self._namefilter
+                and not self._changedfilesonly
+                and all(c in self._statusfilter for c in 'MAC')
+                and isinstance(ctx.rev(), int)
+                and isinstance(pctx.rev(), int)
+                and not ctx.substate and not pctx.substate
+                and b'largefiles' not in repo.requirements)
+
+
+if pycompat.ispy3:
+    _intern = sys.intern
+else:
+    def _intern(name):
+        return name  # unicode can't be interned
 
 class _Entry(object):
-    """Each file or directory"""
+    """Each file or directory
+
+    Children are kept in a list in row order, and looked up by name through
+    a dict of rows, which is built on demand.  Leaf entries have neither.
+    Names are interned since the same file names appear in many
+    directories.
+    """
+
+    __slots__ = ('_name', '_parent', 'status', 'lazy', '_child', '_rows')
 
-    __slots__ = ('_name', '_parent', 'status', 'ctx', 'pctx', 'subkind',
-                 '_child', '_nameindex')
+    # only set for the root and subrepos; see _RepoEntry
+    ctx = None
+    pctx = None
+    subkind = None
 
     def __init__(self, name='', parent=None):
-        self._name = name
+        self._name = _intern(name)
         self._parent = parent
         self.status = None
-        self.ctx = None
-        self.pctx = None
-        self.subkind = None
-        self._child = {}
-        self._nameindex = []
-
-    def copyskel(self):
-        """Create unpopulated copy of this entry"""
-        e = self.__class__()
-        e.status = self.status
-        e.ctx = self.ctx
-        e.pctx = self.pctx
-        e.subkind = self.subkind
-        return e
+        self.lazy = None  # _LazyManifestTree if children not populated
+        self._child = None  # [entry, ...] in row order
+        self._rows = None  # {name: row}
 
     @property
     def parent(self):
@@ -469,10 +537,13 @@ class _Entry(object):
 
     @property
     def path(self):
-        if self.parent is None or not self.parent.name:
-            return self.name
-        else:
-            return self.parent.path + '/' + self.name
+        names = []
+        e = self
+        while e._parent is not None:
+            names.append(e._name)
+            e = e._parent
+        names.reverse()
+        return '/'.join(names)
 
     @property
     def name(self):
@@ -480,9 +551,11 @@ class _Entry(object):
 
     @property
     def isdir(self):
-        return bool(self.subkind or self._child)
+        return bool(self.subkind or self._child or self.lazy)
 
     def __len__(self):
+        if not self._child:
+            return 0
         return len(self._child)
 
     def __nonzero__(self):
@@ -491,39 +564,92 @@ class _Entry(object):
 
     __bool__ = __nonzero__
 
+    def _rowmap(self):
+        if self._rows is None:
+            self._rows = dict((e._name, i)
+                              for i, e in enumerate(self._child or ()))
+        return self._rows
+
     def __getitem__(self, name):
-        return self._child[name]
+        return self._child[self._rowmap()[name]]
+
+    def _setchild(self, e):
+        rows = self._rowmap()
+        row = rows.get(e._name)
+        if row is None:
+            if self._child is None:
+                self._child = []
+            rows[e._name] = len(self._child)
+            self._child.append(e)
+        else:
+            self._child[row] = e
 
     def makechild(self, name):
-        if name not in self._child:
-            self._nameindex.append(name)
-        self._child[name] = e = self.__class__(name, parent=self)
+        e = _Entry(name, parent=self)
+        self._setchild(e)
+        return e
+
+    def getchild(self, name):
+        """Return the child of the name, which is created if not exists"""
+        rows = self._rowmap()
+        row = rows.get(name)
+        if row is not None:
+            return self._child[row]
+        e = _Entry(name, parent=self)
+        if self._child is None:
+            self._child = []
+        rows[e._name] = len(self._child)
+        self._child.append(e)
         return e
 
     def putchild(self, name, e):
         assert not e.name and not e.parent, (e.name, e.parent)
-        e._name = name
+        e._name = _intern(name)
         e._parent = self
-        if name not in self._child:
-            self._nameindex.append(name)
-        self._child[name] = e
+        self._setchild(e)
 
     def __contains__(self, item):
-        return item in self._child
+        return item in self._rowmap()
 
     def at(self, index):
-        return self._child[self._nameindex[index]]
+        return self._child[index]
 
     def index(self, name):
-        return self._nameindex.index(name)
+        return self._rowmap()[name]
 
     def sort(self, reverse=False):
         """Sort the entries recursively; directories first"""
-        for e in self._child.values():
-            e.sort(reverse=reverse)
-        self._nameindex.sort(
-            key=lambda s: (not self[s].isdir, os.path.normcase(s)),
-            reverse=reverse)
+        stack = [self]
+        while stack:
+            e = stack.pop()
+            if not e._child:
+                continue
+            e._child.sort(key=_sortkey, reverse=reverse)
+            e._rows = None
+            stack.extend(c for c in e._child if c._child)
+
+def _sortkey(e):
+    return (not e.isdir, os.path.normcase(e._name))
+
+class _RepoEntry(_Entry):
+    """Root entry of repository or subrepository"""
+
+    __slots__ = ('ctx', 'pctx', 'subkind')
+
+    def __init__(self, name='', parent=None):
+        super(_RepoEntry, self).__init__(name, parent)
+        self.ctx = None
+        self.pctx = None
+        self.subkind = None
+
+    def copyskel(self):
+        """Create unpopulated copy of this entry"""
+        e = _RepoEntry()
+        e.status = self.status
+        e.ctx = self.ctx
+        e.pctx = self.pctx
+        e.subkind = self.subkind
+        return e
 
 
 def _isreporev(rev):
@@ -589,9 +715,7 @@ class _treenodeop(object):
     @staticmethod
     def makepath(e, path):
         for p in path.split('/'):
-            if p not in e:
-                e.makechild(p)
-            e = e[p]
+            e = e.getchild(p)
         return e
 
     @staticmethod
@@ -624,6 +748,106 @@ def _populaterepo(roote, repo, nodeop, statusfilter, match):
             e = nodeop.makepath(roote, hglib.tounicode(path))
             e.status = st
 
+def _listmanifestdir(paths, prefix):
+    """List names of files and subdirectories just under the directory
+
+    paths must be sorted, and prefix is the directory path followed by '/',
+    or empty for the root.  Each subdirectory is skipped by bisection.
+
+    >>> paths = [b'a', b'b/c', b'b/d/e', b'b/d/f', b'b/g', b'b0', b'c/h']
+    >>> _listmanifestdir(paths, b'') == ([b'a', b'b0'], [b'b', b'c'])
+    True
+    >>> _listmanifestdir(paths, b'b/') == ([b'c', b'g'], [b'd'])
+    True
+    >>> _listmanifestdir(paths, b'x/')
+    ([], [])
+    """
+    files = []
+    dirs = []
+    plen = len(prefix)
+    i = bisect.bisect_left(paths, prefix)
+    while i < len(paths):
+        path = paths[i]
+        if not path.startswith(prefix):
+            break
+        sep = path.find(b'/', plen)
+        if sep < 0:
+            files.append(path[plen:])
+            i += 1
+        else:
+            dirs.append(path[plen:sep])
+            # b'0' follows b'/'
+            i = bisect.bisect_left(paths, path[:sep] + b'0', i)
+    return files, dirs
+
+class _LazyManifestTree(object):
+    """Create entries of a directory from manifests when it is expanded
+
+    Files are compared by manifest nodes and flags, which is what status
+    between two revisions does, so the whole tree needs no status.
+    """
+
+    def __init__(self, ctx, pctx, statusfilter):
+        self._mf = ctx.manifest()
+        self._pmf = pctx.manifest()
+        self._statusfilter = statusfilter
+        self._paths = sorted(self._mf)
+        if 'R' in statusfilter:
+            self._ppaths = sorted(self._pmf)
+        else:
+            self._ppaths = []
+
+    def _status(self, path):
+        if path not in self._pmf:
+            return 'A'
+        if (self._mf[path] != self._pmf[path]
+            or self._mf.flags(path) != self._pmf.flags(path)):
+            return 'M'
+        return 'C'
+
+    def makechildren(self, e):
+        """Create [(name, entry), ...] of the directory entry"""
+        prefix = hglib.fromunicode(e.path)
+        if prefix:
+            prefix += b'/'
+        files, dirs = _listmanifestdir(self._paths, prefix)
+        pfiles, pdirs = _listmanifestdir(self._ppaths, prefix)
+        children = []
+        dirnames = set(dirs).union(pdirs)
+        for name in dirnames:
+            c = _Entry()
+            c.lazy = self
+            children.append((hglib.tounicode(name), c))
+        filestats = [(name, self._status(prefix + name)) for name in files]
+        # removed file may be replaced by directory
+        filestats.extend((name, 'R') for name in set(pfiles).difference(files)
+                         if name not in dirnames)
+        for name, st in filestats:
+            if st not in self._statusfilter:
+                continue
+            c = _Entry()
+            c.status = st
+            children.append((hglib.tounicode(name), c))
+        return children
+
+def _populatelazy(e):
+    """Populate children of the directory entry without notification"""
+    children = e.lazy.makechildren(e)
+    e.lazy = None
+    for name, c in children:
+        e.putchild(name, c)
+    e.sort()
+
+def _populatepath(roote, path):
+    """Populate directories leading to the path without notification"""
+    e = roote
+    for p in path.split('/')[:-1]:
+        if p not in e:
+            return
+        e = e[p]
+        if e.lazy:
+            _populatelazy(e)
+
 def _comparesubstate(state1, state2):
     if state1 == state2:
         return 'C'
@@ -642,7 +866,7 @@ def _populatesubrepos(roote, repo, nodeop, statusfilter, match):
     for path in subpaths:
         substate = ctx.substate.get(path, hglib.nullsubrepostate)
         psubstate = pctx.substate.get(path, hglib.nullsubrepostate)
-        e = _Entry()
+        e = _RepoEntry()
         e.status = _comparesubstate(psubstate, substate)
         if e.status == 'R':
             # denotes the original subrepo has been removed
@@ -1202,6 +1202,35 @@ class WidgetGroups(object):
     def set_enable(self, *args, **kargs):
         self.set_prop('setEnabled', *args, **kargs)
 
+# background threads kept alive until they finish
+_runningthreads = set()
+
+def _cancelrunningthreads():
+    for th in list(_runningthreads):
+        th.cancel()
+        th.wait()
+
+def _forgetthread(thread):
+    _runningthreads.discard(thread)
+    if not _runningthreads:
+        app = QApplication.instance()
+        if app:
+            app.aboutToQuit.disconnect(_cancelrunningthreads)
+
+def startKeptThread(thread):
+    """Start QThread which is kept alive even if its owner is discarded
+
+    The thread must have cancel() method, which is called before the
+    application quits.
+    """
+    if not _runningthreads:
+        app = QApplication.instance()
+        if app:
+            app.aboutToQuit.connect(_cancelrunningthreads)
+    _runningthreads.add(thread)
+    thread.finished.connect(lambda: _forgetthread(thread))
+    thread.start()
+
 class DialogKeeper(QObject):
     """Manage non-blocking dialogs identified by creation parameters
 
@@ -16,6 +16,7 @@
 
 from __future__ import absolute_import
 
+import array
 import binascii
 import os
 import re
@@ -26,6 +27,7 @@ from .qtcore import (
     QMimeData,
     QModelIndex,
     QT_VERSION,
+    QThread,
     Qt,
     pyqtSignal,
     pyqtSlot,
@@ -38,6 +40,9 @@ from .qtgui import (
 
 from mercurial import (
     error,
+    hg,
+    node as nodemod,
+    phases,
     pycompat,
 )
 from mercurial.utils import (
@@ -47,10 +52,13 @@ from mercurial.utils import (
 from ..util import hglib
 from ..util.i18n import _
 from . import (
+    changecount,
     cmdcore,
     filedata,
     graph,
+    graphlayout,
     graphopt,
+    qtlib,
 )
 
 mqpatchmimetype = 'application/thg-mqunappliedpatch'
@@ -102,6 +110,31 @@ TROUBLED_COLOR = QColor(172, 34, 34)
 GraphNodeRole = Qt.UserRole + 0
 LabelsRole = Qt.UserRole + 1  # [(text, style), ...]
 
+# namespaces of which names(node) lists the names resolved to the node by
+# nodes(name), so the labels can be indexed by inverting the latter
+_INVERTIBLE_NAMESPACES = {b'bookmarks', b'tags', b'remotebookmarks',
+                          b'remotebranches'}
+
+# number of rows around the displayed one of which changes are counted
+_CHANGES_PREFETCH = 50
+
+# number of rows of which display data is read ahead in background
+_ROW_PREFETCH = 200
+
+# columns which can be filled by _RevData
+_PREFETCHCOLUMNS = (RevColumn, BranchColumn, DescColumn, AuthorColumn,
+                    AgeColumn, LocalDateColumn, UtcDateColumn, PhaseColumn)
+
+# config items which affect the data of the listed columns
+_COLUMNCONFIGS = [
+    ('experimental', 'thg.displaynames', (DescColumn,)),
+    ('tortoisehg', 'authorcolor', (AuthorColumn,)),
+    ('tortoisehg', 'fullauthorname', (AuthorColumn,)),
+    ('tortoisehg', 'hidetags', (DescColumn,)),
+    ('tortoisehg', 'longsummary', (DescColumn,)),
+    ('tortoisehg', 'show-branch-head-label', (DescColumn,)),
+]
+
 def _parsebranchcolors(value):
     r"""Parse tortoisehg.branchcolors setting
 
@@ -144,6 +177,236 @@ def _parsebranchcolors(value):
     return colors
 
 
+class _RevData(object):
+    """Subset of changectx read by _RowPrefetchThread"""
+
+    __slots__ = ('_rev', '_user', '_date', '_description', '_branch',
+                 '_extra', '_phase')
+
+    def __init__(self, rev, clrev, phase):
+        self._rev = rev
+        self._user = clrev.user
+        self._date = clrev.date
+        self._description = clrev.description
+        self._branch = clrev.branchinfo[0]
+        self._extra = clrev.extra
+        self._phase = phase
+
+    def rev(self):
+        return self._rev
+
+    def user(self):
+        return self._user
+
+    def date(self):
+        return self._date
+
+    def description(self):
+        return self._description
+
+    def branch(self):
+        return self._branch
+
+    def extra(self):
+        return self._extra
+
+    def phasestr(self):
+        return phases.phasenames[self._phase]
+
+
+class _RowPrefetchThread(QThread):
+    """Read changelog entries of rows about to be displayed"""
+
+    # emitted with [_RevData, ...]
+    revDataLoaded = pyqtSignal(object)
+
+    def __init__(self, repo, revs):
+        super(_RowPrefetchThread, self).__init__()
+        self._repo = repo
+        self._revs = revs
+        self._canceled = False
+
+    def cancel(self):
+        self._canceled = True
+
+    def run(self):
+        repo = self._repo
+        clog = repo.changelog
+        phasecache = repo._phasecache
+        data = []
+        # in ascending order, nearby entries are read from the revlog at once
+        for rev in sorted(self._revs):
+            if self._canceled:
+                return
+            try:
+                clrev = clog.changelogrevision(rev)
+            except (IndexError, error.LookupError):
+                continue  # stripped meanwhile
+            data.append(_RevData(rev, clrev, phasecache.phase(repo, rev)))
+        self.revDataLoaded.emit(data)
+
+
+class _LatestTagIndex(object):
+    """Latest global tag of every revision, with its date and distance
+
+    It is computed by one pass over the changelog parents in revision
+    order, which is topological.  The index can be extended for appended
+    revisions as long as the tags are unchanged.
+    """
+
+    def __init__(self, repo):
+        self._tagged = self._taggedrevs(repo)
+        self._names = sorted(set(self._tagged.values()) | {'null'})
+        self._ranks = dict((t, i) for i, t in enumerate(self._names))
+        # the arrays are laid out so the right one can be found by
+        # comparison of (date, distance, rank of tag name)
+        self._dates = array.array('d')
+        self._dists = array.array('i')
+        self._tagranks = array.array('i')
+        self._lastnode = nodemod.nullid
+        self._extend(repo)
+
+    @staticmethod
+    def _taggedrevs(repo):
+        clog = repo.changelog
+        tagged = {}
+        for name, node in pycompat.iteritems(repo.tags()):
+            tagtype = repo.tagtype(name)
+            if not tagtype or tagtype == b'local':
+                continue
+            try:
+                rev = clog.rev(node)
+            except error.LookupError:
+                continue
+            tagged.setdefault(rev, []).append(hglib.tounicode(name))
+        return dict((rev, ':'.join(sorted(tags)))
+                    for rev, tags in pycompat.iteritems(tagged))
+
+    def __len__(self):
+        return len(self._dates)
+
+    def update(self, repo):
+        """Extend the index for appended revisions; False if it has to be
+        rebuilt because of changed tags or stripped revisions"""
+        clog = repo.unfiltered().changelog
+        n = len(self)
+        if len(clog) < n or (n and clog.node(n - 1) != self._lastnode):
+            return False
+        if self._taggedrevs(repo) != self._tagged:
+            return False
+        self._extend(repo)
+        return True
+
+    def _extend(self, repo):
+        clog = repo.unfiltered().changelog
+        parentrevs = clog.parentrevs
+        tagged = self._tagged
+        dates, dists, tagranks = self._dates, self._dists, self._tagranks
+        for rev in pycompat.xrange(len(dates), len(clog)):
+            tag = tagged.get(rev)
+            if tag is not None:
+                date = clog.changelogrevision(rev).date[0]
+                dist = 0
+                rank = self._ranks[tag]
+            else:
+                p1, p2 = parentrevs(rev)
+                key = self._key(p1)
+                if p2 != nodemod.nullrev:
+                    key = max(key, self._key(p2))
+                date, dist, rank = key
+                dist += 1
+            dates.append(date)
+            dists.append(dist)
+            tagranks.append(rank)
+        if dates:
+            self._lastnode = clog.node(len(dates) - 1)
+
+    def _key(self, rev):
+        if rev == nodemod.nullrev:
+            return (0.0, 0, self._ranks['null'])
+        return (self._dates[rev], self._dists[rev], self._tagranks[rev])
+
+    def tag(self, rev):
+        """Latest tag of the revision"""
+        return self._names[self._key(rev)[2]]
+
+    def tagofparents(self, parentrevs):
+        """Latest tag of a revision having the specified parents"""
+        key = max(self._key(p) for p in parentrevs)
+        return self._names[key[2]]
+
+
+class _RevLabelIndex(object):
+    """Labels of revisions having branch head, bookmark, tag or other names
+
+    It is built once per repository change, so that the labels of the
+    painted rows can be looked up by node.  Names of the namespaces not known
+    to map nodes one-to-one (e.g. branches, which name every revision but
+    resolve to the tip) are looked up per node.
+    """
+
+    def __init__(self, repo, displaynames, showbranchheads):
+        self._repo = repo
+        self._labels = labels = {}  # node: [(text, style), ...]
+        # [(style, namespace, {node: [name, ...]} or None), ...]
+        self._namespaces = []
+
+        if showbranchheads:
+            branchmap = repo.branchmap()
+            for branch in branchmap:
+                for node in branchmap.branchheads(branch):
+                    labels.setdefault(node, []).append(
+                        (hglib.tounicode(branch), 'log.branch'))
+
+        curmark = hglib.activebookmark(repo)
+        if (curmark not in repo._bookmarks
+            or repo._bookmarks[curmark] not in repo.dirstate.parents()):
+            curmark = None
+        for mark, node in sorted(pycompat.iteritems(repo._bookmarks)):
+            if mark == curmark:
+                style = 'log.curbookmark'
+            else:
+                style = 'log.bookmark'
+            labels.setdefault(node, []).append((hglib.tounicode(mark), style))
+
+        hiddentags = repo._thghiddentags
+        for tag, node in sorted(pycompat.iteritems(repo.tags())):
+            if tag in hiddentags:
+                continue
+            if repo.thgmqtag(tag):
+                style = 'log.patch'
+            else:
+                style = 'log.tag'
+            labels.setdefault(node, []).append((hglib.tounicode(tag), style))
+
+        for name, ns in repo.names.items():
+            if pycompat.sysstr(name) not in displaynames:
+                continue
+            # we will use the templatename as the color name since those
+            # two should be the same
+            style = 'log.%s' % hglib.tounicode(ns.colorname)
+            if name not in _INVERTIBLE_NAMESPACES:
+                self._namespaces.append((style, ns, None))
+                continue
+            nodes = set()
+            for n in ns.listnames(repo):
+                nodes.update(ns.nodes(repo, n))
+            self._namespaces.append(
+                (style, ns, dict((node, ns.names(repo, node))
+                                 for node in nodes)))
+
+    def labels(self, node):
+        """List of (text, style) of the revision"""
+        labels = list(self._labels.get(node, ()))
+        for style, ns, nodenames in self._namespaces:
+            if nodenames is None:
+                names = ns.names(self._repo, node)
+            else:
+                names = nodenames.get(node, ())
+            labels.extend((hglib.tounicode(n), style) for n in names)
+        return labels
+
+
 class HgRepoListModel(QAbstractTableModel):
     """
     Model used for displaying the revisions of a Hg *local* repository
@@ -171,7 +434,9 @@ class HgRepoListModel(QAbstractTableModel):
         self.unicodestar = True
         self.unicodexinabox = True
         self._branchheads = {}  # branch: {node, ...}
-        self._latesttags = {-1: (0, 0, 'null')}  # date, dist, tag
+        self._latesttags = None  # _LatestTagIndex
+        self._revlabels = None  # _RevLabelIndex
+        self._latesttagsstale = False
         self._fullauthorname = False
         self._filterbranch = ''  # unicode
         self._allparents = False
@@ -183,12 +448,20 @@ class HgRepoListModel(QAbstractTableModel):
 
         self._querysess = cmdcore.nullCmdSession()
         self._pendingrebuild = False
+        self._graphlayout = None  # ThreadedGraph being computed
+        self._prefetchthread = None
+        self._prefetchrepo = None  # used by one prefetch thread at a time
+        self._prefetchcache = None  # self._cache to be filled by thread
+        self._prefetchrow = None  # row requested while thread is running
+        self._changecounter = changecount.ChangeCounter(repoagent, self)
+        self._changecounter.countsChanged.connect(self._onChangesCounted)
 
         repoagent.configChanged.connect(self._invalidate)
         repoagent.repositoryChanged.connect(self._reloadGraph)
 
         self._initBranchColors()
         self._reloadConfig()
+        self._graphstate = self._repoState()
         self.graph = self._createGraph()
 
     @property
@@ -218,6 +491,7 @@ class HgRepoListModel(QAbstractTableModel):
         self._rebuildGraph()
 
     def _createGraph(self):
+        self._graphlayout = None
         opts = {
             'branch': hglib.fromunicode(self._filterbranch),
             'showgraftsource': self._showgraftsource,
@@ -237,24 +511,103 @@ class HgRepoListModel(QAbstractTableModel):
             grapher = graph.revision_grapher(self.repo, opts)
             if self._repoagent.configBool('tortoisehg', 'graphopt'):
                 g = graphopt.Graph(self.repo, opts)
+            elif self._useGraphLayoutThread():
+                g = graphlayout.ThreadedGraph(
+                    self.repo, opts['branch'] or None, self._allparents)
+                g.rowsComputed.connect(self._onGraphRowsComputed)
+                g.start()
+                self._graphlayout = g
             else:
                 g = graph.Graph(self.repo, grapher)
             if self.repo.thgmqunappliedpatches:
                 g = graph.GraphWithMq(g, self.repo.thgmqunappliedpatches)
             return g
 
+    def _repoState(self):
+        """Snapshot of repository state to detect appended revisions; None
+        if the graph cannot be updated incrementally"""
+        return graph.RepoState.fromrepo(self.repo)
+
+    def _useGraphLayoutThread(self):
+        return (self._repoagent.configBool('tortoisehg', 'graphthread')
+                and not self._showgraftsource
+                and not self.repo.ui.configbool(b'experimental',
+                                                b'graph-group-branches')
+                and not self._repoagent.overlayUrl())
+
+    @pyqtSlot()
+    def _onGraphRowsComputed(self):
+        if self._graphlayout is None:
+            return
+        self._graphlayout.build_nodes()
+        self._expandRowCount()
+
     @pyqtSlot()
     def _reloadGraph(self):
         self._branchheads.clear()
-        self._latesttags = {-1: self._latesttags[-1]}  # clear
+        self._prefetchrepo = None
+        self._latesttagsstale = True
+        self._revlabels = None
         if self._revspec:
             self._runQuery()
-        self._rebuildGraph()
+        if not self._updateGraphTop():
+            self._rebuildGraph()
+
+    def _updateGraphTop(self):
+        """Splice rows of appended revisions onto the top of the graph
+
+        Returns False if the graph has to be rebuilt from scratch.
+        """
+        oldstate = self._graphstate
+        if (oldstate is None or self._pendingrebuild or self._rowcount <= 0
+            or type(self.graph) is not graph.Graph
+            or self.graph.repo is not self.repo
+            or self._filterbranch or (self._revspec and self._filterbyrevset)
+            or self.repo.thgmqunappliedpatches
+            or self._repoagent.configBool('experimental',
+                                          'graph-group-branches')):
+            return False
+        newstate = self._repoState()
+        if not oldstate.isprefixof(self.repo, newstate):
+            return False
+
+        opts = {
+            'allparents': self._allparents,
+            'showgraftsource': self._showgraftsource,
+            }
+        grapher = graph.revision_grapher(self.repo, opts)
+        maxnodes = newstate.tiprev - oldstate.tiprev + self._fill_step
+        top = self.graph.buildtop(grapher, maxnodes)
+        if top is None:
+            return False
+        nodes, nrows = top
+        ninserted = len(nodes) - nrows
+        if ninserted < 0:
+            return False
+
+        # appended revisions are the highest ones, which are listed just
+        # below the working directory
+        first = 0
+        if nodes[0].rev is None:
+            first = 1
+        if ninserted > 0:
+            self.beginInsertRows(QModelIndex(), first, first + ninserted - 1)
+        self.graph.replacetop(nodes, nrows,
+                              oldstate.wdparents + newstate.wdparents)
+        self._graphstate = newstate
+        self._cache = []
+        if ninserted > 0:
+            self._rowcount += ninserted
+            self.endInsertRows()
+        self._emitAllDataChanged()
+        self.revsUpdated.emit()
+        return True
 
     def _rebuildGraph(self):
         if not self._querysess.isFinished():
             self._pendingrebuild = True
             return
+        self._graphstate = self._repoState()
         # skip costly operation while initializing options
         if self._rowcount <= 0 and not self.graph.isfilled():
             assert not self._cache
@@ -280,7 +633,7 @@ class HgRepoListModel(QAbstractTableModel):
         try:
             oldindexmap = {}  # rev: [index, ...]
             for i in self.persistentIndexList():
-                rev = self.graph[i.row()].rev
+                rev, _isunapplied = self.graph.getrevstate(i.row())
                 if rev not in oldindexmap:
                     oldindexmap[rev] = []
                 oldindexmap[rev].append(i)
@@ -383,12 +736,29 @@ class HgRepoListModel(QAbstractTableModel):
             'tortoisehg', 'fullauthorname')
         self._show_branch_head_label = self._repoagent.configBool(
             'tortoisehg', 'show-branch-head-label')
+        self._columnconfigs = [self._repoagent.configString(section, name)
+                               for section, name, _columns in _COLUMNCONFIGS]
 
     @pyqtSlot()
     def _invalidate(self):
+        oldconfigs = self._columnconfigs
         self._reloadConfig()
-        self._cache = []
-        self._emitAllDataChanged()
+        columns = set()
+        for (_section, _name, cols), old, new in zip(
+                _COLUMNCONFIGS, oldconfigs, self._columnconfigs):
+            if old != new:
+                columns.update(cols)
+        if not columns:
+            return
+        if DescColumn in columns:
+            self._revlabels = None
+        for data in self._cache:
+            for idx in [idx for idx in data if idx[1] in columns]:
+                del data[idx]
+        if self._rowcount <= 0:
+            return
+        self.dataChanged.emit(self.index(0, min(columns)),
+                              self.index(self._rowcount - 1, max(columns)))
 
     def _emitAllDataChanged(self):
         if self._rowcount <= 0:
@@ -422,6 +792,8 @@ class HgRepoListModel(QAbstractTableModel):
         # caller should do _expandRowCount() or _shrinkRowCount() by itself
 
     def loadall(self):
+        if self._graphlayout is not None:
+            return  # rows are streamed from the layout thread
         self._timerhandle = self.startTimer(1)
 
     def timerEvent(self, event):
@@ -551,6 +923,8 @@ class HgRepoListModel(QAbstractTableModel):
         data = self._cache[row]
         idx = (role, index.column())
         if idx not in data:
+            if role == Qt.DisplayRole and idx[1] in _PREFETCHCOLUMNS:
+                self._prefetchRows(row + 1)
             try:
                 result = self._rawdata(index, role)
             except error.RepoLookupError:
@@ -562,6 +936,68 @@ class HgRepoListModel(QAbstractTableModel):
             data[idx] = result
         return data[idx]
 
+    def _prefetchRows(self, row):
+        """Read display data of the rows from the specified row in
+        background if many of them aren't cached"""
+        if self._prefetchthread:
+            self._prefetchrow = row
+            return
+        cache = self._cache
+        revs = []
+        for i in pycompat.xrange(row, min(row + _ROW_PREFETCH,
+                                          len(self.graph))):
+            if i < len(cache) and (Qt.DisplayRole, DescColumn) in cache[i]:
+                continue
+            rev, isunapplied = self.graph.getrevstate(i)
+            if isunapplied or not isinstance(rev, int):
+                continue
+            revs.append(rev)
+        if len(revs) < _ROW_PREFETCH // 2:
+            return  # not worth starting thread
+        if self._prefetchrepo is None:
+            # own repository instance to not share revlog state with GUI
+            # thread
+            self._prefetchrepo = hg.repository(self.repo.ui,
+                                               self.repo.root).unfiltered()
+        self._prefetchthread = th = _RowPrefetchThread(self._prefetchrepo,
+                                                       revs)
+        self._prefetchcache = cache
+        th.revDataLoaded.connect(self._onRevDataLoaded)
+        th.finished.connect(self._onPrefetchFinished)
+        qtlib.startKeptThread(th)
+
+    @pyqtSlot(object)
+    def _onRevDataLoaded(self, revdata):
+        cache = self._cache
+        if (self.sender() is not self._prefetchthread
+            or self._prefetchcache is not cache):
+            return  # model reloaded meanwhile
+        graphlen = len(self.graph)
+        if graphlen > len(cache):
+            cache.extend({} for _i in
+                         pycompat.xrange(graphlen - len(cache)))
+        for ctx in revdata:
+            try:
+                row = self.graph.index(ctx.rev())
+            except ValueError:
+                continue
+            data = cache[row]
+            for column in _PREFETCHCOLUMNS:
+                idx = (Qt.DisplayRole, column)
+                if idx not in data:
+                    data[idx] = self._displaytext(ctx, column)
+
+    @pyqtSlot()
+    def _onPrefetchFinished(self):
+        if self.sender() is not self._prefetchthread:
+            return
+        self._prefetchthread = None
+        self._prefetchcache = None
+        row = self._prefetchrow
+        self._prefetchrow = None
+        if row is not None:
+            self._prefetchRows(row)
+
     def _rawdata(self, index, role):
         row = index.row()
         column = index.column()
@@ -569,13 +1005,7 @@ class HgRepoListModel(QAbstractTableModel):
         ctx = self.repo[gnode.rev]
 
         if role == Qt.DisplayRole:
-            textfunc = self._columnmap.get(column)
-            if textfunc is None:
-                return None
-            text = textfunc(self, ctx)
-            if not isinstance(text, pycompat.unicode):
-                text = hglib.tounicode(text)
-            return text
+            return self._displaytext(ctx, column)
         elif role == Qt.ForegroundRole:
             color = None
             if gnode.instabilities:
@@ -717,33 +1147,19 @@ class HgRepoListModel(QAbstractTableModel):
 
     def _getlatesttags(self, ctx):
         rev = ctx.rev()
-        todo = [rev]
-        repo = self.repo
-        while todo:
-            rev = todo.pop()
-            if rev in self._latesttags:
-                continue
-            ctx = repo[rev]
-            tags = [hglib.tounicode(t) for t in ctx.tags()
-                    if repo.tagtype(t) and repo.tagtype(t) != b'local']
-            if tags:
-                self._latesttags[rev] = ctx.date()[0], 0, ':'.join(sorted(tags))
-                continue
-            try:
-                # The tuples are laid out so the right one can be found by
-                # comparison.
-                if ctx.parents():
-                    pdate, pdist, ptag = max(
-                        self._latesttags[p.rev()] for p in ctx.parents())
-                else:
-                    pdate, pdist, ptag = 0, -1, ""
-            except KeyError:
-                # Cache miss - recurse
-                todo.append(rev)
-                todo.extend(p.rev() for p in ctx.parents())
-                continue
-            self._latesttags[rev] = pdate, pdist + 1, ptag
-        return self._latesttags[rev][2]
+        if rev is not None and not isinstance(rev, int):
+            return ''  # unapplied patch
+        index = self._latesttags
+        if index is not None and (self._latesttagsstale
+                                  or (rev is not None and rev >= len(index))):
+            if not index.update(self.repo):
+                index = None
+        if index is None:
+            index = self._latesttags = _LatestTagIndex(self.repo)
+        self._latesttagsstale = False
+        if rev is None:
+            return index.tagofparents(p.rev() for p in ctx.parents())
+        return index.tag(rev)
 
     def _gettags(self, ctx):
         if ctx.rev() is None:
@@ -783,18 +1199,16 @@ class HgRepoListModel(QAbstractTableModel):
         return hglib.longsummary(ctx.description(), limit)
 
     def _getrevlabels(self, ctx):
-        labels = []
-
-        # as of hg 4.4.2, repo.branchheads() can be slow because of
-        # branchmap.updatecache() -> scmutil.filteredhash() calls
-        branch = ctx.branch()
-        try:
-            branchheads = self._branchheads[branch]
-        except KeyError:
-            branchheads = set(self.repo.branchheads(branch))
-            self._branchheads[branch] = branchheads
-
         if ctx.rev() is None:
+            labels = []
+            # as of hg 4.4.2, repo.branchheads() can be slow because of
+            # branchmap.updatecache() -> scmutil.filteredhash() calls
+            branch = ctx.branch()
+            try:
+                branchheads = self._branchheads[branch]
+            except KeyError:
+                branchheads = set(self.repo.branchheads(branch))
+                self._branchheads[branch] = branchheads
             if hglib.createsnewhead(ctx, branchheads):
                 labels.append((_('Creates new head!'), 'log.warning'))
             topic = self._gettopic(ctx)
@@ -802,54 +1216,83 @@ class HgRepoListModel(QAbstractTableModel):
                 labels.append((topic, 'topic.active'))
             return labels
 
-        if self._show_branch_head_label:
-            if ctx.node() in branchheads:
-                labels.append((hglib.tounicode(branch), 'log.branch'))
-
         if ctx.thgmqunappliedpatch():
             style = 'log.unapplied_patch'
-            labels.append((hglib.tounicode(ctx._patchname), style))
-
-        for mark in ctx.bookmarks():
-            style = 'log.bookmark'
-            if mark == hglib.activebookmark(self.repo):
-                bn = self.repo._bookmarks[hglib.activebookmark(self.repo)]
-                if bn in self.repo.dirstate.parents():
-                    style = 'log.curbookmark'
-            labels.append((hglib.tounicode(mark), style))
-
-        for tag in ctx.thgtags():
-            if self.repo.thgmqtag(tag):
-                style = 'log.patch'
-            else:
-                style = 'log.tag'
-            labels.append((hglib.tounicode(tag), style))
-
-        names = set(self._repoagent.configStringList(
-            'experimental', 'thg.displaynames'))
-        for name, ns in self.repo.names.items():
-            if pycompat.sysstr(name) not in names:
-                continue
-            # we will use the templatename as the color name since those
-            # two should be the same
-            for name in ns.names(self.repo, ctx.node()):
-                labels.append((hglib.tounicode(name),
-                               'log.%s' % hglib.tounicode(ns.colorname)))
+            return [(hglib.tounicode(ctx._patchname), style)]
 
-        return labels
+        if self._revlabels is None:
+            names = set(self._repoagent.configStringList(
+                'experimental', 'thg.displaynames'))
+            self._revlabels = _RevLabelIndex(self.repo, names,
+                                             self._show_branch_head_label)
+        return self._revlabels.labels(ctx.node())
 
     def _getchanges(self, ctx):
         """Return the MAR status for the given ctx."""
         labels = []
-        M, A, R = ctx.changesToParent(0)
+        if isinstance(ctx.rev(), int):
+            counts = self._changecounter.get(ctx.node())
+            if counts is None:
+                # filled by _onChangesCounted()
+                self._prefetchChanges(ctx.rev())
+                return labels
+            M, A, R = counts
+        else:
+            M, A, R = map(len, ctx.changesToParent(0))
         if A:
-            labels.append((str(len(A)), 'log.added'))
+            labels.append((str(A), 'log.added'))
         if M:
-            labels.append((str(len(M)), 'log.modified'))
+            labels.append((str(M), 'log.modified'))
         if R:
-            labels.append((str(len(R)), 'log.removed'))
+            labels.append((str(R), 'log.removed'))
         return labels
 
+    def _prefetchChanges(self, rev):
+        try:
+            row = self.graph.index(rev)
+        except ValueError:
+            return
+        clog = self.repo.changelog
+        revnodes = []
+        for i in pycompat.xrange(max(row - _CHANGES_PREFETCH, 0),
+                                 min(row + _CHANGES_PREFETCH + 1,
+                                     len(self.graph))):
+            rev, isunapplied = self.graph.getrevstate(i)
+            if isunapplied or not isinstance(rev, int):
+                continue
+            revnodes.append((abs(i - row), rev, clog.node(rev)))
+        # nearest rows last, which are counted first
+        revnodes.sort(reverse=True)
+        self._changecounter.request([(r, n) for _d, r, n in revnodes])
+
+    @pyqtSlot(object)
+    def _onChangesCounted(self, revnodes):
+        clog = self.repo.changelog
+        rows = []
+        for rev, node in revnodes:
+            try:
+                row = self.graph.index(rev)
+                if clog.node(rev) != node:
+                    continue
+            except (ValueError, IndexError, error.LookupError):
+                continue
+            if row < len(self._cache):
+                self._cache[row].pop((LabelsRole, ChangesColumn), None)
+            rows.append(row)
+        if not rows:
+            return
+        self.dataChanged.emit(self.index(min(rows), ChangesColumn),
+                              self.index(max(rows), ChangesColumn))
+
+    def _displaytext(self, ctx, column):
+        textfunc = self._columnmap.get(column)
+        if textfunc is None:
+            return None
+        text = textfunc(self, ctx)
+        if not isinstance(text, pycompat.unicode):
+            text = hglib.tounicode(text)
+        return text
+
     def _getconv(self, ctx):
         if ctx.rev() is not None:
             extra = ctx.extra()
@@ -928,6 +1371,9 @@ class FileRevModel(HgRepoListModel):
     def _hasFileColumn(self):
         return True
 
+    def _repoState(self):
+        return None
+
     def _createGraph(self):
         grapher = graph.filelog_grapher(self.repo, self._filename)
         return graph.Graph(self.repo, grapher)
@@ -1342,8 +1342,12 @@ def tag(ui, repoagent, *pats, **opts):
      (b'',  b'remove', None, _('remove the status cache')),
      (b's', b'show', None, _('show the contents of the status cache '
                              '(no update)')),
-     (b'',  b'all', None, _('update all repos in current dir'))],
-    _('thg thgstatus [OPTION]'))
+     (b'',  b'all', None, _('update all repos in current dir')),
+     (b'j', b'jobs', 0, _('number of processes updating repos with --all '
+                          '(default: number of CPUs)')),
+     (b'',  b'serve', None, _('run status service for file managers '
+                              'until idle'))],
+    _('thg thgstatus [OPTION]... [CHANGED_PATH]...'))
 def thgstatus(ui, *pats, **opts):
     """update TortoiseHg status cache"""
     from tortoisehg.util import thgstatus as thgstatusmod
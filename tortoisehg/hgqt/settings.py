@@ -685,6 +685,26 @@ INFO = (
         (genDefaultCombo, ['always', 'localonly', 'never']),
         _('Specify the target filesystem where TortoiseHg monitors changes. '
           'Default: localonly')),
+    _fi(_('Monitor Backend'), 'tortoisehg.monitorbackend',
+        (genDefaultCombo, ['auto', 'stat']),
+        _('Specify how TortoiseHg detects changes of monitored repositories. '
+          '"auto" uses inotify on Linux and falls back to checking the '
+          'repository files by stat. "stat" always checks the files by stat '
+          'when the filesystem watcher reports a change. '
+          'Default: auto')),
+    _fi(_('Monitor Delay'), 'tortoisehg.monitordebounce', genIntEditCombo,
+        _('Time in milliseconds for which changes reported by inotify are '
+          'collected before the repositories are checked. Longer delay '
+          'reduces the number of checks while files are being written. '
+          'Default: 100'),
+        globalonly=True),
+    _fi(_('Monitor Working Directory'), 'tortoisehg.monitorworkingdir',
+        genBoolRBGroup,
+        _('Watch all directories of the working directory by inotify while '
+          'the repository is monitored, so that refreshing the status list '
+          'only checks the files changed since the last refresh. Every '
+          'directory, including ignored ones, takes an inotify watch. Not '
+          'used if the fsmonitor extension is enabled. Default: False')),
     _fi(_('Max Diff Size'), 'tortoisehg.maxdiff', genIntEditCombo,
         _('The maximum size file (in KB) that TortoiseHg will '
           'show changes for in the changelog, status, and commit windows. '
@@ -813,6 +833,23 @@ INFO = (
           '<b>Note</b>: This layouter colors edges using branch information '
           'and does not display graft edges, regardless of whether they are '
           'requested or not.')),
+    _fi(_('Compute graph in background'), 'tortoisehg.graphthread',
+        genBoolRBGroup,
+        _('Compute the layout of the revision graph in a background thread, '
+          'so the log view stays responsive while loading large '
+          'repositories. The computed layout is cached under .hg/cache, '
+          'so only new revisions are laid out next time. Default: False<p>'
+          '<b>Note</b>: This layouter is not used when displaying graft '
+          'edges or filtering by revision set.')),
+    _fi(_('Index file contents for search'), 'tortoisehg.grepindex',
+        genBoolRBGroup,
+        _('Maintain an index of trigrams found in the file revisions under '
+          '.hg/cache, so the search tool only reads files which may match '
+          'the pattern. The index is updated with new revisions when '
+          'searching. Default: False<p>'
+          '<b>Note</b>: The index and its memory usage may be larger than '
+          'the repository store, and building it for the first time takes '
+          'a while.')),
     )),
 ({'name': 'commit', 'label': _('Commit', 'config item'), 'icon': 'hg-commit'},
  (
@@ -56,6 +56,7 @@ from mercurial import (
     context,
     error,
     hg,
+    match as matchmod,
     pycompat,
     scmutil,
     util,
@@ -119,6 +120,9 @@ class StatusWidget(QWidget):
         self.pctx = None
         self.savechecks = True
         self.refthread = None
+        # (status options, last status, dirstate stat) to be updated by
+        # changes reported by WorkingDirFeed
+        self._statusbase = None
         self.refreshWctxLater = QTimer(self, interval=10, singleShot=True)
         self.refreshWctxLater.timeout.connect(self.refreshWctx)
         self.partials = {}
@@ -432,7 +436,13 @@ class StatusWidget(QWidget):
             self.checkAllNoneBtn.setEnabled(False)
         self.refreshBtn.setEnabled(False)
         self.progress.emit(*cmdui.startProgress(_('Refresh'), _('status')))
-        self.refthread = StatusThread(self.repo, self.pctx, self.pats, self.opts)
+        changes = None
+        feed = self._repoagent.workingDirFeed()
+        if feed:
+            # start tracking changes for the next refresh
+            changes = feed.takeChanges(self)
+        self.refthread = StatusThread(self.repo, self.pctx, self.pats,
+                                      self.opts, self._statusbase, changes)
         self.refthread.finished.connect(self.reloadComplete)
         self.refthread.showMessage.connect(self.reloadFailed)
         self.refthread.start()
@@ -448,6 +458,7 @@ class StatusWidget(QWidget):
             assert self.refthread.wstatus is not None
             self.updateModel(self.refthread.wctx, self.refthread.wstatus,
                              self.refthread.patchecked, self.refthread.amending)
+        self._statusbase = self.refthread.statusbase
         self.refthread = None
         if len(self.repo[None].parents()) > 1:
             # nuke partial selections if wctx has a merge in-progress
@@ -690,22 +701,64 @@ class StatusWidget(QWidget):
             model.setData(index, newvalue, Qt.CheckStateRole)
 
 
+def _dirstatestat(repo):
+    try:
+        st = os.stat(repo.vfs.join(b'dirstate'))
+    except OSError:
+        return None
+    return (st.st_size, st.st_ino, st.st_ctime, st.st_mtime)
+
+def _changesmatcher(repo, files, dirs):
+    matchers = []
+    if files:
+        matchers.append(matchmod.exact(sorted(files)))
+    if dirs:
+        pats = [b'path:' + d for d in sorted(dirs)]
+        matchers.append(matchmod.match(repo.root, b'', pats))
+    if len(matchers) == 1:
+        return matchers[0]
+    return matchmod.unionmatcher(matchers)
+
 class StatusThread(QThread):
-    '''Background thread for generating a workingctx'''
+    '''Background thread for generating a workingctx
+
+    If the last status (base) and the paths changed since then are given,
+    only these paths are checked unless the dirstate has been modified.
+    '''
 
     showMessage = pyqtSignal(str)
 
-    def __init__(self, repo, pctx, pats, opts, parent=None):
+    def __init__(self, repo, pctx, pats, opts, base=None, changes=None,
+                 parent=None):
         super(StatusThread, self).__init__()
         self.repo = hg.repository(repo.ui, repo.root)
         self.pctx = pctx
         self.pats = pats
         self.opts = opts
+        self.base = base
+        self.changes = changes
         self.wctx = None
         self.wstatus = None
+        self.statusbase = None
         self.patchecked = {}
         self.amending = set()
 
+    def _incrementalstatus(self, stopts, dsstat):
+        if not self.base or self.changes is None or dsstat is None:
+            return None
+        key, basestatus, basedsstat = self.base
+        if key != sorted(stopts.items()) or basedsstat != dsstat:
+            return None
+        if b'largefiles' in self.repo.requirements:
+            return None  # status of standins can't be narrowed
+        files, dirs = self.changes
+        if not files and not dirs:
+            return scmutil.status(*[list(l) for l in basestatus])
+        m = _changesmatcher(self.repo, files, dirs)
+        status = self.repo.status(match=m, **stopts)
+        return scmutil.status(*[[f for f in old if not m(f)] + list(new)
+                                for old, new in zip(basestatus, status)])
+
     def run(self):
         extract = lambda x, y: dict(zip(x, pycompat.maplist(y.get, x)))
         stopts = extract(('unknown', 'ignored', 'clean'), self.opts)
@@ -756,8 +809,15 @@ class StatusThread(QThread):
 
                 wctx = context.workingctx(self.repo, changes=status)
             else:
-                with lfutil.lfstatus(self.repo):
-                    status = self.repo.status(**stopts)
+                dsstat = _dirstatestat(self.repo)
+                status = self._incrementalstatus(stopts, dsstat)
+                if status is None:
+                    with lfutil.lfstatus(self.repo):
+                        status = self.repo.status(**stopts)
+                # status may update dirstate, or it may be updated by
+                # another process meanwhile
+                if dsstat is not None and dsstat == _dirstatestat(self.repo):
+                    self.statusbase = (sorted(stopts.items()), status, dsstat)
                 wctx = context.workingctx(self.repo, changes=status)
             self.wctx = wctx
             self.wstatus = status
@@ -38,6 +38,7 @@ from mercurial import (
     node,
     pycompat,
     subrepo,
+    util,
 )
 
 from ..util import (
@@ -47,6 +48,7 @@ from ..util import (
 from ..util.patchctx import patchctx
 from . import (
     cmdcore,
+    fsmonitor,
     hgconfig,
 )
 
@@ -108,7 +110,14 @@ _PollStatusPending = 0x4
 
 
 class RepoWatcher(QObject):
-    """Notify changes of repository by optionally monitoring filesystem"""
+    """Notify changes of repository by optionally monitoring filesystem
+
+    On Linux, .hg and .hg/store are watched by inotify through
+    FileSystemMonitor, which may be shared with other watchers, and only the
+    files reported by the monitor are examined.  Otherwise,
+    QFileSystemWatcher tells that something changed, and all known files are
+    checked by stat.
+    """
 
     configChanged = pyqtSignal()
     repositoryChanged = pyqtSignal(int)
@@ -119,6 +128,10 @@ class RepoWatcher(QObject):
         self._repo = repo
         self._ui = repo.ui
         self._fswatcher = None
+        self._monitor = None  # fsmonitor.FileSystemMonitor
+        self._ownsmonitor = False
+        self._inotifying = False
+        self._dirtypaths = set()  # paths reported by inotify, None if lost
         self._deferredpoll = 0  # _Poll* flags
         self._filesmap = {}  # path: (flag, watched)
         self._datamap = {}  # readmeth: (flag, dep-path)
@@ -129,6 +142,8 @@ class RepoWatcher(QObject):
 
     def startMonitoring(self):
         """Start filesystem monitoring to notify changes automatically"""
+        if self._startInotify():
+            return
         if not self._fswatcher:
             self._fswatcher = QFileSystemWatcher(self)
             self._fswatcher.directoryChanged.connect(self._onFsChanged)
@@ -144,6 +159,9 @@ class RepoWatcher(QObject):
         This will release OS resources held by filesystem watcher, so good
         for disabling change notification for a long time.
         """
+        if self._inotifying:
+            self._monitor.unwatchAll(self)
+            self._inotifying = False
         if not self._fswatcher:
             return
         self._fswatcher.blockSignals(True)  # ignore pending events
@@ -164,10 +182,51 @@ class RepoWatcher(QObject):
 
     def isMonitoring(self):
         """True if filesystem monitor is running"""
+        if self._inotifying:
+            return True
         if not self._fswatcher:
             return False
         return not self._fswatcher.signalsBlocked()
 
+    def setFileSystemMonitor(self, monitor):
+        """Use the given FileSystemMonitor instead of creating own one"""
+        if self._monitor is monitor:
+            return
+        monitoring = self._inotifying
+        self.stopMonitoring()
+        if self._ownsmonitor:
+            self._monitor.close()
+            self._monitor.deleteLater()
+            self._ownsmonitor = False
+        self._monitor = monitor
+        if monitoring:
+            self.startMonitoring()
+
+    def fileSystemMonitor(self):
+        """FileSystemMonitor in use, or None if monitored by stat"""
+        if self._inotifying:
+            return self._monitor
+
+    def _startInotify(self):
+        if self._ui.config(b'tortoisehg', b'monitorbackend') == b'stat':
+            return False
+        if not self._monitor:
+            self._monitor = fsmonitor.createMonitor(self._ui, self)
+            if not self._monitor:
+                return False
+            self._ownsmonitor = True
+        # changes can't be caught without .hg watched, e.g. because
+        # fs.inotify.max_user_watches is reached
+        if not self._monitor.watchDirectory(self, self._repo.path):
+            self._ui.debug(b'cannot watch %s by inotify\n' % self._repo.path)
+            self._monitor.unwatchAll(self)
+            return False
+        self._inotifying = True
+        # changes made while not monitored
+        self._dirtypaths = None
+        self._addMissingPaths()
+        return True
+
     def resumeStatusPolling(self):
         """Execute deferred status checks to emit notification signals"""
         self._deferredpoll &= ~_PollDeferred
@@ -186,6 +245,27 @@ class RepoWatcher(QObject):
         """
         self._deferredpoll |= _PollDeferred
 
+    def notifyPathsChanged(self, changedpaths):
+        """Called by FileSystemMonitor with changed paths, or None if
+        unknown"""
+        if changedpaths is None:
+            self._dirtypaths = None
+        else:
+            changedpaths = self._relevantPaths(changedpaths)
+            if not changedpaths:
+                return
+            if self._dirtypaths is not None:
+                self._dirtypaths.update(changedpaths)
+        self._onFsChanged()
+
+    def _relevantPaths(self, changedpaths):
+        # directories of config files (e.g. $HOME) are watched as a whole
+        repodirs = {self._repo.path, self._repo.spath}
+        uifiles = self._uifiles()
+        return set(p for p in changedpaths
+                   if p in self._filesmap or p in uifiles or p in repodirs
+                   or os.path.dirname(p) in repodirs)
+
     @pyqtSlot()
     def _onFsChanged(self):
         if self._deferredpoll:
@@ -197,13 +277,30 @@ class RepoWatcher(QObject):
     def _pollFsChanges(self):
         '''Catch writes or deletions of files, or writes to .hg/ folder,
         most importantly lock files'''
-        self._pollStatus()
+        self._pollStatus(self._inotifying)
         # filesystem monitor may be stopped inside _pollStatus()
         if self.isMonitoring():
             self._addMissingPaths()
 
+    def _watchedDirectories(self):
+        repo = self._repo
+        dirs = {repo.path, repo.spath}
+        dirs.update(os.path.dirname(f) for f in self._filesmap)
+        dirs.update(os.path.dirname(f) for f in self._uifiles())
+        return dirs
+
+    def _uifiles(self):
+        files = set(f for f in self._repo.uifiles() if f)
+        files.add(self._repo.vfs.join(b'hgrc'))
+        return files
+
     def _addMissingPaths(self):
         'Add files to watcher that may have been added or replaced'
+        if self._inotifying:
+            for d in self._watchedDirectories():
+                if not self._monitor.isWatching(self, d):
+                    self._monitor.watchDirectory(self, d)
+            return
         existing = [f for f, (_flag, watched) in self._filesmap.items()
                     if watched and f in self._laststats]
         files = [pycompat.unicode(f) for f in self._fswatcher.files()]
@@ -217,6 +314,7 @@ class RepoWatcher(QObject):
                 self._fswatcher.addPath(hglib.tounicode(f))
 
     def clearStatus(self):
+        self._dirtypaths = None
         self._laststats.clear()
         self._lastdata.clear()
 
@@ -227,7 +325,7 @@ class RepoWatcher(QObject):
             return
         self._pollStatus()
 
-    def _pollStatus(self):
+    def _pollStatus(self, onlydirty=False):
         if not os.path.exists(self._repo.path):
             self._ui.debug(b'repository destroyed: %s\n' % self._repo.root)
             self.repositoryDestroyed.emit()
@@ -235,18 +333,26 @@ class RepoWatcher(QObject):
         if self._locked():
             self._ui.debug(b'locked, aborting\n')
             return
-        curstats, curdata = self._readState()
-        changeflags = self._calculateChangeFlags(curstats, curdata)
+        # paths reported by inotify are kept until examined without lock
+        dirtypaths = self._dirtypaths
+        if not onlydirty or dirtypaths is None:
+            targetpaths = None
+        else:
+            targetpaths = dirtypaths.intersection(self._filesmap)
+        curstats, curdata = self._readState(targetpaths)
+        changeflags = self._calculateChangeFlags(curstats, curdata,
+                                                 targetpaths)
         if self._locked():
             self._ui.debug(b'lock still held - ignoring for now\n')
             return
-        self._laststats = curstats
-        self._lastdata = curdata
+        self._dirtypaths = set()
+        self._updateState(curstats, curdata, targetpaths)
         if changeflags:
             self._ui.debug(b'change found (flags = 0x%x)\n' % changeflags)
             self.repositoryChanged.emit(changeflags)  # may update repo paths
             self._fixState()
-        self._checkuimtime()
+        if targetpaths is None or not dirtypaths.isdisjoint(self._uifiles()):
+            self._checkuimtime()
 
     def _locked(self):
         if os.path.lexists(self._repo.vfs.join(b'wlock')):
@@ -322,15 +428,37 @@ class RepoWatcher(QObject):
 
         return curstats, curdata
 
-    def _calculateChangeFlags(self, curstats, curdata):
+    def _updateState(self, curstats, curdata, targetpaths=None):
+        if targetpaths is None:
+            self._laststats = curstats
+            self._lastdata = curdata
+            return
+        for path in targetpaths:
+            if path in curstats:
+                self._laststats[path] = curstats[path]
+            else:
+                self._laststats.pop(path, None)
+        for readmeth, (_flag, path) in self._datamap.items():
+            if path not in targetpaths:
+                continue
+            if readmeth in curdata:
+                self._lastdata[readmeth] = curdata[readmeth]
+            else:
+                self._lastdata.pop(readmeth, None)
+
+    def _calculateChangeFlags(self, curstats, curdata, targetpaths=None):
         changeflags = 0
         for path, (flag, _watched) in self._filesmap.items():
+            if targetpaths is not None and path not in targetpaths:
+                continue
             last = self._laststats.get(path)
             cur = curstats.get(path)
             if last != cur:
                 self._ui.debug(b' stat: %s (%r -> %r)\n' % (path, last, cur))
                 changeflags |= flag
-        for readmeth, (flag, _path) in self._datamap.items():
+        for readmeth, (flag, path) in self._datamap.items():
+            if targetpaths is not None and path not in targetpaths:
+                continue
             last = self._lastdata.get(readmeth)
             cur = curdata.get(readmeth)
             if last != cur:
@@ -403,6 +531,7 @@ class RepoAgent(QObject):
         cmdagent.commandFinished.connect(self._onCommandFinished)
 
         self._subrepoagents = {}  # path: agent
+        self._wdfeed = None
 
     def startMonitoringIfEnabled(self):
         """Start filesystem monitoring on repository open by RepoManager"""
@@ -417,11 +546,41 @@ class RepoAgent(QObject):
         else:
             self._watcher.startMonitoring()
 
+    def setFileSystemMonitor(self, monitor):
+        """Share FileSystemMonitor with other agents"""
+        self._stopWorkingDirFeed()
+        self._watcher.setFileSystemMonitor(monitor)
+
+    def workingDirFeed(self):
+        """WorkingDirFeed to track changed files in working directory, or
+        None if not available"""
+        if self._wdfeed:
+            return self._wdfeed
+        monitor = self._watcher.fileSystemMonitor()
+        repo = self._repo
+        if not monitor or not self.configBool('tortoisehg',
+                                              'monitorworkingdir'):
+            return None
+        if util.safehasattr(repo, '_fsmonitorstate'):
+            # status is already narrowed by watchman
+            return None
+        self._wdfeed = fsmonitor.WorkingDirFeed(monitor, repo.root, repo.ui,
+                                                self)
+        return self._wdfeed
+
+    def _stopWorkingDirFeed(self):
+        if not self._wdfeed:
+            return
+        self._wdfeed.stop()
+        self._wdfeed.setParent(None)
+        self._wdfeed = None
+
     def isServiceRunning(self):
         return self._watcher.isMonitoring() or self._cmdagent.isServiceRunning()
 
     def stopService(self):
         """Shut down back-end services on repository closed by RepoManager"""
+        self._stopWorkingDirFeed()
         if self._watcher.isMonitoring():
             self._watcher.stopMonitoring()
             self._tryEmitServiceStopped()
@@ -434,6 +593,7 @@ class RepoAgent(QObject):
 
     def suspendMonitoring(self):
         """Stop filesystem monitoring and release OS resources"""
+        self._stopWorkingDirFeed()
         self._watcher.stopMonitoring()
 
     def resumeMonitoring(self):
@@ -568,6 +728,7 @@ class RepoAgent(QObject):
         if self._repo.root in _repocache:
             del _repocache[self._repo.root]
         # avoid further changed/destroyed signals
+        self._stopWorkingDirFeed()
         self._watcher.stopMonitoring()
         self.repositoryDestroyed.emit()
 
@@ -684,6 +845,8 @@ class RepoManager(QObject):
         self._ui = ui
         self._openagents = {}  # path: (agent, refcount)
         # refcount=0 means the repo is about to be closed
+        self._fsmonitor = None
+        self._fsmonitorcreated = False
 
         self._sigmappers = []
         for _sig, slot in self._SIGNALMAP:
@@ -709,6 +872,7 @@ class RepoManager(QObject):
             mapper.setMapping(agent, agent.rootPath())
         agent.repositoryChanged.connect(self._mapRepositoryChanged)
         agent.progressReceived.connect(self._mapProgressReceived)
+        agent.setFileSystemMonitor(self._fileSystemMonitor())
         agent.startMonitoringIfEnabled()
 
         assert agent.rootPath() == path
@@ -749,9 +913,17 @@ class RepoManager(QObject):
             mapper.removeMappings(agent)
         agent.repositoryChanged.disconnect(self._mapRepositoryChanged)
         agent.progressReceived.disconnect(self._mapProgressReceived)
+        agent.setFileSystemMonitor(None)
         agent.setParent(None)
         self.repositoryClosed.emit(path)
 
+    def _fileSystemMonitor(self):
+        # one inotify instance for all repositories; None if unsupported
+        if not self._fsmonitorcreated:
+            self._fsmonitor = fsmonitor.createMonitor(self._ui, self)
+            self._fsmonitorcreated = True
+        return self._fsmonitor
+
     def repoAgent(self, path):
         """Peek open RepoAgent for the specified path without refcount change;
         None for unknown path"""
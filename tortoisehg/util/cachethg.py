@@ -5,7 +5,9 @@
 # This software may be used and distributed according to the terms of the
 # GNU General Public License version 2, incorporated herein by reference.
 
+import collections
 import os
+import stat
 import sys
 
 from mercurial import hg, node, error, pycompat, scmutil
@@ -62,11 +64,42 @@ NOT_IN_REPO = ' '
 ROOT = "r"
 UNRESOLVED = 'U'
 
-# file status cache
-overlay_cache = {}
-cache_tick_count = 0
-cache_root = None
-cache_pdir = None
+# file status cache; (root, pdir): _CacheEntry, least recently used first
+_overlay_cache = collections.OrderedDict()
+_cached_paths = 0
+_CACHE_ENTRIES = 32
+_CACHE_PATHS = 200000
+
+# pdir: (root, tick) of recently looked up directories
+_root_cache = {}
+_ROOT_CACHE_SIZE = 1000
+
+# repositories opened by get_states(), least recently used first
+_repo_cache = collections.OrderedDict()
+_REPO_CACHE_SIZE = 4
+
+# entries are revalidated by stat at most once per CACHE_RECHECK, and
+# discarded after CACHE_MAXAGE even if nothing seems changed.  states of
+# subdirectories aren't validated by stat, so they are trusted only for
+# CACHE_TIMEOUT
+CACHE_RECHECK = CACHE_TIMEOUT / 50
+CACHE_MAXAGE = CACHE_TIMEOUT * 60
+
+
+class _CacheEntry(object):
+    """States of paths under a directory and stats to validate them"""
+
+    def __init__(self, states, repostamp, dirstat, stats, subdirs, tick):
+        self.states = states
+        self.repostamp = repostamp
+        self.dirstat = dirstat
+        self.stats = stats  # path: stat of direct children of pdir
+        self.subdirs = subdirs  # paths of direct subdirectories of pdir
+        self.tick = tick
+        self.checked = tick
+
+    def size(self):
+        return len(self.states) + len(self.stats)
 
 
 def add_dirs(list):
@@ -95,128 +128,251 @@ def get_states(path, repo=None):
     """
     Get the states of a given path in source control.
     """
-    global overlay_cache, cache_tick_count
-    global cache_root, cache_pdir
-    global enabled, localonly
-    global includepaths, excludepaths
-
-    #debugf("called: _get_state(%s)", path)
     tc = GetTickCount()
 
-    # check if path is cached
-    pdir = os.path.dirname(path)
-    status = overlay_cache.get(path, '')
-    if overlay_cache and (cache_pdir == pdir or cache_pdir and
-              status not in ' r' and path.startswith(cache_pdir)):
-        #use cached data when pdir has not changed or when the cached state is a repo state
-        if tc - cache_tick_count < CACHE_TIMEOUT:
-            if not status:
-                if os.path.isdir(os.path.join(path, '.hg')):
-                    add(path, ROOT)
-                    status = ROOT
-                else:
-                    status = overlay_cache.get(pdir + '*', NOT_IN_REPO)
-                    add(path, status)
-                debugf("%s: %s (cached~)", (path, status))
-            else:
-                debugf("%s: %s (cached)", (path, status))
-            return status
-        else:
-            debugf("Timed out!!")
-            overlay_cache.clear()
-            cache_tick_count = GetTickCount()
-     # path is a drive
+    # path is a drive
     if path.endswith(":\\"):
-        add(path, NOT_IN_REPO)
         return NOT_IN_REPO
-     # open repo
-    if cache_pdir == pdir:
-        root = cache_root
-    else:
-        debugf("find new root")
-        root = paths.find_root(path)
-        if root == path:
-            if not overlay_cache:
-                cache_root = pdir
-            add(path, ROOT)
-            debugf("%s: r", path)
-            return ROOT
-        cache_root = root
-        cache_pdir = pdir
 
+    pdir = os.path.dirname(path)
+    root = _find_root(pdir, tc)
     if root is None:
+        if os.path.isdir(os.path.join(path, '.hg')):
+            debugf("%s: r", path)
+            return ROOT
         debugf("_get_state: not in repo")
-        overlay_cache = {None: None}
-        cache_tick_count = GetTickCount()
         return NOT_IN_REPO
-    debugf("_get_state: root = " + root)
-    hgdir = os.path.join(root, '.hg', '')
-    if pdir == hgdir[:-1] or pdir.startswith(hgdir):
-        add(pdir, NOT_IN_REPO)
+    if is_in_hgdir(root, pdir):
+        return NOT_IN_REPO
+    if is_excluded(path):
         return NOT_IN_REPO
+
+    entry = _overlay_cache.pop((root, pdir), None)
+    if entry is not None:
+        if _is_valid(entry, root, pdir, path, tc):
+            _overlay_cache[(root, pdir)] = entry  # most recently used
+            status = lookup_state(entry.states, path)
+            debugf("%s: %s (cached)", (path, status))
+            return status
+        debugf("%s: cache outdated", pdir)
+        _discard(entry)
+        # states of the parent directories may be changed as well
+        _invalidate_parents(root, pdir)
+
     try:
-        if not enabled:
-            overlay_cache = {None: None}
-            cache_tick_count = GetTickCount()
-            debugf("overlayicons disabled")
-            return NOT_IN_REPO
-        if localonly and not paths.is_on_fixed_drive(path):
-            debugf("%s: is a network drive", path)
-            overlay_cache = {None: None}
-            cache_tick_count = GetTickCount()
-            return NOT_IN_REPO
-        if includepaths:
-            for p in includepaths:
-                if path.startswith(p):
-                    break
-            else:
-                debugf("%s: is not in an include path", path)
-                overlay_cache = {None: None}
-                cache_tick_count = GetTickCount()
-                return NOT_IN_REPO
-        for p in excludepaths:
-            if path.startswith(p):
-                debugf("%s: is in an exclude path", path)
-                overlay_cache = {None: None}
-                cache_tick_count = GetTickCount()
-                return NOT_IN_REPO
         tc1 = GetTickCount()
         real = os.path.realpath #only test if necessary (symlink in path)
         hgroot = hglib.fromunicode(root)
         if not repo or (repo.root != hgroot and repo.root != real(hgroot)):
-            repo = hg.repository(hglib.loadui(), path=hgroot)
+            repo = _open_repo(root)
             debugf("hg.repository() took %g ticks", (GetTickCount() - tc1))
     except error.RepoError:
         # We aren't in a working tree
         debugf("%s: not in repo", pdir)
-        add(pdir + '*', IGNORED)
         return IGNORED
     except Exception as e:
         debugf("error while handling %s:", pdir)
         debugf(e)
-        add(pdir + '*', UNKNOWN)
         return UNKNOWN
 
-     # get file status
-    tc1 = GetTickCount()
-
+    # take stats before status so changes made meanwhile invalidate the entry
+    repostamp = _repo_stamp(root)
+    dirstat = _stat(pdir)
+    stats, subdirs = _child_stats(pdir)
     try:
-        matcher = scmutil.match(repo[None], [hglib.fromunicode(pdir)])
-        repostate = repo.status(match=matcher, ignored=True,
-                        clean=True, unknown=True)
+        states = dir_states(repo, root, pdir)
     except error.Abort as inst:
         debugf("abort: %s", inst)
         debugf("treat as unknown : %s", path)
         return UNKNOWN
+    _store((root, pdir), _CacheEntry(states, repostamp, dirstat, stats,
+                                     subdirs, GetTickCount()))
+    status = lookup_state(states, path)
+    debugf("%s: %s", (path, status))
+    return status
+
+
+def invalidate(path):
+    """
+    Discard cached states of the path and the directories containing it.
+    """
+    for key in list(_overlay_cache):
+        root, pdir = key
+        if path == pdir or path.startswith(os.path.join(pdir, '')):
+            _discard(_overlay_cache.pop(key))
+
+
+def _invalidate_parents(root, pdir):
+    while pdir != root:
+        parent = os.path.dirname(pdir)
+        if parent == pdir:
+            break
+        pdir = parent
+        entry = _overlay_cache.pop((root, pdir), None)
+        if entry is not None:
+            _discard(entry)
+
+
+def clear():
+    """
+    Discard all cached states.
+    """
+    global _cached_paths
+    _overlay_cache.clear()
+    _root_cache.clear()
+    _repo_cache.clear()
+    _cached_paths = 0
+
 
+def _find_root(pdir, tc):
+    cached = _root_cache.get(pdir)
+    if cached is not None and tc - cached[1] < CACHE_TIMEOUT:
+        return cached[0]
+    debugf("find new root")
+    root = paths.find_root(pdir)
+    if len(_root_cache) >= _ROOT_CACHE_SIZE:
+        _root_cache.clear()
+    _root_cache[pdir] = (root, tc)
+    return root
+
+
+def _open_repo(root):
+    repo = _repo_cache.pop(root, None)
+    if repo is None:
+        repo = hg.repository(hglib.loadui(), path=hglib.fromunicode(root))
+        if len(_repo_cache) >= _REPO_CACHE_SIZE:
+            _repo_cache.popitem(last=False)
+    else:
+        # dirstate may be changed since it was read
+        repo.invalidate()
+        repo.invalidatedirstate()
+    _repo_cache[root] = repo
+    return repo
+
+
+def _stat(path):
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return None
+    return (st.st_mtime, st.st_size)
+
+
+def _repo_stamp(root):
+    """Stats of files changed by commands which may change the states"""
+    hgdir = os.path.join(root, '.hg')
+    return (_stat(os.path.join(hgdir, 'dirstate')),
+            _stat(os.path.join(hgdir, 'merge', 'state2')),
+            _stat(os.path.join(hgdir, 'merge', 'state')))
+
+
+def _child_stats(pdir):
+    stats = {}
+    subdirs = set()
+    try:
+        names = os.listdir(pdir)
+    except OSError:
+        return stats, subdirs
+    for name in names:
+        path = os.path.join(pdir, name)
+        try:
+            st = os.lstat(path)
+        except OSError:
+            stats[path] = None
+            continue
+        stats[path] = (st.st_mtime, st.st_size)
+        if stat.S_ISDIR(st.st_mode):
+            subdirs.add(path)
+    return stats, subdirs
+
+
+def _is_valid(entry, root, pdir, path, tc):
+    if tc - entry.tick >= CACHE_MAXAGE:
+        return False
+    # files may be modified in place under the subdirectory
+    if path in entry.subdirs and tc - entry.tick >= CACHE_TIMEOUT:
+        return False
+    if tc - entry.checked >= CACHE_RECHECK:
+        # files added or removed in pdir, or dirstate updated by commands
+        if (entry.dirstat != _stat(pdir)
+            or entry.repostamp != _repo_stamp(root)):
+            return False
+        entry.checked = tc
+    # file modified in place
+    return entry.stats.get(path) == _stat(path)
+
+
+def lookup_state(states, path):
+    """
+    Get the states of a given path from the dict built by dir_states().
+    """
+    status = states.get(path)
+    if status:
+        return status
+    if os.path.isdir(os.path.join(path, '.hg')):
+        return ROOT  # nested repository isn't listed by status
+    return NOT_IN_REPO
+
+
+def _store(key, entry):
+    global _cached_paths
+    _overlay_cache[key] = entry
+    _cached_paths += entry.size()
+    while len(_overlay_cache) > 1 and (len(_overlay_cache) > _CACHE_ENTRIES
+                                       or _cached_paths > _CACHE_PATHS):
+        _key, oldentry = _overlay_cache.popitem(last=False)
+        _discard(oldentry)
+
+
+def _discard(entry):
+    global _cached_paths
+    _cached_paths -= entry.size()
+
+
+def is_in_hgdir(root, path):
+    """Whether the path is the .hg directory of the root or in it"""
+    hgdir = os.path.join(root, '.hg', '')
+    return path == hgdir[:-1] or path.startswith(hgdir)
+
+
+def is_excluded(path):
+    """Whether overlay icons are disabled for the path by configuration"""
+    if not enabled:
+        debugf("overlayicons disabled")
+        return True
+    if localonly and not paths.is_on_fixed_drive(path):
+        debugf("%s: is a network drive", path)
+        return True
+    if includepaths:
+        for p in includepaths:
+            if path.startswith(p):
+                break
+        else:
+            debugf("%s: is not in an include path", path)
+            return True
+    for p in excludepaths:
+        if path.startswith(p):
+            debugf("%s: is in an exclude path", path)
+            return True
+    return False
+
+
+def dir_states(repo, root, pdir):
+    """
+    Get the states of the files and directories under pdir as a dict
+    {path: states}.  Raises error.Abort if status can't be computed.
+    """
+    tc1 = GetTickCount()
+    matcher = scmutil.match(repo[None], [hglib.fromunicode(pdir)])
+    repostate = repo.status(match=matcher, ignored=True,
+                    clean=True, unknown=True)
     debugf("status() took %g ticks", (GetTickCount() - tc1))
     mergestate = repo.dirstate.parents()[1] != node.nullid
 
     # cached file info
-    tc = GetTickCount()
-    overlay_cache = {}
-    add(root, ROOT)
-    add(os.path.join(root, '.hg'), NOT_IN_REPO)
+    cache = {}
+    _add(cache, root, ROOT)
+    _add(cache, os.path.join(root, '.hg'), NOT_IN_REPO)
     states = STATUS_STATES
     if mergestate:
         mstate = hglib.readmergestate(repo)
@@ -237,12 +393,10 @@ def get_states(path, repo=None):
         add_dirs(grp)
         for f in grp:
             fpath = os.path.join(root, os.path.normpath(hglib.tounicode(f)))
-            add(fpath, st)
-    status = overlay_cache.get(path, UNKNOWN)
-    debugf("%s: %s", (path, status))
-    cache_tick_count = GetTickCount()
-    return status
+            _add(cache, fpath, st)
+    return cache
+
 
+def _add(cache, path, state):
+    cache[path] = cache.get(path, '') + state
 
-def add(path, state):
-    overlay_cache[path] = overlay_cache.get(path, '') + state
@@ -37,7 +37,9 @@ configitem(b'tortoisehg', b'changeset.link', default=None)
 configitem(b'tortoisehg', b'ciexclude', default=b'')
 configitem(b'tortoisehg', b'cipushafter', default=None)
 configitem(b'tortoisehg', b'closeci', default=False)
+configitem(b'tortoisehg', b'cmdserver.idletimeout', default=60)
 configitem(b'tortoisehg', b'cmdserver.readtimeout', default=30)
+configitem(b'tortoisehg', b'cmdserver.readworkers', default=2)
 configitem(b'tortoisehg', b'confirmaddfiles', default=True)
 configitem(b'tortoisehg', b'confirmdeletefiles', default=True)
 configitem(b'tortoisehg', b'confirmpush', default=True)
@@ -57,6 +59,8 @@ configitem(b'tortoisehg', b'fullauthorname', default=False)
 configitem(b'tortoisehg', b'fullpath', default=False)
 configitem(b'tortoisehg', b'graphlimit', default=500)
 configitem(b'tortoisehg', b'graphopt', default=False)
+configitem(b'tortoisehg', b'graphthread', default=False)
+configitem(b'tortoisehg', b'grepindex', default=False)
 configitem(b'tortoisehg', b'guifork', default=None)
 configitem(b'tortoisehg', b'hidetags', default=b'')
 configitem(b'tortoisehg', b'immediate', default=b'')
@@ -71,7 +75,10 @@ configitem(b'tortoisehg', b'issue.linkmandatory', default=False)
 configitem(b'tortoisehg', b'issue.regex', default=None)
 configitem(b'tortoisehg', b'longsummary', default=False)
 configitem(b'tortoisehg', b'maxdiff', default=None)
+configitem(b'tortoisehg', b'monitorbackend', default=b'auto')
+configitem(b'tortoisehg', b'monitordebounce', default=None)
 configitem(b'tortoisehg', b'monitorrepo', default=b'localonly')
+configitem(b'tortoisehg', b'monitorworkingdir', default=False)
 configitem(b'tortoisehg', b'opentabsaftercurrent', default=True)
 configitem(b'tortoisehg', b'postpull', default=None)
 configitem(b'tortoisehg', b'promoteditems', default=b'commit,log')
@@ -0,0 +1,498 @@
+# grepsearch.py - search file contents of a revision in parallel
+#
+# This software may be used and distributed according to the terms of the
+# GNU General Public License version 2 or any later version.
+
+"""search file contents of a revision or history in parallel
+
+The files or revisions to search are split into shards, which are processed
+by a pool of worker processes.  Each worker opens the repository once, and
+scans every file as a whole buffer with the pattern compiled in multiline
+mode, only splitting the lines containing a match.  Workers map working
+directory files into memory instead of reading them, but the calling process
+doesn't, since a file truncated while mapped would crash it by SIGBUS.  The
+matches of a shard are sent back to the caller at once, and the results are
+generated in the order of shards.
+
+Workers are fresh Python processes running _workermain(), which only import
+this module and Mercurial, as forking the multi-threaded GUI process isn't
+safe.  Shards and results are pickled through their stdin and stdout.
+Since a worker takes a while to start, small searches and frozen builds
+run in the calling process.
+"""
+
+from __future__ import absolute_import
+
+import difflib
+import mmap
+import multiprocessing
+import os
+import pickle
+import re
+import stat
+import subprocess
+import sys
+
+from mercurial import (
+    error,
+    hg,
+    match as matchmod,
+    pycompat,
+    scmutil,
+    util,
+)
+from mercurial.utils import (
+    procutil,
+    stringutil,
+)
+
+from . import hglib
+
+# number of files processed by a worker at a time
+_MAX_SHARD_FILES = 200
+
+# fewer files are searched in the calling process
+_MIN_PARALLEL_FILES = 2000
+
+# number of revisions processed by a worker at a time
+_MAX_SHARD_REVS = 256
+
+# fewer revisions are searched in the calling process
+_MIN_PARALLEL_REVS = 500
+
+# number of file revisions of which matched lines are kept by a worker
+_FILE_STATES_CACHE = 2000
+
+# whether working directory files are mapped into memory; only set in
+# worker processes, which may crash without taking down the GUI
+_mapfiles = False
+
+class _FileSearcher(object):
+    """Find matching lines in files of a revision (None for working dir)"""
+
+    def __init__(self, repo, rev, pattern, flags, once):
+        self.repo = repo
+        self.ctx = repo[rev]
+        self.regexp = re.compile(pattern, flags)
+        self.bufregexp = re.compile(pattern, flags | re.M)
+        # \A and \Z match at every line only if lines are searched separately
+        self.linebyline = bool(re.search(r'\\[AZ]',
+                                         pycompat.sysstr(pattern)))
+        self.once = once
+        # working files have to be read through the decode filters if any
+        self.readwdir = rev is None and not repo._decodefilterpats
+
+    def _readfile(self, wfile):
+        if not self.readwdir:
+            return self.ctx[wfile].data()
+        path = self.repo.wjoin(wfile)
+        st = os.lstat(path)
+        if stat.S_ISLNK(st.st_mode):
+            return os.readlink(path)
+        if not stat.S_ISREG(st.st_mode) or st.st_size == 0:
+            return b''
+        with open(path, 'rb') as fp:
+            if not _mapfiles:
+                return fp.read()
+            return mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def searchfile(self, wfile):
+        """Search the file; returns [(lineno, line, [(start, end), ...])]
+
+        Raises EnvironmentError if the file can't be read.
+        """
+        data = self._readfile(wfile)
+        try:
+            if data.find(b'\0') >= 0:
+                return []  # binary
+            if self.linebyline or data.find(b'\r') >= 0:
+                return self._searchlines(data[:])
+            return self._searchbuffer(data)
+        finally:
+            if isinstance(data, mmap.mmap):
+                data.close()
+
+    def _linematch(self, line):
+        spans = [m.span() for m in self.regexp.finditer(line)]
+        # as "hg grep", a line only having empty match at its start is
+        # not reported
+        if spans and spans[-1][1]:
+            return spans
+
+    def _searchlines(self, data):
+        found = []
+        for i, line in enumerate(data.splitlines()):
+            spans = self._linematch(line)
+            if spans:
+                found.append((i + 1, line, spans))
+                if self.once:
+                    break
+        return found
+
+    def _searchbuffer(self, buf):
+        """Search the buffer containing no CR at once, only splitting the
+        lines where the multiline pattern matches"""
+        found = []
+        end = len(buf)
+        pos = 0
+        lineno = 1
+        linepos = 0  # start of the line numbered lineno
+        while pos <= end:
+            m = self.bufregexp.search(buf, pos)
+            if not m:
+                break
+            start = buf.rfind(b'\n', 0, m.start()) + 1
+            stop = buf.find(b'\n', m.start())
+            if stop < 0:
+                stop = end
+            # the match may span lines, so the line is searched again
+            line = buf[start:stop]
+            spans = self._linematch(line)
+            if spans:
+                lineno += buf[linepos:start].count(b'\n')
+                linepos = start
+                found.append((lineno, line, spans))
+                if self.once:
+                    break
+            pos = stop + 1
+        return found
+
+    def searchshard(self, wfiles):
+        """Search the files; returns (number of files, matches, unreadable
+        files), where matches is [(wfile, [(lineno, line, spans), ...])]"""
+        matches = []
+        errors = []
+        for wfile in wfiles:
+            try:
+                found = self.searchfile(wfile)
+            except EnvironmentError:
+                errors.append(wfile)
+                continue
+            if found:
+                matches.append((wfile, found))
+        return len(wfiles), matches, errors
+
+def _matchlines(body, regexp):
+    """Generate (linenum, colstart, colend, line) of lines matching the
+    multiline regexp, as "hg grep" does"""
+    begin = 0
+    linenum = 0
+    while begin < len(body):
+        match = regexp.search(body, begin)
+        if not match:
+            break
+        mstart, mend = match.span()
+        linenum += body.count(b'\n', begin, mstart) + 1
+        lstart = body.rfind(b'\n', begin, mstart) + 1 or begin
+        begin = body.find(b'\n', mend) + 1 or len(body) + 1
+        lend = begin - 1
+        yield linenum, mstart - lstart, mend - lstart, body[lstart:lend]
+
+def _findpos(regexp, line, colstart, colend):
+    """Generate (start, end) of all matches in the line of which the first
+    match is known"""
+    yield colstart, colend
+    p = colend
+    while p < len(line):
+        m = regexp.search(line, p)
+        if not m:
+            break
+        if m.end() == p:
+            p += 1
+        else:
+            yield m.span()
+            p = m.end()
+
+def _difflinestates(a, b):
+    """Generate (change, state) of matched lines added to or removed from
+    states a to b, where lines are compared by content"""
+    sm = difflib.SequenceMatcher(None, [s[3] for s in a], [s[3] for s in b])
+    for tag, alo, ahi, blo, bhi in sm.get_opcodes():
+        if tag in ('delete', 'replace'):
+            for i in pycompat.xrange(alo, ahi):
+                yield b'-', a[i]
+        if tag in ('insert', 'replace'):
+            for i in pycompat.xrange(blo, bhi):
+                yield b'+', b[i]
+
+class _HistorySearcher(object):
+    """Find matching lines added or removed by revisions, as
+    "hg grep --all" does"""
+
+    def __init__(self, repo, pattern, flags, include, exclude, follow,
+                 candidates):
+        self.repo = repo
+        self.regexp = re.compile(pattern, flags | re.M)
+        self.matchfn = matchmod.match(repo.root, b'', [], include, exclude)
+        self.follow = follow
+        self.candidates = candidates
+        self._getfile = util.lrucachefunc(repo.file)
+        self._getrenamed = scmutil.getrenamedfn(repo)
+        # (path, filenode): (binary, states), shared by adjacent revisions
+        self._filestates = util.lrucachedict(_FILE_STATES_CACHE)
+
+    def _states(self, fn, fnode):
+        cached = self._filestates.get((fn, fnode))
+        if cached is not None:
+            return cached
+        try:
+            body = self._getfile(fn).read(fnode)
+        except error.CensoredNodeError:
+            body = b''
+        cached = (stringutil.binary(body),
+                  list(_matchlines(body, self.regexp)))
+        self._filestates[(fn, fnode)] = cached
+        return cached
+
+    def searchshard(self, revs):
+        """Search the revisions; returns (number of revisions, matches),
+        where matches is [(rev, path, linenum, change, user, line, spans)]
+        in order.  line and spans are None for binary files."""
+        found = []
+        for rev in revs:
+            ctx = self.repo[rev]
+            pctx = ctx.p1()
+            user = self.repo.ui.shortuser(ctx.user())
+            for fn in sorted(ctx.files()):
+                if fn not in ctx or not self.matchfn(fn):
+                    continue
+                fnode = ctx.filenode(fn)
+                pfn = fn
+                if self.follow:
+                    pfn = self._getrenamed(fn, rev) or fn
+                pfnode = None
+                if pfn in pctx:
+                    pfnode = pctx.filenode(pfn)
+                if (self.candidates is not None
+                    and self.candidates.covers(rev)
+                    and fnode not in self.candidates
+                    and (pfnode is None or pfnode not in self.candidates)):
+                    continue  # neither revision has matching lines
+                binary, states = self._states(fn, fnode)
+                pstates = []
+                if pfnode is not None:
+                    pstates = self._states(pfn, pfnode)[1]
+                for change, st in _difflinestates(pstates, states):
+                    linenum, colstart, colend, line = st
+                    if binary:
+                        found.append((rev, fn, linenum, change, user, None,
+                                      None))
+                    else:
+                        spans = list(_findpos(self.regexp, line, colstart,
+                                              colend))
+                        found.append((rev, fn, linenum, change, user, line,
+                                      spans))
+        return len(revs), found
+
+# command line of worker process; demandimport keeps its startup short
+_WORKER_SCRIPT = ('from mercurial import demandimport; demandimport.enable(); '
+                  'from tortoisehg.util import grepsearch; '
+                  'grepsearch._workermain()')
+
+def _workermain():
+    """Entry point of worker process
+
+    Reads (searchercls, root, filtername, configs, args) and then shards
+    from stdin.  Writes (True, None) once the searcher is set up, and
+    (True, result) for each shard to stdout, or (False, error message) on
+    error.
+    """
+    global _mapfiles
+    _mapfiles = True
+    fin, fout = procutil.stdin, procutil.stdout
+    def reply(ok, result):
+        pickle.dump((ok, result), fout, pickle.HIGHEST_PROTOCOL)
+        fout.flush()
+    searchercls, root, filtername, configs, args = pickle.load(fin)
+    try:
+        ui = hglib.loadui()
+        ui.fout = ui.ferr  # stdout is reserved for results
+        for section, name, value, source in configs:
+            ui.setconfig(section, name, value, source)
+        repo = hg.repository(ui, root)
+        if filtername:
+            repo = repo.filtered(filtername)
+        else:
+            repo = repo.unfiltered()
+        searcher = searchercls(repo, *args)
+    except Exception as inst:
+        reply(False, stringutil.forcebytestr(inst))
+        return
+    reply(True, None)
+    while True:
+        try:
+            shard = pickle.load(fin)
+        except EOFError:
+            break
+        try:
+            result = searcher.searchshard(shard)
+        except Exception as inst:
+            reply(False, stringutil.forcebytestr(inst))
+            continue
+        reply(True, result)
+
+def _dynamicconfigs(ui):
+    """List config values which a worker can't read from config files,
+    such as --config options"""
+    configs = []
+    for section, name, value in ui.walkconfig():
+        source = ui.configsource(section, name)
+        if b':' in source:
+            # path:line
+            continue
+        if source == b'none':
+            source = b''
+        configs.append((section, name, value, source))
+    return configs
+
+def _canstartworkers():
+    # frozen executable can't run the worker script
+    return not getattr(sys, 'frozen', False)
+
+class _WorkerPool(object):
+    """Worker processes to which shards are sent in turn"""
+
+    def __init__(self, jobs, initargs):
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join(sys.path)
+        self._procs = []
+        try:
+            for _i in pycompat.xrange(jobs):
+                proc = subprocess.Popen([sys.executable, '-c', _WORKER_SCRIPT],
+                                        stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE, env=env)
+                self._procs.append(proc)
+                self._send(proc, initargs)
+            for proc in self._procs:
+                self._receive(proc)
+        except BaseException:
+            self.terminate()
+            raise
+
+    def _send(self, proc, obj):
+        pickle.dump(obj, proc.stdin, pickle.HIGHEST_PROTOCOL)
+        proc.stdin.flush()
+
+    def _receive(self, proc):
+        try:
+            ok, result = pickle.load(proc.stdout)
+        except EOFError:
+            raise error.Abort(b'search worker exited unexpectedly')
+        if not ok:
+            raise error.Abort(result)
+        return result
+
+    def imap(self, shards):
+        """Generate results of the shards in order
+
+        Shard i is processed by worker i % jobs, which gets the next shard
+        as soon as its result is read, so a worker never has to read a
+        shard while its result isn't consumed.
+        """
+        procs = self._procs
+        for proc, shard in zip(procs, shards):
+            self._send(proc, shard)
+        for i in pycompat.xrange(len(shards)):
+            proc = procs[i % len(procs)]
+            result = self._receive(proc)
+            if i + len(procs) < len(shards):
+                self._send(proc, shards[i + len(procs)])
+            yield result
+
+    def close(self):
+        for proc in self._procs:
+            proc.stdin.close()
+        for proc in self._procs:
+            proc.wait()
+            proc.stdout.close()
+
+    def terminate(self):
+        for proc in self._procs:
+            proc.kill()
+        for proc in self._procs:
+            proc.wait()
+            proc.stdin.close()
+            proc.stdout.close()
+
+def _shards(items, jobs, maxsize):
+    size = max(1, min(maxsize, len(items) // (jobs * 4)))
+    for i in pycompat.xrange(0, len(items), size):
+        yield items[i:i + size]
+
+def _run(repo, searchercls, args, items, jobs, maxsize, minparallel):
+    """Generate results of searchercls(repo, *args).searchshard() for the
+    shards of items in order"""
+    jobs = jobs or multiprocessing.cpu_count()
+    if not _canstartworkers() or jobs < 2 or len(items) < minparallel:
+        searcher = searchercls(repo, *args)
+        for shard in _shards(items, 1, maxsize):
+            yield searcher.searchshard(shard)
+        return
+
+    pool = _WorkerPool(jobs, (searchercls, repo.root, repo.filtername,
+                              _dynamicconfigs(repo.ui), args))
+    completed = False
+    try:
+        for result in pool.imap(list(_shards(items, jobs, maxsize))):
+            yield result
+        completed = True
+    finally:
+        if completed:
+            pool.close()
+        else:
+            pool.terminate()
+
+def narrowfiles(ctx, wfiles, candidates):
+    """Drop files of which the revision in ctx isn't in the candidates
+    (trigramindex.CandidateSet)
+
+    Files changed in the working directory are kept, and all files are kept
+    if they are read through decode filters, as their contents differ from
+    the indexed file revisions, or if the revision isn't covered by the
+    index.
+    """
+    if ctx.rev() is None:
+        if (ctx.repo()._decodefilterpats
+            or not candidates.covers(ctx.p1().rev())):
+            return wfiles
+        changed = set(ctx.modified())
+        mf = ctx.p1().manifest()
+    else:
+        if not candidates.covers(ctx.rev()):
+            return wfiles
+        changed = set()
+        mf = ctx.manifest()
+    return [f for f in wfiles
+            if f in changed or f not in mf or mf[f] in candidates]
+
+def search(repo, rev, wfiles, pattern, flags=0, once=False, jobs=None):
+    """Search the files of the revision (None for working directory)
+
+    Generates (number of searched files, matches, unreadable files) for
+    each shard of files in order, where matches is
+    [(wfile, [(lineno, line, [(start, end), ...]), ...]), ...].  If once is
+    True, only the first matching line of each file is reported.
+
+    Closing the generator stops the workers.
+    """
+    return _run(repo, _FileSearcher, (rev, pattern, flags, once), wfiles,
+                jobs, _MAX_SHARD_FILES, _MIN_PARALLEL_FILES)
+
+def searchhistory(repo, revs, pattern, flags=0, include=(), exclude=(),
+                  follow=False, candidates=None, jobs=None):
+    """Search lines added or removed by the revisions
+
+    The revisions are split into ranges searched in parallel, and each
+    revision is compared with its first parent, following copies if
+    follow is True.  Generates (number of searched revisions, matches) for
+    each range in order of revs, where matches is
+    [(rev, path, linenum, change, user, line, [(start, end), ...])];
+    change is '+' or '-', and line and spans are None for binary files.
+    If candidates is specified, only the file revisions in it are read.
+
+    Closing the generator stops the workers.
+    """
+    return _run(repo, _HistorySearcher,
+                (pattern, flags, list(include), list(exclude), follow,
+                 candidates),
+                list(revs), jobs, _MAX_SHARD_REVS, _MIN_PARALLEL_REVS)
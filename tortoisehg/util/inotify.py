@@ -0,0 +1,155 @@
+# inotify.py - minimal binding of Linux inotify API
+#
+# This software may be used and distributed according to the terms of the
+# GNU General Public License version 2 or any later version.
+
+"""minimal binding of Linux inotify API
+
+Only the functions needed to watch a handful of directories are provided.
+The inotify file descriptor is non-blocking, so it can be polled by an event
+loop (e.g. QSocketNotifier) and read until no more events are queued.
+"""
+
+from __future__ import absolute_import
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import struct
+import sys
+
+# event masks (see <sys/inotify.h>)
+IN_ACCESS = 0x00000001
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_CLOSE_NOWRITE = 0x00000010
+IN_OPEN = 0x00000020
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+
+IN_UNMOUNT = 0x00002000
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_EXCL_UNLINK = 0x04000000
+IN_ISDIR = 0x40000000
+
+# file in directory is replaced, written, or removed; the directory itself
+# is gone
+IN_DIRCHANGES = (IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE
+                 | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF)
+
+_IN_NONBLOCK = os.O_NONBLOCK
+_IN_CLOEXEC = 0o2000000
+
+_EVENTHEADER = struct.Struct('=iIII')  # wd, mask, cookie, len
+_READSIZE = 64 * 1024
+
+_libc = None
+
+
+def _loadlibc():
+    global _libc
+    if _libc is None:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                           use_errno=True)
+        libc.inotify_init1.argtypes = [ctypes.c_int]
+        libc.inotify_init1.restype = ctypes.c_int
+        libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p,
+                                           ctypes.c_uint32]
+        libc.inotify_add_watch.restype = ctypes.c_int
+        libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+        libc.inotify_rm_watch.restype = ctypes.c_int
+        _libc = libc
+    return _libc
+
+
+def available():
+    """True if inotify API can be used on this platform"""
+    if not sys.platform.startswith('linux'):
+        return False
+    try:
+        _loadlibc().inotify_init1
+    except (OSError, AttributeError):
+        return False
+    return True
+
+
+def _oserror(path=None):
+    err = ctypes.get_errno()
+    if path is None:
+        return OSError(err, os.strerror(err))
+    return OSError(err, os.strerror(err), path)
+
+
+class Watcher(object):
+    """Inotify instance to which directories or files can be added"""
+
+    def __init__(self):
+        self._libc = _loadlibc()
+        self._fd = self._libc.inotify_init1(_IN_NONBLOCK | _IN_CLOEXEC)
+        if self._fd < 0:
+            raise _oserror()
+
+    def fileno(self):
+        return self._fd
+
+    def closed(self):
+        return self._fd < 0
+
+    def close(self):
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+    def addwatch(self, path, mask):
+        """Start watching the given path (bytes) and return watch descriptor
+
+        Adding the same inode again returns the existing descriptor and
+        replaces its mask.
+        """
+        wd = self._libc.inotify_add_watch(self._fd, path, mask)
+        if wd < 0:
+            raise _oserror(path)
+        return wd
+
+    def rmwatch(self, wd):
+        """Stop watching; the kernel queues IN_IGNORED for the descriptor"""
+        if self._libc.inotify_rm_watch(self._fd, wd) < 0:
+            raise _oserror()
+
+    def read(self):
+        """Read queued events as [(wd, mask, cookie, name), ...]
+
+        Returns an empty list if no event is queued.  name is bytes relative
+        to the watched directory, or empty for the watched path itself.
+        """
+        events = []
+        while True:
+            try:
+                buf = os.read(self._fd, _READSIZE)
+            except OSError as inst:
+                if inst.errno == errno.EINTR:
+                    continue
+                if inst.errno == errno.EAGAIN:
+                    break
+                raise
+            if not buf:
+                break
+            offset = 0
+            while offset + _EVENTHEADER.size <= len(buf):
+                wd, mask, cookie, namelen = _EVENTHEADER.unpack_from(buf,
+                                                                     offset)
+                offset += _EVENTHEADER.size
+                name = buf[offset:offset + namelen].rstrip(b'\0')
+                offset += namelen
+                events.append((wd, mask, cookie, name))
+        return events
@@ -15,7 +15,9 @@ from hgext.largefiles import (
 
 from mercurial import (
     hg,
+    match as matchmod,
     pycompat,
+    util,
 )
 
 if pycompat.TYPE_CHECKING:
@@ -23,6 +25,7 @@ if pycompat.TYPE_CHECKING:
         Dict,
         List,
         Optional,
+        Tuple,
     )
 
 def get_system_times():
@@ -64,78 +67,6 @@ if os.name == 'nt':
                                  shellcon.SHCNF_FLUSH,
                                  None, None)
 
-    def update_thgstatus(ui, root, wait=False):
-        '''Rewrite the file .hg/thgstatus
-
-        Caches the information provided by repo.status() in the file
-        .hg/thgstatus, which can then be read by the overlay shell extension
-        to display overlay icons for directories.
-
-        The file .hg/thgstatus contains one line for each directory that has
-        removed, modified or added files (in that order of preference). Each
-        line consists of one char for the status of the directory (r, m or a),
-        followed by the relative path of the directory in the repo. If the
-        file .hg/thgstatus is empty, then the repo's working directory is
-        clean.
-
-        Specify wait=True to wait until the system clock ticks to the next
-        second before accessing Mercurial's dirstate. This is useful when
-        Mercurial's .hg/dirstate contains unset entries (in output of
-        "hg debugstate"). unset entries happen if .hg/dirstate was updated
-        within the same second as Mercurial updated the respective file in
-        the working tree. This happens with a high probability for example
-        when cloning a repo. The overlay shell extension will display unset
-        dirstate entries as (potentially false) modified. Specifying wait=True
-        ensures that there are no unset entries left in .hg/dirstate when this
-        function exits.
-        '''
-        if wait:
-            tref = time.time()
-            tdelta = float(int(tref)) + 1.0 - tref
-            if tdelta > 0.0:
-                time.sleep(tdelta)
-
-        repo = hg.repository(ui, root) # a fresh repo object is needed
-        with lfutil.lfstatus(repo):
-            repostate = repo.status() # will update dirstate as a side effect
-
-        dirstatus = {}  # type: Dict[bytes, bytes]
-        def dirname(f):
-            # type: (bytes) -> bytes
-            return b'/'.join(f.split(b'/')[:-1])
-        for fn in repostate.added:
-            dirstatus[dirname(fn)] = b'a'
-        for fn in repostate.modified:
-            dirstatus[dirname(fn)] = b'm'
-        for fn in repostate.removed + repostate.deleted:
-            dirstatus[dirname(fn)] = b'r'
-
-        update = False
-
-        try:
-            with repo.vfs(b'thgstatus', b'rb') as f:
-                for dn in sorted(dirstatus):
-                    s = dirstatus[dn]
-                    e = f.readline()  # type: bytes
-                    if e.startswith(b'@@noicons'):
-                        break
-                    if e == b'' or e[0] != s or e[1:-1] != dn:
-                        update = True
-                        break
-                if f.readline() != b'':
-                    # extra line in f, needs update
-                    update = True
-        except IOError:
-            update = True
-
-        if update:
-            with repo.vfs(b'thgstatus', b'wb', atomictemp=True) as f:
-                for dn in sorted(dirstatus):
-                    s = dirstatus[dn]
-                    f.write(s + dn + b'\n')
-                    ui.note(b"%s %s\n" % (s, dn))
-        return update
-
 else:
     def shell_notify(paths, noassoc=False):
         # type: (List[bytes], bool) -> None
@@ -157,5 +88,155 @@ else:
         finally:
             f_notify.close()
 
-    def update_thgstatus(*args, **kws):
-        pass
+# file under .hg/cache recording the dirstate for which .hg/thgstatus is valid
+_THGSTATUS_DIRSTATE = b'thgstatus-dirstate'
+
+def _dirstate_identity(repo):
+    # type: (...) -> Optional[bytes]
+    try:
+        st = repo.vfs.lstat(b'dirstate')
+    except OSError:
+        return None
+    return b'%d %d %d' % (st.st_size, int(st.st_mtime * 1000000), st.st_ino)
+
+def _read_thgstatus(repo):
+    # type: (...) -> Tuple[bool, Optional[Dict[bytes, bytes]]]
+    """Read .hg/thgstatus as (noicons, {dir: status}); the dict is None if
+    the file doesn't exist"""
+    try:
+        with repo.vfs(b'thgstatus', b'rb') as f:
+            lines = f.read().splitlines()
+    except IOError:
+        return False, None
+    if lines and lines[0].startswith(b'@@noicons'):
+        return True, None
+    return False, dict((e[1:], e[:1]) for e in lines if e)
+
+def _read_dirstate_identity(repo):
+    # type: (...) -> Optional[bytes]
+    try:
+        return repo.cachevfs.read(_THGSTATUS_DIRSTATE)
+    except IOError:
+        return None
+
+def _write_dirstate_identity(repo, identity):
+    # type: (...) -> None
+    try:
+        if identity is None:
+            repo.cachevfs.tryunlink(_THGSTATUS_DIRSTATE)
+        else:
+            repo.cachevfs.write(_THGSTATUS_DIRSTATE, identity,
+                                atomictemp=True)
+    except (IOError, OSError):
+        pass  # read-only repository, for example
+
+def _changed_dirs(repo, paths):
+    # type: (...) -> Optional[List[bytes]]
+    """Directories (relative to root) containing the changed paths, or None
+    if the whole working directory has to be checked"""
+    dirs = set()
+    for path in paths:
+        abspath = os.path.abspath(path)
+        if not os.path.isdir(abspath) or os.path.islink(abspath):
+            abspath = os.path.dirname(abspath)
+        rel = os.path.relpath(abspath, repo.root)
+        if rel == pycompat.oscurdir:
+            return None
+        if (rel == pycompat.ospardir
+            or rel.startswith(pycompat.ospardir + pycompat.ossep)):
+            continue  # not in this repository
+        dirs.add(util.pconvert(rel))
+    return sorted(dirs)
+
+def _is_in_dirs(dn, dirs):
+    # type: (bytes, List[bytes]) -> bool
+    return any(dn == d or dn.startswith(d + b'/') for d in dirs)
+
+def update_thgstatus(ui, root, wait=False, paths=None):
+    '''Rewrite the file .hg/thgstatus
+
+    Caches the information provided by repo.status() in the file
+    .hg/thgstatus, which can then be read by the overlay shell extension
+    to display overlay icons for directories.
+
+    The file .hg/thgstatus contains one line for each directory that has
+    removed, modified or added files (in that order of preference). Each
+    line consists of one char for the status of the directory (r, m or a),
+    followed by the relative path of the directory in the repo. If the
+    file .hg/thgstatus is empty, then the repo's working directory is
+    clean.
+
+    Specify wait=True to wait until the system clock ticks to the next
+    second before accessing Mercurial's dirstate. This is useful when
+    Mercurial's .hg/dirstate contains unset entries (in output of
+    "hg debugstate"). unset entries happen if .hg/dirstate was updated
+    within the same second as Mercurial updated the respective file in
+    the working tree. This happens with a high probability for example
+    when cloning a repo. The overlay shell extension will display unset
+    dirstate entries as (potentially false) modified. Specifying wait=True
+    ensures that there are no unset entries left in .hg/dirstate when this
+    function exits.
+
+    If paths changed in the working directory are specified, and the
+    dirstate is the same as when .hg/thgstatus was last written, only the
+    directories containing these paths are checked and the other lines of
+    .hg/thgstatus are kept.  Otherwise the whole working directory is
+    checked.
+
+    Returns True if .hg/thgstatus is rewritten.
+    '''
+    if wait:
+        tref = time.time()
+        tdelta = float(int(tref)) + 1.0 - tref
+        if tdelta > 0.0:
+            time.sleep(tdelta)
+
+    repo = hg.repository(ui, root) # a fresh repo object is needed
+    noicons, olddirstatus = _read_thgstatus(repo)
+    identity = _dirstate_identity(repo)
+    dirs = None
+    if (paths is not None and olddirstatus is not None
+        and identity is not None
+        and _read_dirstate_identity(repo) == identity):
+        dirs = _changed_dirs(repo, paths)
+
+    if dirs is None:
+        match = None
+        dirstatus = {}  # type: Dict[bytes, bytes]
+    else:
+        ui.debug(b'checking %d directories\n' % len(dirs))
+        match = matchmod.match(repo.root, b'', [b'path:' + d for d in dirs])
+        # lines of the checked directories will be replaced
+        dirstatus = dict((dn, s) for dn, s in olddirstatus.items()
+                         if not _is_in_dirs(dn, dirs))
+    if dirs != []:
+        with lfutil.lfstatus(repo):
+            # will update dirstate as a side effect
+            repostate = repo.status(match=match)
+
+        def dirname(f):
+            # type: (bytes) -> bytes
+            return b'/'.join(f.split(b'/')[:-1])
+        for fn in repostate.added:
+            dirstatus[dirname(fn)] = b'a'
+        for fn in repostate.modified:
+            dirstatus[dirname(fn)] = b'm'
+        for fn in repostate.removed + repostate.deleted:
+            dirstatus[dirname(fn)] = b'r'
+
+    # if the dirstate is changed by another process meanwhile, the status
+    # may be outdated, so the next update has to check everything
+    newidentity = _dirstate_identity(repo)
+    if newidentity != identity:
+        newidentity = None
+    if newidentity != _read_dirstate_identity(repo):
+        _write_dirstate_identity(repo, newidentity)
+
+    update = not noicons and dirstatus != olddirstatus
+    if update:
+        with repo.vfs(b'thgstatus', b'wb', atomictemp=True) as f:
+            for dn in sorted(dirstatus):
+                s = dirstatus[dn]
+                f.write(s + dn + b'\n')
+                ui.note(b"%s %s\n" % (s, dn))
+    return update
@@ -0,0 +1,537 @@
+# statusservice.py - overlay status service for file manager extensions
+#
+# This software may be used and distributed according to the terms of the
+# GNU General Public License version 2 or any later version.
+
+"""overlay status service for file manager extensions
+
+File manager extensions (e.g. contrib/nautilus-thg.py) ask the overlay state
+of every file they show.  Computing it in the extension process means opening
+the repository and running status for the whole directory whenever the cache
+of cachethg is discarded.  StatusServer is a long-lived process listening on
+a UNIX domain socket, which keeps repositories open and caches the states per
+directory until they are invalidated by inotify events, so the extension only
+has to send the paths it shows in batch.
+
+Each message is a 4-byte big-endian length followed by the payload.  The
+payload of a request is a command byte followed by NUL-separated paths:
+
+  S  query states of the paths; response payload is NUL-separated states
+  I  drop cached states of the paths; response payload is empty
+
+The server exits after it has been idle for a while, and is spawned again by
+StatusClient on demand.
+"""
+
+from __future__ import absolute_import
+
+import collections
+import errno
+import os
+import select
+import socket
+import stat
+import struct
+import subprocess
+import tempfile
+import time
+
+from mercurial import (
+    error,
+    hg,
+)
+from mercurial.utils import (
+    stringutil,
+)
+
+from . import (
+    cachethg,
+    hglib,
+    inotify,
+    paths,
+)
+
+CMD_STATES = b'S'
+CMD_INVALIDATE = b'I'
+
+_HEADER = struct.Struct('>I')
+
+# seconds the server waits for requests before exiting
+_IDLE_TIMEOUT = 600
+
+# number of repositories kept open, and directories cached per repository
+_MAX_REPOS = 20
+_MAX_DIRS = 64
+
+# directories watched per repository; states in working directories having
+# more directories are cached for CACHE_TIMEOUT
+_MAX_WATCHES = 10000
+
+_WATCHMASK = inotify.IN_DIRCHANGES | inotify.IN_ATTRIB | inotify.IN_ONLYDIR
+
+
+def socketpath():
+    """Default path to the socket of the service for the current user"""
+    base = os.environ.get('XDG_RUNTIME_DIR') or tempfile.gettempdir()
+    return os.path.join(base, 'tortoisehg-%d' % os.getuid(), 'status.sock')
+
+
+def _makesocketdir(path):
+    sockdir = os.path.dirname(path)
+    try:
+        os.mkdir(sockdir, 0o700)
+    except OSError as inst:
+        if inst.errno != errno.EEXIST:
+            raise
+    st = os.lstat(sockdir)
+    if (not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid()
+        or st.st_mode & 0o077):
+        raise OSError(errno.EPERM, 'insecure socket directory', sockdir)
+
+
+def _sendmsg(sock, payload):
+    sock.sendall(_HEADER.pack(len(payload)) + payload)
+
+
+def _recvexact(sock, size):
+    chunks = []
+    while size > 0:
+        data = sock.recv(size)
+        if not data:
+            raise EOFError
+        chunks.append(data)
+        size -= len(data)
+    return b''.join(chunks)
+
+
+def _recvmsg(sock):
+    size, = _HEADER.unpack(_recvexact(sock, _HEADER.size))
+    return _recvexact(sock, size)
+
+
+class _RepoEntry(object):
+    """Open repository and cached states of directories in it"""
+
+    def __init__(self, root, repo):
+        self.root = root
+        self.repo = repo
+        self.dirstates = collections.OrderedDict()  # pdir: (states, expiry)
+        self.watcheddirs = {}  # dir: wd
+        # whether all directories of working directory are watched, or None
+        # if not walked yet
+        self.treewatched = None
+
+
+class StatusServer(object):
+    """Answer overlay states of paths from cache kept per directory"""
+
+    def __init__(self, ui, sockpath=None, idletimeout=_IDLE_TIMEOUT):
+        self._ui = ui
+        self._privatedir = not sockpath
+        self._sockpath = sockpath or socketpath()
+        self._idletimeout = idletimeout
+        self._repos = collections.OrderedDict()  # root: _RepoEntry
+        self._wddirs = {}  # wd: (root, dir)
+        self._watcher = None
+        if inotify.available():
+            try:
+                self._watcher = inotify.Watcher()
+            except OSError:
+                pass  # fall back to CACHE_TIMEOUT
+        self._listener = None
+        self._conns = {}  # socket: bytearray of received data
+
+    def _bind(self):
+        if self._privatedir:
+            _makesocketdir(self._sockpath)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.bind(self._sockpath)
+        except socket.error as inst:
+            if inst.errno != errno.EADDRINUSE or self._isalive():
+                sock.close()
+                raise
+            # stale socket left by crashed server
+            os.unlink(self._sockpath)
+            sock.bind(self._sockpath)
+        sock.listen(16)
+        sock.setblocking(False)
+        self._listener = sock
+
+    def _isalive(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self._sockpath)
+            return True
+        except socket.error:
+            return False
+        finally:
+            sock.close()
+
+    def run(self):
+        """Serve until idle for idletimeout seconds"""
+        self._bind()
+        sockstat = os.stat(self._sockpath)
+        self._ui.note(b'listening at %s\n' % hglib.fromunicode(self._sockpath))
+        try:
+            lastactive = time.time()
+            while True:
+                rlist = [self._listener] + list(self._conns)
+                if self._watcher:
+                    rlist.append(self._watcher)
+                timeout = lastactive + self._idletimeout - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    readable, _w, _x = select.select(rlist, [], [],
+                                                     max(timeout, 1))
+                except select.error as inst:
+                    if inst.args[0] == errno.EINTR:
+                        continue
+                    raise
+                for sock in readable:
+                    if sock is self._listener:
+                        self._accept()
+                    elif sock is self._watcher:
+                        self._readevents()
+                    else:
+                        self._readconn(sock)
+                        lastactive = time.time()
+        finally:
+            for sock in list(self._conns):
+                self._closeconn(sock)
+            self._listener.close()
+            try:
+                # don't remove socket of another server
+                if os.stat(self._sockpath).st_ino == sockstat.st_ino:
+                    os.unlink(self._sockpath)
+            except OSError:
+                pass
+            if self._watcher:
+                self._watcher.close()
+
+    def _accept(self):
+        try:
+            sock, _addr = self._listener.accept()
+        except socket.error:
+            return
+        sock.setblocking(False)
+        self._conns[sock] = bytearray()
+
+    def _closeconn(self, sock):
+        del self._conns[sock]
+        sock.close()
+
+    def _readconn(self, sock):
+        buf = self._conns[sock]
+        try:
+            data = sock.recv(65536)
+        except socket.error as inst:
+            if inst.errno in (errno.EAGAIN, errno.EINTR):
+                return
+            data = b''
+        if not data:
+            self._closeconn(sock)
+            return
+        buf.extend(data)
+        while len(buf) >= _HEADER.size:
+            size, = _HEADER.unpack_from(buf, 0)
+            if len(buf) < _HEADER.size + size:
+                break
+            payload = bytes(buf[_HEADER.size:_HEADER.size + size])
+            del buf[:_HEADER.size + size]
+            try:
+                response = self._dispatch(payload)
+                sock.setblocking(True)
+                sock.settimeout(5)
+                _sendmsg(sock, response)
+                sock.setblocking(False)
+            except (socket.error, ValueError):
+                self._closeconn(sock)
+                return
+
+    def _dispatch(self, payload):
+        cmd, data = payload[:1], payload[1:]
+        upaths = [hglib.tounicode(p) for p in data.split(b'\0') if p]
+        if cmd == CMD_STATES:
+            states = [self.state(p) for p in upaths]
+            return b'\0'.join(hglib.fromunicode(s) for s in states)
+        elif cmd == CMD_INVALIDATE:
+            for p in upaths:
+                self.invalidate(p)
+            return b''
+        raise ValueError('unknown command %r' % cmd)
+
+    def state(self, path):
+        """Overlay states of the given path as cachethg.get_states() does"""
+        if os.path.isdir(os.path.join(path, '.hg')):
+            return cachethg.ROOT
+        pdir = os.path.dirname(path)
+        root = paths.find_root(path)
+        if root is None or cachethg.is_in_hgdir(root, pdir):
+            return cachethg.NOT_IN_REPO
+        if cachethg.is_excluded(path):
+            return cachethg.NOT_IN_REPO
+        # a broken repository or directory mustn't take the service down
+        try:
+            entry = self._repoentry(root)
+        except error.RepoError:
+            return cachethg.IGNORED
+        except Exception as inst:
+            self._ui.debug(b'cannot open %s: %s\n'
+                           % (hglib.fromunicode(root),
+                              stringutil.forcebytestr(inst)))
+            return cachethg.UNKNOWN
+        try:
+            states = self._dirstates(entry, pdir)
+        except Exception as inst:
+            self._ui.debug(b'cannot get states of %s: %s\n'
+                           % (hglib.fromunicode(pdir),
+                              stringutil.forcebytestr(inst)))
+            return cachethg.UNKNOWN
+        return cachethg.lookup_state(states, path)
+
+    def invalidate(self, path):
+        """Drop cached states of directories containing the path"""
+        for entry in self._repos.values():
+            if path == entry.root or path.startswith(entry.root + os.sep):
+                self._invalidatedirs(entry, path)
+
+    def _repoentry(self, root):
+        entry = self._repos.pop(root, None)
+        if entry is None:
+            repo = hg.repository(self._ui, hglib.fromunicode(root))
+            entry = _RepoEntry(root, repo)
+            self._watchdir(entry, os.path.join(root, '.hg'))
+            if len(self._repos) >= _MAX_REPOS:
+                _oldroot, oldentry = self._repos.popitem(last=False)
+                self._unwatchall(oldentry)
+        self._repos[root] = entry  # most recently used
+        return entry
+
+    def _dirstates(self, entry, pdir):
+        cached = entry.dirstates.pop(pdir, None)
+        if cached is not None and cached[1] > time.time():
+            entry.dirstates[pdir] = cached
+            return cached[0]
+        repo = entry.repo
+        # pick up changes of dirstate and working parents
+        repo.invalidate()
+        repo.invalidatedirstate()
+        states = cachethg.dir_states(repo, entry.root, pdir)
+        if entry.treewatched is None:
+            entry.treewatched = self._watchtree(entry, entry.root)
+            if not entry.treewatched:
+                self._unwatchworkingdir(entry)
+        if entry.treewatched:
+            expiry = float('inf')
+        else:
+            expiry = time.time() + cachethg.CACHE_TIMEOUT
+        entry.dirstates[pdir] = (states, expiry)
+        if len(entry.dirstates) > _MAX_DIRS:
+            entry.dirstates.popitem(last=False)
+        return states
+
+    def _watchdir(self, entry, path):
+        if not self._watcher:
+            return False
+        if path in entry.watcheddirs:
+            return True
+        if len(entry.watcheddirs) >= _MAX_WATCHES:
+            return False
+        try:
+            wd = self._watcher.addwatch(hglib.fromunicode(path), _WATCHMASK)
+        except OSError:
+            return False
+        entry.watcheddirs[path] = wd
+        self._wddirs[wd] = (entry.root, path)
+        return True
+
+    def _watchtree(self, entry, top):
+        """Watch the directory and its subdirectories; False if not all of
+        them can be watched"""
+        if not self._watcher:
+            return False
+        for dirpath, dirnames, _filenames in os.walk(top):
+            if not self._watchdir(entry, dirpath):
+                return False
+            # status doesn't descend into .hg or nested repositories
+            dirnames[:] = [d for d in dirnames if d != '.hg' and not
+                           os.path.isdir(os.path.join(dirpath, d, '.hg'))]
+        return True
+
+    def _unwatchdir(self, entry, path):
+        wd = entry.watcheddirs.pop(path)
+        self._wddirs.pop(wd, None)
+        try:
+            self._watcher.rmwatch(wd)
+        except OSError:
+            pass
+
+    def _unwatchtree(self, entry, top):
+        prefix = os.path.join(top, '')
+        for path in [d for d in entry.watcheddirs
+                     if d == top or d.startswith(prefix)]:
+            self._unwatchdir(entry, path)
+
+    def _unwatchall(self, entry):
+        for path in list(entry.watcheddirs):
+            self._unwatchdir(entry, path)
+
+    def _unwatchworkingdir(self, entry):
+        """Stop watching working directory, e.g. because of too many
+        directories, so states are cached for CACHE_TIMEOUT"""
+        hgdir = os.path.join(entry.root, '.hg')
+        for path in list(entry.watcheddirs):
+            if path != hgdir:
+                self._unwatchdir(entry, path)
+        entry.treewatched = False
+        # no longer invalidated by events
+        entry.dirstates.clear()
+
+    def _invalidatedirs(self, entry, path):
+        # cached states of a directory include ones of its subdirectories
+        for pdir in list(entry.dirstates):
+            if path == pdir or path.startswith(os.path.join(pdir, '')):
+                del entry.dirstates[pdir]
+
+    def _readevents(self):
+        for wd, mask, _cookie, name in self._watcher.read():
+            if mask & inotify.IN_Q_OVERFLOW:
+                for entry in self._repos.values():
+                    entry.dirstates.clear()
+                    if entry.treewatched:
+                        entry.treewatched = None  # new directories missed
+                continue
+            if wd not in self._wddirs:
+                continue
+            root, path = self._wddirs[wd]
+            if mask & inotify.IN_IGNORED:
+                del self._wddirs[wd]
+            entry = self._repos.get(root)
+            if entry is None:
+                continue
+            if mask & inotify.IN_IGNORED:
+                entry.watcheddirs.pop(path, None)
+            if path == os.path.join(root, '.hg'):
+                entry.dirstates.clear()  # dirstate or merge state changed
+                continue
+            self._invalidatedirs(entry, path)
+            if name and mask & inotify.IN_ISDIR and entry.treewatched:
+                self._trackdir(entry, os.path.join(path,
+                                                   hglib.tounicode(name)),
+                               mask)
+
+    def _trackdir(self, entry, path, mask):
+        """Update watches for the directory created, removed or renamed
+        in working directory"""
+        if mask & (inotify.IN_MOVED_FROM | inotify.IN_DELETE):
+            self._unwatchtree(entry, path)
+        elif (mask & (inotify.IN_CREATE | inotify.IN_MOVED_TO)
+              and os.path.basename(path) != '.hg'
+              and not os.path.isdir(os.path.join(path, '.hg'))):
+            if not self._watchtree(entry, path):
+                self._unwatchworkingdir(entry)
+
+
+def serve(ui, sockpath=None):
+    """Run status service until idle"""
+    server = StatusServer(ui, sockpath)
+    try:
+        server.run()
+    except (OSError, socket.error) as inst:
+        if inst.errno == errno.EADDRINUSE:
+            ui.note(b'status service is already running\n')
+            return
+        raise
+
+
+class StatusClient(object):
+    """Query overlay states from StatusServer, spawning it if needed
+
+    Methods return None if the service isn't available, in which case the
+    caller should compute the states by itself.
+    """
+
+    def __init__(self, spawncmd=None, sockpath=None, timeout=2.0):
+        self._spawncmd = spawncmd
+        self._sockpath = sockpath or socketpath()
+        self._timeout = timeout
+        self._sock = None
+        self._lastfailure = 0
+
+    def states(self, upaths):
+        """List of overlay states of the given unicode paths
+
+        Each item holds all the states of the path as cachethg.get_states()
+        does, not the single state returned by cachethg.get_state().
+        """
+        response = self._request(CMD_STATES, upaths)
+        if response is None:
+            return None
+        states = [hglib.tounicode(s) for s in response.split(b'\0')]
+        if len(states) != len(upaths):
+            return None
+        return states
+
+    def invalidate(self, upaths):
+        """Make the service forget cached states of the given paths"""
+        return self._request(CMD_INVALIDATE, upaths) is not None
+
+    def close(self):
+        if self._sock:
+            self._sock.close()
+            self._sock = None
+
+    def _request(self, cmd, upaths):
+        payload = cmd + b'\0'.join(hglib.fromunicode(p) for p in upaths)
+        for _retry in (0, 1):
+            sock = self._connect()
+            if not sock:
+                return None
+            try:
+                _sendmsg(sock, payload)
+                return _recvmsg(sock)
+            except (socket.error, EOFError):
+                # server may have exited by idle timeout; reconnect
+                self.close()
+        return None
+
+    def _connect(self):
+        if self._sock:
+            return self._sock
+        sock = self._tryconnect()
+        if not sock and self._spawn():
+            deadline = time.time() + self._timeout
+            while not sock and time.time() < deadline:
+                time.sleep(0.05)
+                sock = self._tryconnect()
+            if not sock:
+                self._lastfailure = time.time()
+        self._sock = sock
+        return sock
+
+    def _tryconnect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self._timeout)
+        try:
+            sock.connect(self._sockpath)
+        except socket.error:
+            sock.close()
+            return None
+        return sock
+
+    def _spawn(self):
+        # don't keep spawning server which fails to start
+        if not self._spawncmd or time.time() - self._lastfailure < 60:
+            return False
+        try:
+            with open(os.devnull, 'r+b') as devnull:
+                subprocess.Popen(self._spawncmd, stdin=devnull,
+                                 stdout=devnull, stderr=devnull,
+                                 close_fds=True, cwd='/',
+                                 preexec_fn=os.setsid)
+        except OSError:
+            self._lastfailure = time.time()
+            return False
+        return True
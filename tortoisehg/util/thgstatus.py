@@ -7,26 +7,116 @@
 
 '''update TortoiseHg status cache'''
 
-from mercurial import hg
-from tortoisehg.util import paths, shlib
+from mercurial import error, hg
+from mercurial.utils import stringutil
+from tortoisehg.util import hglib, paths, shlib
+import multiprocessing
 import os
+import sys
+import time
 
 def cachefilepath(repo):
     return repo.vfs.join(b"thgstatus")
 
+def find_roots(base):
+    '''List roots of the repositories found in the base directory'''
+    roots = []
+    for f in sorted(os.listdir(base)):
+        r = paths.find_root(os.path.join(base, f))
+        if r is not None and r not in roots:
+            roots.append(r)
+    return roots
+
+# ui of update_all(), of which --config values are copied to workers
+_callerui = None
+
+def _init_worker(ui):
+    global _callerui
+    _callerui = ui
+
+def _update_root(root):
+    '''Update status cache of the repository in worker process
+
+    Returns (root, updated, elapsed seconds, error message or None).
+    '''
+    start = time.time()
+    try:
+        ui = hglib.loadui()
+        if _callerui is not None:
+            hglib.copydynamicconfig(_callerui, ui)
+        updated = shlib.update_thgstatus(ui, root)
+    except (error.Abort, error.RepoError, EnvironmentError) as inst:
+        return root, False, time.time() - start, stringutil.forcebytestr(inst)
+    return root, updated, time.time() - start, None
+
+def _fork_context():
+    '''multiprocessing context which forks workers, or None
+
+    Workers started by spawn or forkserver would run the main script,
+    which is the thg command itself, instead of waiting for tasks.
+    thgstatus runs no other thread, so forking it is safe.
+    '''
+    if getattr(sys, 'frozen', False):
+        return None
+    try:
+        if 'fork' in multiprocessing.get_all_start_methods():
+            return multiprocessing.get_context('fork')
+    except AttributeError:
+        # Python 2 forks on POSIX
+        if os.name == 'posix':
+            return multiprocessing
+    return None
+
+def update_all(_ui, base, jobs=None):
+    '''Update status cache of all repositories in the base directory
+
+    Repositories are processed by a pool of jobs worker processes (one
+    per CPU by default) where workers can be forked, and the shell is
+    notified once for all updated repositories.  Returns the list of updated
+    roots.
+    '''
+    start = time.time()
+    roots = [hglib.fromunicode(r) for r in find_roots(base)]
+    jobs = min(jobs or multiprocessing.cpu_count(), len(roots))
+    ctx = _fork_context()
+    if jobs > 1 and ctx is not None:
+        pool = ctx.Pool(jobs, _init_worker, (_ui,))
+        try:
+            results = list(pool.imap_unordered(_update_root, roots))
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        _init_worker(_ui)
+        try:
+            results = [_update_root(r) for r in roots]
+        finally:
+            _init_worker(None)
+
+    updated = []
+    for root, changed, elapsed, err in sorted(results):
+        if err is not None:
+            _ui.warn(b'%s: %s\n' % (root, err))
+            continue
+        _ui.note(b'%s: %.3f sec%s\n'
+                 % (root, elapsed, changed and b' (updated)' or b''))
+        if changed:
+            updated.append(root)
+    # single notification, so the shell refreshes the icons at once
+    shlib.shell_notify(updated)
+    _ui.note(b'%d of %d repositories updated in %.3f sec\n'
+             % (len(updated), len(roots), time.time() - start))
+    return updated
+
 def run(_ui, *pats, **opts):
 
+    if opts.get('serve'):
+        from tortoisehg.util import statusservice
+        statusservice.serve(_ui)
+        return
+
     if opts.get('all'):
-        roots = []
-        base = os.getcwd()
-        for f in os.listdir(base):
-            r = paths.find_root(os.path.join(base, f))
-            if r is not None:
-                roots.append(r)
-        for r in roots:
-            _ui.note("%s\n" % r) 
-            shlib.update_thgstatus(_ui, r, wait=False)
-            shlib.shell_notify([r])
+        update_all(_ui, os.getcwd(), jobs=opts.get('jobs'))
         return
 
     root = paths.find_root()
@@ -55,7 +145,8 @@ def run(_ui, *pats, **opts):
         return
 
     wait = opts.get('delay') is not None
-    shlib.update_thgstatus(_ui, root, wait=wait)
+    # changed paths, if given, restrict the directories to be checked
+    shlib.update_thgstatus(_ui, root, wait=wait, paths=pats or None)
 
     if opts.get('notify'):
         shlib.shell_notify(opts.get('notify'))
@@ -0,0 +1,395 @@
+# trigramindex.py - trigram index of file contents for repository search
+#
+# This software may be used and distributed according to the terms of the
+# GNU General Public License version 2 or any later version.
+
+"""trigram index of file contents for repository search
+
+The index maps each trigram (3-byte sequence, lowercased) found in file
+revisions to the file revisions containing it.  File revisions are
+identified by filenode, so a file revision shared by changesets (e.g. by
+branches merged without changing the file) is indexed once.  A filenode also
+hashes the parent revisions, so identical contents of different histories
+are indexed separately.  The index covers the file revisions added by all
+changesets up to the indexed tip, and is extended by update() as new
+changesets arrive.
+
+A regular expression is translated to a query of trigrams which must appear
+in any text it matches, so file revisions not containing them needn't be
+read.  Binary and large file revisions aren't indexed and are always
+candidates.
+
+The index is saved to .hg/cache/thg-trigram in native byte order.
+"""
+
+from __future__ import absolute_import
+
+import array
+import collections
+import re
+import struct
+import sys
+import threading
+
+from mercurial import (
+    error,
+    node as nodemod,
+    pycompat,
+)
+
+try:
+    from re import _constants as sre_constants, _parser as sre_parse
+except ImportError:
+    import sre_constants  # pytype: disable=import-error
+    import sre_parse  # pytype: disable=import-error
+
+# magic, version, byte order, tip node, tip rev, number of file revisions,
+# unindexed file revisions and trigrams; followed by the filenodes, the ids
+# of unindexed file revisions, the trigrams, the number of ids per trigram,
+# and the ids of file revisions per trigram
+_CACHEHEADER = struct.Struct('=4sBc20siIII')
+_CACHEMAGIC = b'THGT'
+_CACHEVERSION = 1
+_CACHEBYTEORDER = sys.byteorder[:1].encode('ascii')
+_CACHEFILE = b'thg-trigram'
+
+# array type of file revision ids
+_IDTYPE = 'I' if array.array('I').itemsize == 4 else 'L'
+
+# file revisions larger than this aren't indexed
+_MAX_FILE_SIZE = 1 << 20
+
+_TRIGRAM_RE = re.compile(b'(?=(...))', re.S)
+
+# number of indexes kept in memory
+_MAX_INDEXES = 4
+
+_lock = threading.Lock()  # guards _indexes and _rootlocks
+_indexes = collections.OrderedDict()  # root: TrigramIndex, least recent first
+_rootlocks = {}  # root: lock held while the index is loaded or updated
+
+def _trigrams(data):
+    return set(_TRIGRAM_RE.findall(data.lower()))
+
+def _tobytes(arr):
+    if pycompat.ispy3:
+        return arr.tobytes()
+    return arr.tostring()
+
+def _toarray(buf):
+    arr = array.array(_IDTYPE)
+    if pycompat.ispy3:
+        arr.frombytes(buf)
+    else:
+        arr.fromstring(buf)
+    return arr
+
+## Query of trigrams
+#
+# A query is None (matches everything), a frozenset of trigrams which must
+# all appear, or ('and'|'or', [query, ...]).
+
+def _andquery(queries):
+    trigrams = set()
+    others = []
+    for q in queries:
+        if q is None:
+            continue
+        if isinstance(q, frozenset):
+            trigrams.update(q)
+        else:
+            others.append(q)
+    if trigrams:
+        others.append(frozenset(trigrams))
+    if not others:
+        return None
+    if len(others) == 1:
+        return others[0]
+    return ('and', others)
+
+def _orquery(queries):
+    if not queries or any(q is None for q in queries):
+        return None
+    if len(queries) == 1:
+        return queries[0]
+    return ('or', queries)
+
+def _literalquery(literal):
+    literal = bytes(literal).lower()
+    if len(literal) < 3:
+        return None
+    return frozenset(literal[i:i + 3]
+                     for i in pycompat.xrange(len(literal) - 2))
+
+_REPEATS = tuple(getattr(sre_constants, n) for n in
+                 ('MAX_REPEAT', 'MIN_REPEAT', 'POSSESSIVE_REPEAT')
+                 if hasattr(sre_constants, n))
+
+def _seqquery(items):
+    """Query of the sequence of parsed regular expression items"""
+    queries = []
+    literal = bytearray()
+    for op, av in items:
+        if op == sre_constants.LITERAL and av < 256:
+            literal.append(av)
+            continue
+        queries.append(_literalquery(literal))
+        literal = bytearray()
+        if op == sre_constants.SUBPATTERN:
+            queries.append(_seqquery(av[-1]))
+        elif op == getattr(sre_constants, 'ATOMIC_GROUP', None):
+            queries.append(_seqquery(av))
+        elif op in _REPEATS:
+            minrepeat, _maxrepeat, item = av
+            if minrepeat > 0:
+                queries.append(_seqquery(item))
+        elif op == sre_constants.BRANCH:
+            queries.append(_orquery([_seqquery(b) for b in av[1]]))
+        # anything else may match various texts
+    queries.append(_literalquery(literal))
+    return _andquery(queries)
+
+def regexquery(pattern, flags=0):
+    """Query of trigrams which must appear in text matching the regular
+    expression, or None if any text may match
+
+    >>> regexquery(b'abcd') == frozenset([b'abc', b'bcd'])
+    True
+    >>> regexquery(b'ab|cde') is None
+    True
+    >>> q = regexquery(b'(?i)Foo(bar|quux)+')
+    >>> q == ('and', [('or', [frozenset([b'bar']),
+    ...                       frozenset([b'quu', b'uux'])]),
+    ...               frozenset([b'foo'])])
+    True
+    """
+    try:
+        parsed = sre_parse.parse(pattern, flags)
+    except Exception:
+        return None
+    return _seqquery(parsed)
+
+
+class CandidateSet(object):
+    """Filenodes of file revisions which may match the query
+
+    Only the file revisions added by changesets up to tiprev are known to
+    the index.  The others, e.g. of changesets added after the index was
+    updated, are always candidates, so membership is meaningful only for
+    revisions covered by the index.  The set is kept small to be sent to
+    search workers.
+    """
+
+    def __init__(self, nodes, tiprev):
+        self._nodes = nodes
+        self.tiprev = tiprev
+
+    def covers(self, rev):
+        """True if the file revisions of the changeset are known"""
+        return rev is not None and rev <= self.tiprev
+
+    def __contains__(self, fnode):
+        return fnode in self._nodes
+
+    def __len__(self):
+        return len(self._nodes)
+
+
+class TrigramIndex(object):
+    """Trigram index of file revisions of a repository"""
+
+    def __init__(self):
+        self.tiprev = nodemod.nullrev
+        self.tipnode = nodemod.nullid
+        self._filenodes = []  # id: filenode
+        self._fileids = {}  # filenode: id
+        self._unindexed = set()  # ids of file revisions not indexed
+        self._postings = {}  # trigram: array of ids in ascending order
+
+    def __len__(self):
+        return len(self._filenodes)
+
+    @classmethod
+    def read(cls, vfs):
+        """Read the index saved in .hg/cache; None if not available"""
+        try:
+            buf = vfs.read(_CACHEFILE)
+        except (IOError, OSError):
+            return None
+        try:
+            (magic, version, byteorder, tipnode, tiprev, nfiles, nunindexed,
+             ntrigrams) = _CACHEHEADER.unpack_from(buf, 0)
+        except struct.error:
+            return None
+        if (magic, version, byteorder) != (_CACHEMAGIC, _CACHEVERSION,
+                                           _CACHEBYTEORDER):
+            return None
+        self = cls()
+        self.tiprev = tiprev
+        self.tipnode = tipnode
+        try:
+            offset = _CACHEHEADER.size
+            itemsize = array.array(_IDTYPE).itemsize
+            end = offset + 20 * nfiles
+            self._filenodes = [buf[i:i + 20]
+                               for i in pycompat.xrange(offset, end, 20)]
+            offset = end
+            end = offset + itemsize * nunindexed
+            self._unindexed = set(_toarray(buf[offset:end]))
+            offset = end
+            end = offset + 3 * ntrigrams
+            trigrams = [buf[i:i + 3] for i in pycompat.xrange(offset, end, 3)]
+            offset = end
+            end = offset + itemsize * ntrigrams
+            counts = _toarray(buf[offset:end])
+            offset = end
+            for t, n in zip(trigrams, counts):
+                end = offset + itemsize * n
+                self._postings[t] = _toarray(buf[offset:end])
+                offset = end
+        except ValueError:
+            return None  # truncated
+        if (len(self._filenodes) != nfiles or len(counts) != ntrigrams
+            or offset != len(buf)):
+            return None  # truncated
+        self._fileids = dict((n, i) for i, n in enumerate(self._filenodes))
+        return self
+
+    def write(self, vfs):
+        """Save the index to .hg/cache"""
+        trigrams = sorted(self._postings)
+        postings = [self._postings[t] for t in trigrams]
+        try:
+            with vfs(_CACHEFILE, b'wb', atomictemp=True) as fp:
+                fp.write(_CACHEHEADER.pack(
+                    _CACHEMAGIC, _CACHEVERSION, _CACHEBYTEORDER,
+                    self.tipnode, self.tiprev, len(self._filenodes),
+                    len(self._unindexed), len(trigrams)))
+                fp.write(b''.join(self._filenodes))
+                fp.write(_tobytes(array.array(_IDTYPE,
+                                              sorted(self._unindexed))))
+                fp.write(b''.join(trigrams))
+                fp.write(_tobytes(array.array(_IDTYPE,
+                                              [len(a) for a in postings])))
+                for a in postings:
+                    fp.write(_tobytes(a))
+        except (IOError, OSError):
+            pass  # read-only repository, for example
+
+    def _clear(self):
+        self.__init__()
+
+    def _addfile(self, repo, path, fnode):
+        i = len(self._filenodes)
+        self._filenodes.append(fnode)
+        self._fileids[fnode] = i
+        try:
+            data = repo.file(path).read(fnode)
+        except error.CensoredNodeError:
+            data = None
+        if data is None or len(data) > _MAX_FILE_SIZE or b'\0' in data:
+            self._unindexed.add(i)
+            return
+        postings = self._postings
+        for t in _trigrams(data):
+            a = postings.get(t)
+            if a is None:
+                postings[t] = array.array(_IDTYPE, [i])
+            else:
+                a.append(i)
+
+    def update(self, repo, progress=None, canceled=None):
+        """Index file revisions of changesets added since the last update
+
+        progress(pos, total) is called for every changeset, and the update
+        stops after the current changeset if canceled() returns True.
+        Returns True if the index is changed.
+        """
+        repo = repo.unfiltered()
+        cl = repo.changelog
+        if (self.tiprev >= len(cl)
+            or (self.tiprev != nodemod.nullrev
+                and cl.node(self.tiprev) != self.tipnode)):
+            self._clear()  # stripped
+        start = self.tiprev + 1
+        for rev in pycompat.xrange(start, len(cl)):
+            if canceled and canceled():
+                break
+            if progress:
+                progress(rev - start, len(cl) - start)
+            ctx = repo[rev]
+            for path in ctx.files():
+                try:
+                    fnode = ctx.filenode(path)
+                except error.LookupError:
+                    continue  # removed
+                if fnode not in self._fileids:
+                    self._addfile(repo, path, fnode)
+            self.tiprev = rev
+            self.tipnode = cl.node(rev)
+        return self.tiprev >= start
+
+    def _lookup(self, query):
+        """Set of ids of file revisions matching the query, or None if all
+        may match"""
+        if query is None:
+            return None
+        if isinstance(query, frozenset):
+            postings = [self._postings.get(t) for t in query]
+            if any(a is None for a in postings):
+                return set()
+            return self._intersection(postings)
+        op, queries = query
+        results = [self._lookup(q) for q in queries]
+        if op == 'or':
+            if any(r is None for r in results):
+                return None
+            return set().union(*results)
+        return self._intersection([r for r in results if r is not None])
+
+    def _intersection(self, sets):
+        if not sets:
+            return None
+        sets = sorted(sets, key=len)
+        ids = set(sets[0])
+        for s in sets[1:]:
+            if not ids:
+                break
+            ids.intersection_update(s)
+        return ids
+
+    def candidates(self, pattern, flags=0):
+        """CandidateSet of file revisions which may match the regular
+        expression, or None if it doesn't narrow the search"""
+        ids = self._lookup(regexquery(pattern, flags))
+        if ids is None:
+            return None
+        ids.update(self._unindexed)
+        filenodes = self._filenodes
+        return CandidateSet(frozenset(filenodes[i] for i in ids), self.tiprev)
+
+def isenabled(ui):
+    return ui.configbool(b'tortoisehg', b'grepindex')
+
+def updatedindex(repo, progress=None, canceled=None):
+    """Load the index of the repository, and update it to the current tip
+
+    The indexes of recently searched repositories are kept in memory for
+    subsequent searches, and saved to .hg/cache if updated.  Only one thread
+    can load or update the index of a repository at a time.
+    """
+    root = repo.root
+    with _lock:
+        rootlock = _rootlocks.setdefault(root, threading.Lock())
+    with rootlock:
+        with _lock:
+            index = _indexes.pop(root, None)
+        if index is None:
+            index = TrigramIndex.read(repo.cachevfs) or TrigramIndex()
+        if index.update(repo, progress, canceled):
+            index.write(repo.cachevfs)
+        with _lock:
+            _indexes[root] = index
+            while len(_indexes) > _MAX_INDEXES:
+                _indexes.popitem(last=False)
+        return index